@@ -0,0 +1,441 @@
+"""
+Upstream catchment tracing from the D8 pointer grid
+
+Built on the point_query.py index. The uint8 flow_dir memory map is read once
+to build a flow index:
+- upstream (uint8): reverse-flow bitmask; bit k is set when the neighbour in
+  direction D8_DIRECTIONS[k] drains into the cell
+- order: every cell in preorder of the upstream flow tree, so the catchment
+  of any cell is the contiguous range order[position[cell]:position[cell] + size[cell]]
+- position, size: each cell's start in order and its catchment size in cells
+- block_counts: per BLOCK cells of order, the cumulative count of every
+  accumulation class and of stream cells
+- block_bounds: per BLOCK cells of order, their min/max row and column
+- outline_keys_F, outline_starts_F: for each of OUTLINE_FACTORS, order split
+  into runs of consecutive cells inside the same F x F block, sorted by block
+  then position: key block * (n + 1) + run end, and the run start
+
+Tracing is then a range lookup rather than a search: subcatchments nest
+inside the catchments that contain them, so nothing upstream is traced twice,
+and class and stream counts come from block_counts plus at most two partial
+blocks, however much of the county drains to the outlet. Outlines of small
+catchments are gathered cell by cell from one contiguous slice of order.
+Larger ones take their bounding box from block_bounds the same way, then
+test every F x F block inside it, at the finest level with at most
+MAX_OUTLINE_GATHER of them, with one binary search each for a run inside the
+catchment's range, so no query touches more than that many entries. Outlines
+are kept in an LRU cache.
+
+Usage:
+    python catchment.py build
+    python catchment.py trace 33.45 -112.07 [--snap 100] [--output catchment.geojson]
+    python catchment.py pois [--output catchments.geojson]
+"""
+
+import argparse
+import functools
+import json
+import math
+import os
+import time
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from point_query import INDEX_DIR, PointIndex, layer_path
+
+# WhiteboxTools D8 pointer codes and (dy, dx) offsets, as in dem/hydrology.py
+D8_DIRECTIONS = [
+    (1, -1, 1),     # NE
+    (2, 0, 1),      # E
+    (4, 1, 1),      # SE
+    (8, 1, 0),      # S
+    (16, 1, -1),    # SW
+    (32, 0, -1),    # W
+    (64, -1, -1),   # NW
+    (128, -1, 0),   # N
+]
+# Cells of order per block_counts row
+BLOCK = 4096
+# Catchment outlines are rasterised on at most this many cells
+MAX_OUTLINE_CELLS = 4_000_000
+# Block sides of the coarse outline levels, and the most cells or blocks
+# an outline may gather
+OUTLINE_FACTORS = (16, 64, 256)
+MAX_OUTLINE_GATHER = 1_000_000
+NUM_CLASSES = 4
+POIS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "lib", "data", "pois.json")
+FLOW_INDEX = ["upstream", "order", "position", "size", "block_counts", "block_bounds"] + [
+    f"outline_{kind}_{factor}" for factor in OUTLINE_FACTORS for kind in ("keys", "starts")]
+
+def flow_index_exists(index_dir=INDEX_DIR):
+    return all(os.path.exists(layer_path(index_dir, name)) for name in FLOW_INDEX)
+
+def upstream_bitmask(pointer):
+    """
+    Reverse-flow bitmask of a D8 pointer grid (bit k: neighbour k drains here)
+    """
+    rows, cols = pointer.shape
+    upstream = np.zeros((rows, cols), dtype=np.uint8)
+    codes = {(dy, dx): code for code, dy, dx in D8_DIRECTIONS}
+    for k, (_, dy, dx) in enumerate(D8_DIRECTIONS):
+        # The neighbour at (dy, dx) drains here if it points back along (-dy, -dx)
+        back = codes[(-dy, -dx)]
+        src = pointer[max(dy, 0):rows + min(dy, 0), max(dx, 0):cols + min(dx, 0)]
+        dst = upstream[max(-dy, 0):rows + min(-dy, 0), max(-dx, 0):cols + min(-dx, 0)]
+        dst |= (src == back).astype(np.uint8) << k
+    return upstream
+
+def _upstream_of(parents, bits, offsets):
+    """
+    For each direction, (mask over parents, upstream neighbour flat indices)
+    """
+    for k, offset in enumerate(offsets):
+        has = (bits >> k) & 1 == 1
+        yield has, parents[has] + offset
+
+def build_flow_index(index_dir=INDEX_DIR):
+    """
+    Write the reverse-flow bitmask and preorder catchment ranges of flow_dir
+
+    Cells are visited outlet first, one upstream wave at a time: the waves
+    give catchment sizes (summed back downstream), then preorder positions
+    (each cell's upstream neighbours take consecutive ranges after it).
+    """
+    pointer = np.load(layer_path(index_dir, "flow_dir"), mmap_mode="r")
+    rows, cols = pointer.shape
+    n = rows * cols
+    index_type = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    offsets = [dy * cols + dx for _, dy, dx in D8_DIRECTIONS]
+
+    print("Building reverse-flow bitmask...")
+    upstream = upstream_bitmask(np.asarray(pointer))
+    np.save(layer_path(index_dir, "upstream"), upstream)
+    bits = upstream.reshape(-1)
+
+    # Outlets: cells draining nowhere or off the grid (nobody's upstream neighbour)
+    has_down = np.zeros(n, dtype=bool)
+    for k, offset in enumerate(offsets):
+        has = np.flatnonzero((bits >> k) & 1)
+        has_down[has + offset] = True
+    outlets = np.flatnonzero(~has_down).astype(index_type)
+    del has_down
+
+    print("Ordering cells upstream from outlets...")
+    waves = [outlets]
+    while waves[-1].size:
+        frontier = waves[-1]
+        waves.append(np.concatenate([cells for _, cells in _upstream_of(frontier, bits[frontier], offsets)]))
+    waves.pop()
+    if sum(wave.size for wave in waves) != n:
+        raise ValueError("flow_dir has cells that never reach an outlet (a flow cycle)")
+
+    size = np.ones(n, dtype=index_type)
+    for wave in reversed(waves):
+        wave_bits = bits[wave]
+        total = size[wave]
+        for has, cells in _upstream_of(wave, wave_bits, offsets):
+            total[has] += size[cells]
+        size[wave] = total
+
+    position = np.empty(n, dtype=index_type)
+    position[outlets] = np.cumsum(size[outlets]) - size[outlets]
+    for wave in waves:
+        nxt = position[wave] + 1
+        for has, cells in _upstream_of(wave, bits[wave], offsets):
+            position[cells] = nxt[has]
+            nxt[has] += size[cells]
+
+    order = np.empty(n, dtype=index_type)
+    order[position] = np.arange(n, dtype=index_type)
+    np.save(layer_path(index_dir, "order"), order)
+    np.save(layer_path(index_dir, "position"), position)
+    np.save(layer_path(index_dir, "size"), size)
+
+    print("Counting classes per block...")
+    classes = np.load(layer_path(index_dir, "accum_class"), mmap_mode="r").reshape(-1)
+    distance = np.load(layer_path(index_dir, "stream_distance"), mmap_mode="r").reshape(-1)
+    blocks = math.ceil(n / BLOCK)
+    counts = np.zeros((blocks + 1, NUM_CLASSES + 2), dtype=np.int64)
+    bounds = np.empty((blocks, 4), dtype=np.int32)
+    chunk = BLOCK * 256
+    for start in range(0, n, chunk):
+        cells = order[start:start + chunk]
+        block = np.arange(cells.size) // BLOCK
+        first = start // BLOCK + 1
+        nblocks = block[-1] + 1
+        key = block * (NUM_CLASSES + 1) + np.minimum(classes[cells], NUM_CLASSES)
+        counts[first:first + nblocks, :-1] = np.bincount(
+            key, minlength=nblocks * (NUM_CLASSES + 1)).reshape(nblocks, -1)
+        counts[first:first + nblocks, -1] = np.bincount(
+            block, weights=distance[cells] == 0, minlength=nblocks)
+        cell_rows, cell_cols = np.divmod(cells, cols)
+        edges = np.arange(0, cells.size, BLOCK)
+        for i, (reduce, values) in enumerate([(np.minimum, cell_rows), (np.maximum, cell_rows),
+                                              (np.minimum, cell_cols), (np.maximum, cell_cols)]):
+            bounds[first - 1:first - 1 + nblocks, i] = reduce.reduceat(values, edges)
+    np.save(layer_path(index_dir, "block_counts"), np.cumsum(counts, axis=0))
+    np.save(layer_path(index_dir, "block_bounds"), bounds)
+
+    print("Splitting order into outline runs...")
+    for factor in OUTLINE_FACTORS:
+        keys, starts = outline_runs(order, cols, factor, chunk)
+        np.save(layer_path(index_dir, f"outline_keys_{factor}"), keys)
+        np.save(layer_path(index_dir, f"outline_starts_{factor}"), starts.astype(index_type))
+    return len(waves)
+
+def outline_runs(order, cols, factor, chunk):
+    """
+    Runs of consecutive cells of order inside the same factor x factor block
+
+    Returns (keys, starts) sorted by block, then position in order: key is
+    block * (n + 1) + the run's end, so the first run of a block ending after
+    a position is one binary search away.
+    """
+    block_cols = -(-cols // factor)
+    starts, blocks = [], []
+    previous = -1
+    for start in range(0, order.size, chunk):
+        rows, columns = np.divmod(order[start:start + chunk].astype(np.int64), cols)
+        block = rows // factor * block_cols + columns // factor
+        new = np.flatnonzero(np.concatenate(([block[0] != previous], block[1:] != block[:-1])))
+        starts.append(new + start)
+        blocks.append(block[new])
+        previous = block[-1]
+    starts, blocks = np.concatenate(starts), np.concatenate(blocks)
+    ends = np.append(starts[1:], order.size)
+    keys = blocks * (order.size + 1) + ends
+    by_block = np.argsort(keys)
+    return keys[by_block], starts[by_block]
+
+class CatchmentEngine:
+    """
+    Upstream catchments of points, from the point_query.py index and its flow index
+
+    Parameters:
+    index_dir (str): Directory holding both indexes
+    cache_outlines (int): Catchment outlines kept in the LRU cache
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, cache_outlines=256):
+        self.points = PointIndex(index_dir)
+        self.rows, self.cols = self.points.rows, self.points.cols
+        load = lambda name: np.load(layer_path(index_dir, name), mmap_mode="r")
+        self.order = load("order")
+        self.position = load("position").reshape(-1)
+        self.size = load("size").reshape(-1)
+        self.block_counts = load("block_counts")
+        self.classes = self.points.layers["accum_class"].reshape(-1)
+        self.distance = self.points.layers["stream_distance"].reshape(-1)
+        self.accum = self.points.layers["flow_accum"]
+        self.block_bounds = load("block_bounds")
+        self.outline_levels = [(factor, load(f"outline_keys_{factor}"), load(f"outline_starts_{factor}"))
+                               for factor in OUTLINE_FACTORS]
+        self._outline = functools.lru_cache(maxsize=cache_outlines)(self._trace_outline)
+
+    def snap(self, row, col, radius):
+        """
+        Cell of highest accumulation within radius cells of (row, col)
+        """
+        if radius <= 0:
+            return row, col
+        top, left = max(row - radius, 0), max(col - radius, 0)
+        window = np.nan_to_num(np.asarray(self.accum[top:row + radius + 1, left:col + radius + 1]), nan=-1)
+        r, c = np.unravel_index(np.argmax(window), window.shape)
+        return top + int(r), left + int(c)
+
+    def cells(self, row, col):
+        """
+        Flat indices of every cell draining through (row, col), outlet first
+        """
+        cell = row * self.cols + col
+        start = int(self.position[cell])
+        return self.order[start:start + int(self.size[cell])]
+
+    def _range_counts(self, start, stop):
+        """
+        Class and stream cell counts of order[start:stop]
+        """
+        first, last = -(-start // BLOCK), stop // BLOCK
+        if first >= last:
+            return self._count_cells(self.order[start:stop])
+        counts = self.block_counts[last] - self.block_counts[first]
+        counts = counts + self._count_cells(self.order[start:first * BLOCK])
+        return counts + self._count_cells(self.order[last * BLOCK:stop])
+
+    def _count_cells(self, cells):
+        cells = np.sort(cells)
+        counts = np.bincount(np.minimum(self.classes[cells], NUM_CLASSES), minlength=NUM_CLASSES + 1)
+        return np.append(counts, np.count_nonzero(self.distance[cells] == 0))
+
+    def stats(self, row, col):
+        cell = row * self.cols + col
+        start, n = int(self.position[cell]), int(self.size[cell])
+        counts = self._range_counts(start, start + n)
+        return {
+            "cells": n,
+            "area_km2": round(n * self.points.cell_area_km2, 4),
+            "class_cells": {str(c): int(counts[c]) for c in range(1, NUM_CLASSES + 1)},
+            "stream_cells": int(counts[-1]),
+        }
+
+    def _range_bounds(self, start, stop):
+        """
+        (top, bottom, left, right) rows and columns of order[start:stop]
+        """
+        first, last = -(-start // BLOCK), stop // BLOCK
+        parts = [self.order[start:min(first * BLOCK, stop)], self.order[max(last * BLOCK, start):stop]]
+        rows, cols = np.divmod(np.concatenate(parts).astype(np.int64), self.cols)
+        top, bottom = list(rows), list(rows)
+        left, right = list(cols), list(cols)
+        if first < last:
+            bounds = self.block_bounds[first:last]
+            top.append(bounds[:, 0].min())
+            bottom.append(bounds[:, 1].max())
+            left.append(bounds[:, 2].min())
+            right.append(bounds[:, 3].max())
+        return int(min(top)), int(max(bottom)), int(min(left)), int(max(right))
+
+    def _outline_blocks(self, row, col):
+        """
+        (block side, flat block indices) covering the catchment of (row, col)
+
+        Small catchments are their own cells. Larger ones test every block of
+        the finest level with at most MAX_OUTLINE_GATHER blocks over their
+        bounding box (or the coarsest) for a run inside the catchment's range.
+        """
+        cell = row * self.cols + col
+        start, stop = int(self.position[cell]), int(self.position[cell]) + int(self.size[cell])
+        if stop - start <= MAX_OUTLINE_GATHER:
+            return 1, np.asarray(self.order[start:stop], dtype=np.int64)
+
+        top, bottom, left, right = self._range_bounds(start, stop)
+        for factor, keys, starts in self.outline_levels:
+            if (bottom // factor - top // factor + 1) * (right // factor - left // factor + 1) \
+                    <= MAX_OUTLINE_GATHER:
+                break
+        block_rows, block_cols = np.mgrid[top // factor:bottom // factor + 1,
+                                          left // factor:right // factor + 1]
+        blocks = (block_rows * -(-self.cols // factor) + block_cols).reshape(-1)
+        # First run of each block ending after start, and whether it begins before stop
+        n = self.order.size + 1
+        found = np.searchsorted(keys, blocks * n + start, side="right")
+        run = np.minimum(found, keys.size - 1)
+        inside = (found < keys.size) & (keys[run] // n == blocks) & (starts[run] < stop)
+        return factor, blocks[inside]
+
+    def _trace_outline(self, row, col):
+        """
+        Catchment outline as a GeoJSON geometry in WGS84, plus its bounds in cells
+        """
+        level, blocks = self._outline_blocks(row, col)
+        rows, cols = np.divmod(blocks, -(-self.cols // level))
+        top, left = int(rows.min()), int(cols.min())
+        height, width = int(rows.max()) - top + 1, int(cols.max()) - left + 1
+        extra = max(1, math.ceil(math.sqrt(height * width / MAX_OUTLINE_CELLS)))
+        mask = np.zeros((-(-height // extra), -(-width // extra)), dtype=np.uint8)
+        mask[(rows - top) // extra, (cols - left) // extra] = 1
+        factor = level * extra
+        top, left = top * level, left * level
+        height = min(height * level, self.rows - top)
+        width = min(width * level, self.cols - left)
+
+        gt = self.points.geotransform
+        driver = gdal.GetDriverByName("MEM")
+        ds = driver.Create("", mask.shape[1], mask.shape[0], 1, gdal.GDT_Byte)
+        ds.SetGeoTransform((gt[0] + left * gt[1], gt[1] * factor, 0,
+                            gt[3] + top * gt[5], 0, gt[5] * factor))
+        srs = osr.SpatialReference(wkt=self.points.meta["projection"])
+        ds.SetProjection(srs.ExportToWkt())
+        band = ds.GetRasterBand(1)
+        band.WriteArray(mask)
+
+        vectors = ogr.GetDriverByName("Memory").CreateDataSource("")
+        layer = vectors.CreateLayer("catchment", srs=srs, geom_type=ogr.wkbPolygon)
+        layer.CreateField(ogr.FieldDefn("VALUE", ogr.OFTInteger))
+        gdal.Polygonize(band, band, layer, 0)
+
+        outline = ogr.Geometry(ogr.wkbMultiPolygon)
+        for feature in layer:
+            outline.AddGeometry(feature.GetGeometryRef())
+        outline = outline.UnionCascaded()
+        wgs84 = osr.SpatialReference()
+        wgs84.ImportFromEPSG(4326)
+        wgs84.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        if not srs.IsSame(wgs84):
+            outline.Transform(osr.CoordinateTransformation(srs, wgs84))
+        return json.loads(outline.ExportToJson()), [top, left, height, width], factor
+
+    def trace(self, lat, lon, snap=0, outline=True):
+        """
+        Upstream catchment of a point as a GeoJSON feature
+
+        Parameters:
+        lat, lon (float): Point to trace from
+        snap (int): Move the point to the highest-accumulation cell within this many cells
+        outline (bool): Include the catchment outline (otherwise geometry is the outlet point)
+        """
+        rows, cols, inside = self.points.cells([lat], [lon])
+        if not inside[0]:
+            return {"type": "Feature", "geometry": None,
+                    "properties": {"lat": lat, "lon": lon, "cells": 0, "error": "outside the rasters"}}
+        row, col = self.snap(int(rows[0]), int(cols[0]), snap)
+        properties = {"lat": lat, "lon": lon, "outlet": [row, col], **self.stats(row, col)}
+        geometry = {"type": "Point", "coordinates": [lon, lat]}
+        if outline:
+            geometry, bounds, factor = self._outline(row, col)
+            properties.update({"bounds": bounds, "outline_cell_factor": factor})
+        return {"type": "Feature", "geometry": geometry, "properties": properties}
+
+    def trace_many(self, lats, lons, snap=0, outline=True):
+        return [self.trace(float(lat), float(lon), snap, outline) for lat, lon in zip(lats, lons)]
+
+def _write_features(path, features):
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    print(f"Wrote {len(features)} catchments to {path}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upstream catchments from the D8 pointer grid")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("build", help="Build the flow index (after point_query.py build)")
+
+    trace = commands.add_parser("trace", help="Trace the catchment of one point")
+    trace.add_argument("lat", type=float)
+    trace.add_argument("lon", type=float)
+    trace.add_argument("--snap", type=int, default=0,
+                       help="Snap to the highest-accumulation cell within this many cells")
+    trace.add_argument("--output", default=None, help="GeoJSON file to write (defaults to stdout)")
+
+    pois = commands.add_parser("pois", help="Trace the catchment of every flood event POI")
+    pois.add_argument("--pois", default=POIS_PATH)
+    pois.add_argument("--snap", type=int, default=0)
+    pois.add_argument("--output", default="catchments.geojson")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        start = time.perf_counter()
+        waves = build_flow_index(args.index_dir)
+        print(f"Flow index ready ({waves} upstream waves) in {time.perf_counter() - start:.1f}s")
+    elif args.command == "trace":
+        feature = CatchmentEngine(args.index_dir).trace(args.lat, args.lon, args.snap)
+        if args.output:
+            _write_features(args.output, [feature])
+        else:
+            print(json.dumps(feature, indent=2))
+    else:
+        with open(args.pois) as f:
+            points = json.load(f)["features"]
+        engine = CatchmentEngine(args.index_dir)
+        start = time.perf_counter()
+        features = []
+        for poi in points:
+            lon, lat = poi["geometry"]["coordinates"][:2]
+            feature = engine.trace(lat, lon, args.snap)
+            feature["properties"]["name"] = poi["properties"].get("name")
+            features.append(feature)
+        print(f"Traced {len(features)} catchments in {time.perf_counter() - start:.1f}s")
+        _write_features(args.output, features)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite for the hydrology pipeline on synthetic DEMs
+
+Generates reproducible synthetic DEMs (a regional slope plus fractal value
+noise, which drains into dendritic networks with pits and flats like a real
+DEM) at several sizes, then runs each stage of the pipeline on them:
+- delineate: delineate_basins with the chosen backend
+- reclassify: reclassify_influence_raster
+- pmtiles: the tile build that replaced convert_raster_to_vector
+  (water-tile-generation/build_pmtiles.py)
+
+Every stage runs in a freshly spawned process so its wall time, CPU time
+(including worker and WhiteboxTools subprocesses) and peak RSS are its own.
+Bytes written are the sizes of the stage's output files. Results are written
+as JSON; with --baseline they are compared against an earlier run and the
+exit status is 1 when any stage regressed beyond the tolerance.
+
+Runs offline: nothing is downloaded, and the stage cache is bypassed.
+
+Usage:
+    python benchmark.py bench/ --sizes 1024 2048 4096 --backend numpy
+    python benchmark.py bench/ --baseline bench_baseline.json --tolerance 0.2
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+import numpy as np
+from osgeo import gdal, osr
+
+from rasters import GTIFF_OPTIONS
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TILE_BUILDER_DIR = os.path.join(HERE, "..", "water-tile-generation")
+
+DEFAULT_SIZES = [1024, 2048, 4096]
+STAGES = ["delineate", "reclassify", "pmtiles"]
+
+# Synthetic DEMs sit over Phoenix at 1 arc-second (about 30 m) cells
+ORIGIN = (-112.5, 33.8)
+CELL_SIZE = 1 / 3600
+# Rows generated per block, so DEMs of any size are built in bounded memory
+GENERATE_ROWS = 1024
+# Slowdowns smaller than this many seconds are timing noise, not regressions
+MIN_WALL_DELTA = 0.5
+
+def _smoothstep(t):
+    return t * t * (3 - 2 * t)
+
+def value_noise(rows, cols, size, period, seed, octave):
+    """
+    Value noise at the given rows and columns with one lattice point every period cells
+
+    The lattice depends only on size, period and (seed, octave), so any block of
+    the DEM can be generated on its own.
+    """
+    n = size // period + 2
+    lattice = np.random.default_rng([seed, octave]).random((n, n), dtype=np.float32)
+    y = rows.astype(np.float32) / period
+    x = cols.astype(np.float32) / period
+    y0 = y.astype(np.int64)
+    x0 = x.astype(np.int64)
+    ty = _smoothstep(y - y0)[:, None]
+    tx = _smoothstep(x - x0)[None, :]
+    # Interpolate between lattice rows first, while the rows are still lattice-wide
+    between = lattice[y0] * (1 - ty) + lattice[y0 + 1] * ty
+    return between[:, x0] * (1 - tx) + between[:, x0 + 1] * tx
+
+def synthetic_dem_block(row0, nrows, size, seed=0, relief=400.0, slope=0.01):
+    """
+    Elevations (metres) of rows row0..row0+nrows of a size x size synthetic DEM
+
+    A regional slope falling to the south-west (like the valley floor below
+    the Mazatzal and McDowell ranges) under fractal value noise whose octaves
+    run from half the DEM down to 4 cells, each at half the amplitude of the last.
+    """
+    rows = np.arange(row0, row0 + nrows)
+    cols = np.arange(size)
+    cell_m = CELL_SIZE * 111320.0
+    dem = ((size - rows)[:, None] + cols[None, :]).astype(np.float32) * (slope * cell_m / 2)
+
+    period = size // 2
+    amplitude = relief
+    octave = 0
+    while period >= 4:
+        dem += amplitude * value_noise(rows, cols, size, period, seed, octave)
+        period //= 2
+        amplitude /= 2
+        octave += 1
+    return dem
+
+def write_synthetic_dem(path, size, seed=0):
+    """
+    Write a size x size synthetic DEM GeoTIFF, block by block
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+    driver = gdal.GetDriverByName("GTiff")
+    ds = driver.Create(path, size, size, 1, gdal.GDT_Float32, options=GTIFF_OPTIONS)
+    ds.SetGeoTransform((ORIGIN[0], CELL_SIZE, 0, ORIGIN[1], 0, -CELL_SIZE))
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(-9999)
+    for row0 in range(0, size, GENERATE_ROWS):
+        nrows = min(GENERATE_ROWS, size - row0)
+        band.WriteArray(synthetic_dem_block(row0, nrows, size, seed), 0, row0)
+    ds = None
+    return path
+
+def file_bytes(paths):
+    return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+def _stage_delineate(dem_path, work_dir, options):
+    from tiles import DELINEATION_OUTPUTS, delineate_basins
+    output_dir = os.path.join(work_dir, "tiles")
+    delineate_basins(dem_path, output_dir, options["threshold"], 1, backend=options["backend"],
+                     tiles=options["tiles"], workers=options["workers"])
+    return [os.path.join(output_dir, name) for name in DELINEATION_OUTPUTS]
+
+def _stage_reclassify(dem_path, work_dir, options):
+    from tiles import reclassify_influence_raster
+    output_dir = os.path.join(work_dir, "tiles")
+    output_file = os.path.join(output_dir, "stream_influence_reclass.tif")
+    reclassify_influence_raster(os.path.join(output_dir, "stream_influence.tif"), output_file)
+    return [output_file]
+
+def _stage_pmtiles(dem_path, work_dir, options):
+    sys.path.insert(0, TILE_BUILDER_DIR)
+    from build_pmtiles import build_pmtiles
+    output_file = os.path.join(work_dir, "tiles.pmtiles")
+    build_pmtiles(os.path.join(work_dir, "tiles", "stream_influence_reclass.tif"), output_file,
+                  max_zoom=options["max_zoom"], workers=options["workers"],
+                  state_path=os.path.join(work_dir, "tiles.pmtiles.state.json"))
+    return [output_file]
+
+STAGE_FUNCTIONS = {
+    "delineate": _stage_delineate,
+    "reclassify": _stage_reclassify,
+    "pmtiles": _stage_pmtiles,
+}
+
+def _measure_stage(stage, dem_path, work_dir, options, queue):
+    os.chdir(HERE)
+    sys.path.insert(0, HERE)
+    gdal.UseExceptions()
+    start_wall = time.perf_counter()
+    start_cpu = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    outputs = STAGE_FUNCTIONS[stage](dem_path, work_dir, options)
+    wall = time.perf_counter() - start_wall
+    end_cpu = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+
+    cpu = sum((end.ru_utime + end.ru_stime) - (begin.ru_utime + begin.ru_stime)
+              for begin, end in zip(start_cpu, end_cpu))
+    # ru_maxrss is in KB on Linux; children are waited-for workers and tool processes
+    peak_kb = max(end.ru_maxrss for end in end_cpu)
+    queue.put({
+        "wall_s": round(wall, 3),
+        "cpu_s": round(cpu, 3),
+        "peak_rss_mb": round(peak_kb / 1024, 1),
+        "bytes_written": file_bytes(outputs),
+    })
+
+def run_stage_isolated(stage, dem_path, work_dir, options):
+    """
+    Run one stage in a fresh process and return its measurements
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure_stage,
+                              args=(stage, dem_path, work_dir, options, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed on {dem_path} (exit code {process.exitcode})")
+    return queue.get()
+
+def run_benchmarks(work_dir, sizes=DEFAULT_SIZES, stages=STAGES, backend="numpy", tiles=None,
+                   workers=None, threshold=500, max_zoom=13, seed=0):
+    """
+    Generate (or reuse) the synthetic DEMs and time every stage on each
+
+    Returns the results document written by main.
+    """
+    os.makedirs(work_dir, exist_ok=True)
+    options = {"backend": backend, "tiles": tiles, "workers": workers,
+               "threshold": threshold, "max_zoom": max_zoom}
+    results = []
+    for size in sizes:
+        size_dir = os.path.join(work_dir, f"dem_{size}_seed_{seed}")
+        os.makedirs(size_dir, exist_ok=True)
+        dem_path = os.path.join(size_dir, "dem.tif")
+        if not os.path.exists(dem_path):
+            print(f"Generating {size}x{size} synthetic DEM (seed {seed})...")
+            write_synthetic_dem(dem_path, size, seed)
+
+        for stage in stages:
+            print(f"Benchmarking {stage} on {size}x{size}...")
+            measured = run_stage_isolated(stage, os.path.abspath(dem_path),
+                                          os.path.abspath(size_dir), options)
+            measured["mcells_per_s"] = round(size * size / 1e6 / max(measured["wall_s"], 1e-9), 3)
+            results.append({"stage": stage, "size": size, **measured})
+            print(f"  {measured['wall_s']:.2f}s wall, {measured['cpu_s']:.2f}s CPU, "
+                  f"{measured['peak_rss_mb']:.0f} MB peak, {measured['bytes_written']} bytes")
+
+    return {
+        "config": {"seed": seed, "stages": list(stages), **options},
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "gdal": gdal.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+def compare_results(current, baseline, tolerance=0.2, memory_tolerance=0.2):
+    """
+    Regressions of a benchmark run against a baseline run
+
+    A stage regresses when its wall time (by at least MIN_WALL_DELTA seconds)
+    or peak RSS grows by more than the tolerance (a fraction), or its output
+    size changes by more than the tolerance either way. Returns a list of (stage, size, metric, baseline,
+    current) for the regressions, and prints a comparison table.
+    """
+    previous = {(row["stage"], row["size"]): row for row in baseline["results"]}
+    regressions = []
+    print(f"{'stage':<12} {'size':>6}  {'wall s':<18}{'peak MB':<18}{'bytes':<26}")
+    for row in current["results"]:
+        key = (row["stage"], row["size"])
+        if key not in previous:
+            print(f"{row['stage']:<12} {row['size']:>6} (not in baseline)")
+            continue
+        old = previous[key]
+        checks = [
+            ("wall_s", row["wall_s"] > old["wall_s"] * (1 + tolerance)
+                       and row["wall_s"] - old["wall_s"] >= MIN_WALL_DELTA),
+            ("peak_rss_mb", row["peak_rss_mb"] > old["peak_rss_mb"] * (1 + memory_tolerance)),
+            ("bytes_written",
+             abs(row["bytes_written"] - old["bytes_written"]) > old["bytes_written"] * tolerance),
+        ]
+        flags = [metric for metric, regressed in checks if regressed]
+        regressions.extend((row["stage"], row["size"], metric, old[metric], row[metric])
+                           for metric in flags)
+        print(f"{row['stage']:<12} {row['size']:>6}  "
+              f"{old['wall_s']:>7.2f} -> {row['wall_s']:<7.2f}"
+              f"{old['peak_rss_mb']:>7.0f} -> {row['peak_rss_mb']:<7.0f}"
+              f"{old['bytes_written']:>11} -> {row['bytes_written']:<11}"
+              f"{'  REGRESSED: ' + ', '.join(flags) if flags else ''}")
+    return regressions
+
+if __name__ == "__main__":
+    from tiled import parse_tiles
+
+    parser = argparse.ArgumentParser(description="Benchmark the hydrology pipeline on synthetic DEMs")
+    parser.add_argument("work_dir", help="Directory for synthetic DEMs and stage outputs")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="DEM sizes in cells per side")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--backend", choices=["whitebox", "whitebox_chain", "numpy"], default="numpy")
+    parser.add_argument("--tiles", type=parse_tiles, default=None,
+                        help="Run the delineation tiled, e.g. 4x4 (for the largest sizes)")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threshold", type=int, default=500, help="Stream threshold in cells")
+    parser.add_argument("--max-zoom", type=int, default=13, help="Deepest zoom of the tile build")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None,
+                        help="Results JSON (defaults to benchmark.json in work_dir)")
+    parser.add_argument("--baseline", default=None,
+                        help="Earlier results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fractional slowdown and output size change")
+    parser.add_argument("--memory-tolerance", type=float, default=0.2,
+                        help="Allowed fractional growth in peak RSS")
+    args = parser.parse_args()
+    if args.tiles is not None and args.backend != "numpy":
+        parser.error("--tiles runs the numpy backend")
+
+    report = run_benchmarks(args.work_dir, args.sizes, args.stages, args.backend, args.tiles,
+                            args.workers, args.threshold, args.max_zoom, args.seed)
+    output = args.output or os.path.join(args.work_dir, "benchmark.json")
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(report, baseline, args.tolerance, args.memory_tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.baseline}")
+            sys.exit(1)
+        print(f"No regressions against {args.baseline}")
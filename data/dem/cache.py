@@ -0,0 +1,194 @@
+"""
+Content-addressed cache for the stages of the tiles.py pipeline
+
+Each stage is keyed by the SHA-256 of its input files' contents, its
+parameters and the version of the tool that runs it. When a stage's key is
+already in the cache its outputs are copied into place instead of being
+recomputed, so tweaking a late parameter only reruns the stages after it.
+
+Entries live in <cache_dir>/<key>/ with a manifest.json recording the output
+hashes, total size and last use; the cache is trimmed least recently used
+first whenever it grows past max_bytes.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import profiling
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+def code_version(*paths):
+    """
+    Version string for in-process stages: a hash of the source files that run them
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+class StageCache:
+    """
+    Skip pipeline stages whose inputs, parameters and tool version are unchanged
+
+    Parameters:
+    cache_dir (str): Directory holding cached artifacts
+    max_bytes (int): Size limit; least recently used entries are evicted beyond it
+    force (bool): Recompute every stage (results are still stored)
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3, force=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.force = force
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # Content hashes of files, reused while (size, mtime) is unchanged
+        self.index_path = os.path.join(cache_dir, "file_hashes.json")
+        try:
+            with open(self.index_path) as f:
+                self.file_hashes = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.file_hashes = {}
+
+    def file_hash(self, path):
+        """
+        SHA-256 of a file's contents, memoised on its size and mtime
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        known = self.file_hashes.get(path)
+        if known and known[0] == stamp:
+            return known[1]
+
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                digest.update(chunk)
+        self._remember(path, digest.hexdigest())
+        return digest.hexdigest()
+
+    def _remember(self, path, content_hash):
+        stat = os.stat(path)
+        self.file_hashes[os.path.abspath(path)] = [[stat.st_size, stat.st_mtime_ns], content_hash]
+        with open(self.index_path, "w") as f:
+            json.dump(self.file_hashes, f)
+
+    def key(self, stage, inputs, params, version):
+        """
+        Cache key for a stage run
+        """
+        payload = {
+            "stage": stage,
+            "version": version,
+            "params": params,
+            "inputs": [self.file_hash(path) for path in inputs],
+        }
+        encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def run(self, stage, inputs, params, outputs, version, fn):
+        """
+        Run fn() unless a cached result for this exact stage run exists
+
+        Parameters:
+        stage (str): Stage name
+        inputs (list): Input file paths whose contents key the stage
+        params (dict): Parameters that affect the outputs
+        outputs (list): Output file paths the stage writes
+        version (str): Version of the tool running the stage
+        fn (callable): Computes the stage, writing every path in outputs
+
+        Returns True when the stage was served from the cache.
+        """
+        key = self.key(stage, inputs, params, version)
+        entry = os.path.join(self.cache_dir, key)
+        manifest_path = os.path.join(entry, "manifest.json")
+
+        if not self.force and os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+            for i, path in enumerate(outputs):
+                if manifest["outputs"][i] is None:
+                    continue
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                shutil.copyfile(os.path.join(entry, str(i)), path)
+                self._remember(path, manifest["outputs"][i])
+            manifest["last_used"] = time.time()
+            with open(manifest_path, "w") as f:
+                json.dump(manifest, f)
+            print(f"  ✓ {stage}: cached")
+            return True
+
+        fn()
+        self._store(entry, stage, outputs)
+        self.evict()
+        return False
+
+    def _store(self, entry, stage, outputs):
+        staging = entry + ".tmp"
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+
+        hashes = []
+        size = 0
+        for i, path in enumerate(outputs):
+            # Optional sidecars (e.g. a shapefile's .prj) may not be written
+            if not os.path.exists(path):
+                hashes.append(None)
+                continue
+            shutil.copyfile(path, os.path.join(staging, str(i)))
+            hashes.append(self.file_hash(path))
+            size += os.path.getsize(path)
+
+        with open(os.path.join(staging, "manifest.json"), "w") as f:
+            json.dump({"stage": stage, "outputs": hashes, "size": size,
+                       "last_used": time.time()}, f)
+
+        shutil.rmtree(entry, ignore_errors=True)
+        os.rename(staging, entry)
+
+    def entries(self):
+        """
+        (last_used, size, path) for every complete cache entry
+        """
+        found = []
+        for name in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.cache_dir, name, "manifest.json")
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                found.append((manifest["last_used"], manifest["size"],
+                              os.path.join(self.cache_dir, name)))
+        return found
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_bytes:
+            _, size, path = entries.pop(0)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+def run_stage(cache, stage, inputs, params, outputs, version, fn):
+    """
+    Run a stage through the cache, or directly when cache is None
+
+    The run is recorded in the active profiling.RunReport, if any.
+    """
+    with profiling.stage(stage, inputs, outputs) as record:
+        if cache is None:
+            fn()
+            cached = False
+        else:
+            cached = cache.run(stage, inputs, params, outputs, version, fn)
+        record["cached"] = cached
+    return cached
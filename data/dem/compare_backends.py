@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Parity harness for the hydrology backends in tiles.py
+
+Runs delineate_basins with two backends on the same DEM and reports how
+closely every output raster agrees. The backends are not expected to be
+bit-identical (WhiteboxTools breaks flats with a small elevation increment,
+the NumPy engine routes across them by distance to the flat's edge), so each
+raster is checked against a tolerance instead.
+
+The default pair is whitebox_chain, which runs every stage including the
+influence chain as WhiteboxTools tools, against the in-process numpy engine,
+so nothing is shared between the two sides. The whitebox backend's fused
+influence stage is a NumPy port of that chain; --influence checks it against
+the four WhiteboxTools tools on the same flow_accum.tif, and a whitebox run
+in the comparison does so on its own accumulation.
+
+Usage:
+    python compare_backends.py dem.tif comparison/ [--threshold 500]
+    python compare_backends.py tiles/flow_accum.tif comparison/ --influence
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+from osgeo import gdal
+
+from tiles import class_edges, classify_block, delineate_basins, fused_influence, whitebox_influence
+
+# Minimum agreement for each output before the comparison fails
+DEFAULT_TOLERANCES = {
+    "filled_dem.tif": 0.99,   # share of cells within --elevation-tolerance
+    "flow_dir.tif": 0.97,     # share of cells with the same pointer
+    "flow_accum.tif": 0.95,   # share of cells with the same accumulation
+    "streams.tif": 0.95,      # Jaccard index of stream cells
+    "stream_influence.tif": 0.97,  # share of cells with the same class
+}
+
+# fused_influence against the WhiteboxTools chain on the same accumulation:
+# rescaled (1-4) values within INFLUENCE_VALUE_TOLERANCE on at least
+# INFLUENCE_VALUE_SHARE of the cells, and the same class on INFLUENCE_CLASS_SHARE
+INFLUENCE_VALUE_TOLERANCE = 1e-3
+INFLUENCE_VALUE_SHARE = 0.999
+INFLUENCE_CLASS_SHARE = 0.995
+
+def read_valid(path):
+    """
+    Read a single-band raster as float64 with nodata as NaN
+    """
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    data = band.ReadAsArray().astype(np.float64)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        data[data == nodata] = np.nan
+    return data
+
+def compare_rasters(dir_a, dir_b, elevation_tolerance=0.05):
+    """
+    Agreement score for every output raster of two runs
+
+    Returns a dict of filename -> (score, detail string).
+    """
+    scores = {}
+
+    a, b = (read_valid(os.path.join(d, "filled_dem.tif")) for d in (dir_a, dir_b))
+    both = np.isfinite(a) & np.isfinite(b)
+    diff = np.abs(a - b)[both]
+    scores["filled_dem.tif"] = (
+        np.mean(diff <= elevation_tolerance) if diff.size else 1.0,
+        f"max |dz| = {diff.max() if diff.size else 0:.4f}"
+    )
+
+    for filename in ["flow_dir.tif", "flow_accum.tif", "stream_influence.tif"]:
+        a, b = (read_valid(os.path.join(d, filename)) for d in (dir_a, dir_b))
+        both = np.isfinite(a) & np.isfinite(b)
+        same = np.mean(a[both] == b[both]) if both.any() else 1.0
+        detail = f"{both.sum()} cells compared"
+        if filename == "flow_accum.tif" and both.any():
+            corr = np.corrcoef(np.log(a[both]), np.log(b[both]))[0, 1]
+            detail += f", log-correlation {corr:.4f}"
+        scores[filename] = (same, detail)
+
+    a, b = (read_valid(os.path.join(d, "streams.tif")) == 1 for d in (dir_a, dir_b))
+    union = np.count_nonzero(a | b)
+    jaccard = np.count_nonzero(a & b) / union if union else 1.0
+    scores["streams.tif"] = (jaccard, f"{np.count_nonzero(a)} vs {np.count_nonzero(b)} stream cells")
+
+    return scores
+
+def compare_influence(flow_accum, output_dir, max_influence_distance=1, num_classes=4):
+    """
+    Check fused_influence against the four-stage WhiteboxTools chain on one flow_accum.tif
+
+    Returns True when the rescaled values and the classes agree within the
+    INFLUENCE_* tolerances.
+    """
+    sigma = max_influence_distance / 4
+    paths = {name: os.path.join(output_dir, f"influence_{name}.tif") for name in ("whitebox", "fused")}
+    os.makedirs(output_dir, exist_ok=True)
+    print("\nRunning the WhiteboxTools influence chain...")
+    whitebox_influence(flow_accum, paths["whitebox"], sigma)
+    print("Running the fused influence stage...")
+    fused_influence(flow_accum, paths["fused"], sigma)
+
+    a, b = (read_valid(path) for path in paths.values())
+    both = np.isfinite(a) & np.isfinite(b)
+    mask_agreement = np.mean(np.isfinite(a) == np.isfinite(b))
+    diff = np.abs(a - b)[both]
+    values = np.mean(diff <= INFLUENCE_VALUE_TOLERANCE) if diff.size else 1.0
+    edges = class_edges(num_classes)
+    classes = np.mean(classify_block(a[both].astype(np.float32), edges) ==
+                      classify_block(b[both].astype(np.float32), edges)) if diff.size else 1.0
+
+    checks = [
+        ("valid cells", mask_agreement, 1.0, ""),
+        (f"values within {INFLUENCE_VALUE_TOLERANCE:g}", values, INFLUENCE_VALUE_SHARE,
+         f"; max |diff| = {diff.max() if diff.size else 0:.2e}"),
+        ("classes", classes, INFLUENCE_CLASS_SHARE, ""),
+    ]
+    print("\nfused_influence vs WhiteboxTools chain:")
+    passed = True
+    for name, score, need, detail in checks:
+        ok = score >= need
+        passed &= ok
+        print(f"  {'✓' if ok else '✗'} {name}: {score:.3%} agreement (need {need:.1%}{detail})")
+    return passed
+
+def compare_backends(dem_path, output_dir, flow_accum_threshold=500, max_influence_distance=1,
+                     backends=("whitebox_chain", "numpy"), tolerances=None, elevation_tolerance=0.05):
+    """
+    Run two backends on the same DEM and check their outputs agree
+
+    Returns True when every raster meets its tolerance.
+    """
+    tolerances = {**DEFAULT_TOLERANCES, **(tolerances or {})}
+    dirs = []
+    for backend in backends:
+        backend_dir = os.path.join(output_dir, backend)
+        print(f"\nRunning {backend} backend...")
+        delineate_basins(dem_path, backend_dir, flow_accum_threshold,
+                         max_influence_distance, backend=backend)
+        dirs.append(backend_dir)
+
+    scores = compare_rasters(*dirs, elevation_tolerance=elevation_tolerance)
+
+    print(f"\n{backends[0]} vs {backends[1]}:")
+    passed = True
+    for filename, (score, detail) in scores.items():
+        ok = score >= tolerances[filename]
+        passed &= ok
+        print(f"  {'✓' if ok else '✗'} {filename}: {score:.2%} agreement "
+              f"(need {tolerances[filename]:.0%}; {detail})")
+
+    # WhiteboxTools is available: check the fused stage on its accumulation too
+    for backend, backend_dir in zip(backends, dirs):
+        if backend.startswith("whitebox"):
+            passed &= compare_influence(os.path.join(backend_dir, "flow_accum.tif"),
+                                        os.path.join(output_dir, "influence"),
+                                        max_influence_distance)
+            break
+
+    return passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare hydrology backends on a DEM")
+    parser.add_argument("dem", help="Input DEM (flow_accum.tif with --influence)")
+    parser.add_argument("output_dir", help="Directory for each backend's outputs")
+    parser.add_argument("--threshold", type=int, default=500, help="Stream extraction threshold")
+    parser.add_argument("--influence-distance", type=float, default=1, help="Influence distance")
+    parser.add_argument("--elevation-tolerance", type=float, default=0.05,
+                        help="Filled DEM cells within this many units count as equal")
+    parser.add_argument("--backends", nargs=2, default=["whitebox_chain", "numpy"],
+                        help="The two backends to compare")
+    parser.add_argument("--influence", action="store_true",
+                        help="Only check fused_influence against the WhiteboxTools chain on a "
+                             "flow_accum.tif")
+    args = parser.parse_args()
+
+    if args.influence:
+        ok = compare_influence(args.dem, args.output_dir, args.influence_distance)
+    else:
+        ok = compare_backends(args.dem, args.output_dir, args.threshold, args.influence_distance,
+                              tuple(args.backends), elevation_tolerance=args.elevation_tolerance)
+    sys.exit(0 if ok else 1)
@@ -4,14 +4,32 @@ Download USGS DEM data for Maricopa County using USGS API
 Note: USGS API key can be obtained from https://apps.nationalmap.gov/apikeys/
 """
 
+import argparse
 import requests
+import hashlib
 import json
-import subprocess
+import re
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from osgeo import gdal
+
+from rasters import COG_OPTIONS
 
 # USGS API Key (optional - USGS TNM API doesn't require authentication for public data)
 USGS_API_KEY = os.environ.get("USGS_API_KEY", "")
 
+# Persistent tile cache, reused across runs (keyed by product ID)
+TILE_CACHE_DIR = os.environ.get("DEM_TILE_CACHE", "tile_cache")
+CHUNK_SIZE = 1024 * 1024
+
+# TNM products endpoint (point it at a local stand-in server for testing)
+TNM_API_URL = os.environ.get("TNM_API_URL", "https://tnmaccess.nationalmap.gov/api/v1/products")
+DEM_DATASET = "National Elevation Dataset (NED) 1/3 arc-second"
+# Search results are kept with the tile cache and reused for this long
+SEARCH_MAX_AGE = 7 * 24 * 3600
+
 # Maricopa County bounds
 MARICOPA_BOUNDS = {
     "min_lon": -113.33,
@@ -20,156 +38,435 @@ MARICOPA_BOUNDS = {
     "max_lat": 33.93
 }
 
-def search_usgs_dem():
+def search_usgs_dem(bounds=MARICOPA_BOUNDS, api_url=TNM_API_URL, cache_dir=TILE_CACHE_DIR,
+                    max_age=SEARCH_MAX_AGE, page_size=100):
     """
-    Search USGS National Map for DEM products covering Maricopa County
-    """
-    print("Searching USGS National Map for DEM products...")
-
-    # USGS TNM API endpoint
-    url = "https://tnmaccess.nationalmap.gov/api/v1/products"
+    Search USGS National Map for DEM products covering bounds
 
+    Pages through the results, so every matching product is returned. A
+    complete result is saved in the tile cache (search.json) and reused for
+    max_age seconds, so a warm re-run makes no network requests at all; when
+    the API fails, the last saved result is used however old it is.
+    """
     params = {
-        "bbox": f"{MARICOPA_BOUNDS['min_lon']},{MARICOPA_BOUNDS['min_lat']},{MARICOPA_BOUNDS['max_lon']},{MARICOPA_BOUNDS['max_lat']}",
-        "datasets": "National Elevation Dataset (NED) 1/3 arc-second",
+        "bbox": f"{bounds['min_lon']},{bounds['min_lat']},{bounds['max_lon']},{bounds['max_lat']}",
+        "datasets": DEM_DATASET,
         "prodFormats": "GeoTIFF",
         "outputFormat": "JSON",
-        "max": 100
+        "max": page_size
     }
+    query = {"url": api_url, "params": params}
+    search_path = os.path.join(cache_dir, "search.json")
+
+    saved = None
+    if os.path.exists(search_path):
+        with open(search_path) as f:
+            saved = json.load(f)
+        if saved.get("query") != query:
+            saved = None
+    if saved and time.time() - saved["time"] < max_age:
+        print(f"✓ Using the saved search ({len(saved['items'])} DEM products)")
+        return saved["items"]
 
+    print("Searching USGS National Map for DEM products...")
+    items = []
     try:
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-
-        if "items" in data and len(data["items"]) > 0:
-            print(f"✓ Found {len(data['items'])} DEM products")
-            return data["items"]
-        else:
-            print("⚠ No DEM products found")
-            return []
+        while True:
+            response = requests.get(api_url, params={**params, "offset": len(items)}, timeout=30)
+            response.raise_for_status()
+            page = response.json().get("items", [])
+            items.extend(page)
+            # Only a short page ends the results; "total" is not always sent
+            if len(page) < page_size:
+                break
 
     except Exception as e:
         print(f"✗ API search failed: {e}")
-        return []
+        if saved:
+            print(f"  Using the saved search ({len(saved['items'])} DEM products)")
+            return saved["items"]
+        return items
+
+    if items:
+        print(f"✓ Found {len(items)} DEM products")
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(search_path + ".tmp", "w") as f:
+            json.dump({"query": query, "time": time.time(), "items": items}, f)
+        os.replace(search_path + ".tmp", search_path)
+    else:
+        print("⚠ No DEM products found")
+    return items
+
+
+def product_id(product):
+    """
+    Stable identifier for a TNM product, safe to use as a file name
+    """
+    raw = str(product.get("sourceId") or product.get("title") or product.get("downloadURL"))
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", raw).strip("_")
 
 
-def download_dem_tiles(products):
+def is_tiff(path):
     """
-    Download DEM tiles from USGS
+    Check a file starts with a (Big)TIFF header
     """
-    print("\nDownloading DEM tiles...")
+    with open(path, "rb") as f:
+        header = f.read(4)
+    return header in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+")
 
-    downloaded_files = []
 
-    for i, product in enumerate(products[:10]):  # Limit to 10 tiles
-        title = product.get("title", f"tile_{i}")
-        download_url = product.get("downloadURL")
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-        if not download_url:
-            continue
 
-        # Clean filename
-        filename = title.replace(" ", "_").replace("/", "_") + ".tif"
+def remote_validator(session, url):
+    """
+    (ETag, Last-Modified) the server currently sends for url
+    """
+    response = session.head(url, allow_redirects=True, timeout=30)
+    response.raise_for_status()
+    return response.headers.get("ETag"), response.headers.get("Last-Modified")
 
-        print(f"\n  [{i+1}/{min(10, len(products))}] {title}")
-        print(f"  URL: {download_url[:80]}...")
 
+def cached_tile(product, cache_dir=TILE_CACHE_DIR, verify=False, session=None):
+    """
+    Path of a complete cached tile for this product, or None
+
+    A tile is reused when its manifest matches the product's download URL,
+    advertised size and TNM lastUpdated date. With verify=True the file's
+    SHA-256 is checked against the manifest, and (given a session) the ETag,
+    or failing that the Last-Modified date, the server sends now is compared
+    with the one recorded at download.
+    """
+    path = os.path.join(cache_dir, product_id(product) + ".tif")
+    manifest_path = path + ".json"
+    if not (os.path.exists(path) and os.path.exists(manifest_path)):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+
+    expected = product.get("sizeInBytes")
+    if os.path.getsize(path) != manifest["size"]:
+        return None
+    if expected and int(expected) != manifest["size"]:
+        return None
+    if manifest.get("url") != product.get("downloadURL"):
+        return None
+    if manifest.get("last_updated") and manifest["last_updated"] != product.get("lastUpdated"):
+        return None
+    if not verify:
+        return path
+
+    if file_sha256(path) != manifest["sha256"]:
+        print(f"  ⚠ {product_id(product)}: checksum mismatch, downloading again")
+        return None
+    if session is not None:
         try:
-            response = requests.get(download_url, stream=True, timeout=120)
-            response.raise_for_status()
+            etag, last_modified = remote_validator(session, manifest["url"])
+        except Exception as e:
+            print(f"  ⚠ {product_id(product)}: could not check the server copy ({e})")
+            return path
+        if etag and manifest.get("etag"):
+            changed = etag != manifest["etag"]
+        else:
+            changed = bool(last_modified) and last_modified != manifest.get("last_modified")
+        if changed:
+            print(f"  ⚠ {product_id(product)}: changed on the server, downloading again")
+            return None
+    return path
+
 
-            total_size = int(response.headers.get('content-length', 0))
+def parse_content_range(value):
+    """
+    (start, total) from a Content-Range header, None for either part that is missing
+
+    "bytes 100-199/1000" gives (100, 1000), "bytes 100-199/*" (100, None) and
+    "bytes */1000" or anything unparseable (None, ...).
+    """
+    match = re.fullmatch(r"\s*bytes\s+(?:(\d+)-\d+|\*)/(\d+|\*)\s*", value or "")
+    if not match:
+        return None, None
+    start, total = match.groups()
+    return (int(start) if start else None), (int(total) if total != "*" else None)
 
-            with open(filename, 'wb') as f:
-                if total_size == 0:
-                    f.write(response.content)
+
+def discard_partial(part):
+    """
+    Delete a partial download and its validator so the next request starts from scratch
+    """
+    for path in (part, part + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def download_tile(session, product, cache_dir=TILE_CACHE_DIR, retries=3):
+    """
+    Download one product into the tile cache, resuming partial downloads
+
+    A partial file (.part) is resumed with an HTTP Range request guarded by
+    If-Range, so a changed file on the server restarts from scratch. A
+    partial file the server will not resume (416, or a Content-Range that
+    does not continue it) or that ends up the wrong size is deleted, so the
+    next attempt downloads the whole file. The finished file must match the
+    advertised size and be a TIFF before it is moved into the cache.
+    """
+    url = product["downloadURL"]
+    path = os.path.join(cache_dir, product_id(product) + ".tif")
+    part = path + ".part"
+    part_meta = part + ".json"
+
+    for attempt in range(1, retries + 1):
+        try:
+            headers = {}
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            validator = None
+            if offset and os.path.exists(part_meta):
+                with open(part_meta) as f:
+                    validator = json.load(f).get("validator")
+            if offset and validator:
+                headers["Range"] = f"bytes={offset}-"
+                headers["If-Range"] = validator
+
+            with session.get(url, headers=headers, stream=True, timeout=120) as response:
+                if response.status_code == 416:
+                    # Already complete or larger than the server's file
+                    discard_partial(part)
+                    raise IOError(f"could not resume from byte {offset}, restarting")
+                response.raise_for_status()
+
+                if response.status_code == 206:
+                    mode = "ab"
+                    start, total = parse_content_range(response.headers.get("Content-Range"))
+                    if start != offset:
+                        discard_partial(part)
+                        raise IOError(f"Content-Range {response.headers.get('Content-Range')!r} "
+                                      f"does not resume at byte {offset}, restarting")
                 else:
-                    downloaded = 0
-                    for chunk in response.iter_content(chunk_size=8192):
+                    mode, offset = "wb", 0
+                    total = int(response.headers.get("content-length", 0)) or None
+
+                validator = response.headers.get("ETag") or response.headers.get("Last-Modified")
+                with open(part_meta, "w") as f:
+                    json.dump({"validator": validator}, f)
+
+                with open(part, mode) as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
                         f.write(chunk)
-                        downloaded += len(chunk)
-                        percent = (downloaded / total_size) * 100
-                        print(f"\r  Progress: {percent:.1f}%", end='', flush=True)
 
-            print(f"\r  ✓ Downloaded: {filename}")
-            downloaded_files.append(filename)
+            size = os.path.getsize(part)
+            expected = total or product.get("sizeInBytes")
+            if expected and size != int(expected):
+                discard_partial(part)
+                raise IOError(f"wrong size ({size} of {expected} bytes), restarting")
+            if not is_tiff(part):
+                discard_partial(part)
+                raise IOError("downloaded file is not a GeoTIFF")
+
+            os.replace(part, path)
+            os.remove(part_meta)
+            with open(path + ".json", "w") as f:
+                json.dump({
+                    "url": url,
+                    "size": size,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "last_updated": product.get("lastUpdated"),
+                    "sha256": file_sha256(path),
+                }, f)
+            return path
 
         except Exception as e:
-            print(f"\r  ✗ Failed: {e}")
-            continue
+            if attempt == retries:
+                raise
+            print(f"  ⚠ {product_id(product)}: {e}, retrying ({attempt}/{retries})")
+            time.sleep(2 ** attempt)
+
+
+def download_dem_tiles(products, cache_dir=TILE_CACHE_DIR, max_workers=4, verify=False):
+    """
+    Download DEM tiles from USGS into the local tile cache
+
+    Tiles already in the cache are reused without touching the network (with
+    verify=True their checksums and server validators are checked first); the
+    rest are downloaded with at most max_workers concurrent transfers over a
+    shared connection pool. Returns the cached tile paths.
+    """
+    print("\nDownloading DEM tiles...")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers,
+                                            pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    products = [p for p in products if p.get("downloadURL")]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        cached = list(executor.map(lambda p: cached_tile(p, cache_dir, verify, session), products))
+    tiles = {}
+    pending = []
+    for product, path in zip(products, cached):
+        if path:
+            tiles[product_id(product)] = path
+        else:
+            pending.append(product)
+
+    print(f"  {len(tiles)} cached{' and verified' if verify else ''}, {len(pending)} to download")
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(download_tile, session, product, cache_dir): product
+                for product in pending
+            }
+            for i, future in enumerate(as_completed(futures), 1):
+                product = futures[future]
+                title = product.get("title", product_id(product))
+                try:
+                    tiles[product_id(product)] = future.result()
+                    print(f"  [{i}/{len(pending)}] ✓ {title}")
+                except Exception as e:
+                    print(f"  [{i}/{len(pending)}] ✗ {title}: {e}")
 
-    return downloaded_files
+    session.close()
 
+    # Keep the search order so merges are reproducible
+    return [tiles[product_id(p)] for p in products if product_id(p) in tiles]
 
-def merge_and_clip_tiles(tile_files):
+
+def merge_and_clip_tiles(tile_files, output_file="dem.tif", bounds=MARICOPA_BOUNDS,
+                         resolution=None, resampling="bilinear"):
     """
-    Merge DEM tiles and clip to Maricopa County bounds
+    Merge DEM tiles and clip to a bounding box as a Cloud-Optimized GeoTIFF
+
+    The mosaic is built as an in-memory VRT and clipped straight into a tiled,
+    compressed COG with internal overviews, so no intermediate file is written.
+
+    Parameters:
+    tile_files (list): Paths of the DEM tiles to merge
+    output_file (str): Output COG path
+    bounds (dict): min_lon, max_lon, min_lat, max_lat to clip to
+    resolution (float or tuple): Target cell size in degrees (x, or (x, y));
+        defaults to the tiles' native resolution
+    resampling (str): GDAL resampling method used when resolution is given
     """
     if not tile_files:
         print("\n✗ No tiles to merge")
         return False
 
     print(f"\nMerging {len(tile_files)} tiles...")
+    vrt_path = "/vsimem/merged_dem.vrt"
 
     try:
         # Build VRT from all tiles
         print("  Creating virtual raster...")
-        subprocess.run(
-            ["gdalbuildvrt", "temp_maricopa.vrt"] + tile_files,
-            check=True
-        )
-
-        # Clip to Maricopa County bounds
-        print("  Clipping to Maricopa County bounds...")
-        subprocess.run([
-            "gdal_translate",
-            "-projwin",
-            str(MARICOPA_BOUNDS['min_lon']),
-            str(MARICOPA_BOUNDS['max_lat']),
-            str(MARICOPA_BOUNDS['max_lon']),
-            str(MARICOPA_BOUNDS['min_lat']),
-            "temp_maricopa.vrt",
-            "dem.tif"
-        ], check=True)
-
-        # Clean up
-        print("  Cleaning up...")
-        os.remove("temp_maricopa.vrt")
-        for tile in tile_files:
-            if os.path.exists(tile):
-                os.remove(tile)
-
-        print("\n✓ Success! DEM saved as dem.tif")
+        vrt = gdal.BuildVRT(vrt_path, tile_files)
+        if vrt is None:
+            raise RuntimeError("could not build a virtual raster from the tiles")
+
+        translate_options = {
+            "format": "COG",
+            "projWin": [bounds["min_lon"], bounds["max_lat"], bounds["max_lon"], bounds["min_lat"]],
+            "creationOptions": COG_OPTIONS,
+        }
+        if resolution is not None:
+            x_res, y_res = resolution if isinstance(resolution, (tuple, list)) else (resolution, resolution)
+            translate_options.update(xRes=x_res, yRes=y_res, resampleAlg=resampling)
+
+        # Clip to the requested bounds
+        print("  Clipping and writing Cloud-Optimized GeoTIFF...")
+        out_ds = gdal.Translate(output_file, vrt, **translate_options)
+        if out_ds is None:
+            raise RuntimeError(f"could not write {output_file}")
+        width, height = out_ds.RasterXSize, out_ds.RasterYSize
+        out_ds = None
+        vrt = None
+
+        size_mb = os.path.getsize(output_file) / 1024 ** 2
+        print(f"\n✓ Success! DEM saved as {output_file} ({width} x {height}, {size_mb:.1f} MB)")
         return True
 
     except Exception as e:
         print(f"\n✗ Error: {e}")
         return False
 
+    finally:
+        # The tiles stay in the tile cache for the next run
+        gdal.Unlink(vrt_path)
+
+
+def previous_path(output_file):
+    """
+    Where --keep-previous moves the last DEM (dem.tif -> dem.previous.tif)
+    """
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.previous{ext}"
 
-def main():
+def main(cache_dir=TILE_CACHE_DIR, max_workers=4, output_file="dem.tif", bounds=MARICOPA_BOUNDS,
+         resolution=None, keep_previous=False, api_url=TNM_API_URL, refresh_search=False,
+         verify=False):
     print("=" * 60)
     print("USGS DEM Downloader for Maricopa County")
     print("=" * 60)
 
-    products = search_usgs_dem()
+    products = search_usgs_dem(bounds, api_url, cache_dir, 0 if refresh_search else SEARCH_MAX_AGE)
 
     if not products:
         print("\n⚠ No products found")
         return
 
-    downloaded = download_dem_tiles(products)
+    downloaded = download_dem_tiles(products, cache_dir, max_workers, verify)
 
     if not downloaded:
         print("\n✗ No tiles downloaded")
         return
 
-    success = merge_and_clip_tiles(downloaded)
+    # Keep the last DEM for refresh.py, which only recomputes what changed
+    previous = None
+    if keep_previous and os.path.exists(output_file):
+        previous = previous_path(output_file)
+        os.replace(output_file, previous)
+
+    success = merge_and_clip_tiles(downloaded, output_file, bounds, resolution)
 
-    if success:
+    if success and previous:
+        print(f"\n✓ Ready to run: python refresh.py {previous} {output_file}")
+    elif success:
         print("\n✓ Ready to run: python tiles.py")
+    elif previous:
+        os.replace(previous, output_file)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Download and merge USGS DEM tiles")
+    parser.add_argument("--cache-dir", default=TILE_CACHE_DIR,
+                        help="Tile cache directory, reused across runs")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent downloads")
+    parser.add_argument("--output", default="dem.tif", help="Output Cloud-Optimized GeoTIFF")
+    parser.add_argument("--bounds", type=float, nargs=4,
+                        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+                        help="Clip bounds (default: Maricopa County)")
+    parser.add_argument("--resolution", type=float, default=None,
+                        help="Target cell size in degrees (default: native)")
+    parser.add_argument("--keep-previous", action="store_true",
+                        help="Move an existing output aside (dem.previous.tif) for refresh.py")
+    parser.add_argument("--api-url", default=TNM_API_URL,
+                        help="TNM products endpoint (default: the National Map, or $TNM_API_URL)")
+    parser.add_argument("--refresh-search", action="store_true",
+                        help="Search again even if the saved search is still fresh")
+    parser.add_argument("--verify", action="store_true",
+                        help="Check cached tiles' SHA-256 and the server's ETag/Last-Modified "
+                             "before reusing them")
+    args = parser.parse_args()
+
+    bounds = MARICOPA_BOUNDS
+    if args.bounds:
+        bounds = dict(zip(["min_lon", "min_lat", "max_lon", "max_lat"], args.bounds))
+
+    main(args.cache_dir, args.workers, args.output, bounds, args.resolution, args.keep_previous,
+         args.api_url, args.refresh_search, args.verify)
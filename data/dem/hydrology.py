@@ -0,0 +1,644 @@
+"""
+NumPy hydrology kernels for the water accumulation pipeline
+
+Most kernels take arrays padded with a one-cell ring around the cells being
+computed (the "core"). The ring is either halo data from neighbouring tiles
+or invalid padding at the edge of the DEM, which lets the same code run on a
+whole raster or on one tile of it.
+
+D8 pointers use the WhiteboxTools encoding:
+
+    64 | 128 |  1
+    32 |  0  |  2
+    16 |  8  |  4
+"""
+
+import heapq
+from array import array
+import numpy as np
+from scipy.ndimage import gaussian_filter
+from scipy.signal import fftconvolve
+
+# (pointer code, row offset, col offset) in WhiteboxTools scan order
+D8_DIRECTIONS = [
+    (1, -1, 1),
+    (2, 0, 1),
+    (4, 1, 1),
+    (8, 1, 0),
+    (16, 1, -1),
+    (32, 0, -1),
+    (64, -1, -1),
+    (128, -1, 0),
+]
+
+NODATA = -32768.0
+UNREACHED = np.iinfo(np.int32).max
+
+# Label given to cells that drain off the DEM (edges and nodata)
+OCEAN = 1
+
+# Gaussian kernel radius from which FFT convolution beats the separable filter
+FFT_MIN_RADIUS = 32
+
+def pad(array_, fill):
+    """
+    Pad an array with a one-cell ring of `fill`
+    """
+    return np.pad(array_, 1, mode="constant", constant_values=fill)
+
+def neighbour(padded, dy, dx):
+    """
+    View of the padded array shifted by (dy, dx), aligned with the core
+    """
+    rows, cols = padded.shape
+    return padded[1 + dy:rows - 1 + dy, 1 + dx:cols - 1 + dx]
+
+def outlet_mask(valid_p):
+    """
+    Core cells that drain off the data: valid cells with an invalid neighbour
+    """
+    core = neighbour(valid_p, 0, 0)
+    touches_invalid = np.zeros(core.shape, dtype=bool)
+    for _, dy, dx in D8_DIRECTIONS:
+        touches_invalid |= ~neighbour(valid_p, dy, dx)
+    return core & touches_invalid
+
+def fill_depressions(dem, valid, ocean, labelled=False):
+    """
+    Priority-Flood depression filling (Barnes et al. 2014)
+
+    The flood is seeded from every cell on the array border and every cell in
+    `ocean`. In labelled mode each seed starts its own watershed label (ocean
+    seeds share OCEAN), and the lowest spill elevation between every pair of
+    touching labels is recorded, as in Barnes' parallel Priority-Flood.
+
+    Parameters:
+    dem (ndarray): Elevations
+    valid (ndarray): Boolean mask of cells holding data
+    ocean (ndarray): Boolean mask of cells that drain off the DEM
+    labelled (bool): Also return watershed labels and spill edges
+
+    Returns:
+    filled, or (filled, labels, num_labels, spill_edges) in labelled mode, where
+    spill_edges maps (label_a, label_b) with label_a < label_b to an elevation
+    """
+    rows, cols = dem.shape
+    width = cols + 2
+
+    z = array("d", pad(np.where(valid, dem, 0).astype(np.float64), 0).ravel().tobytes())
+    closed = bytearray(pad(~valid, True).ravel().tobytes())
+    is_ocean = bytearray(pad(ocean & valid, False).ravel().tobytes())
+
+    border = np.zeros(dem.shape, dtype=bool)
+    border[0, :] = border[-1, :] = border[:, 0] = border[:, -1] = True
+    seed_rows, seed_cols = np.nonzero((border | ocean) & valid)
+    seeds = ((seed_rows + 1) * width + seed_cols + 1).tolist()
+
+    label = array("i", bytes(4 * len(z))) if labelled else None
+    next_label = OCEAN + 1
+    spill_edges = {}
+
+    heap = [(z[i], i) for i in seeds]
+    heapq.heapify(heap)
+    for i in seeds:
+        closed[i] = 1
+
+    pit = []
+    offsets = [dy * width + dx for _, dy, dx in D8_DIRECTIONS]
+
+    while heap or pit:
+        if pit:
+            c = pit.pop()
+        else:
+            c = heapq.heappop(heap)[1]
+        zc = z[c]
+
+        if labelled:
+            lc = label[c]
+            if lc == 0:
+                if is_ocean[c]:
+                    lc = OCEAN
+                else:
+                    lc = next_label
+                    next_label += 1
+                label[c] = lc
+
+        for off in offsets:
+            n = c + off
+            if closed[n]:
+                if labelled:
+                    ln = label[n]
+                    if ln and ln != lc:
+                        key = (lc, ln) if lc < ln else (ln, lc)
+                        spill = zc if zc > z[n] else z[n]
+                        if spill < spill_edges.get(key, np.inf):
+                            spill_edges[key] = spill
+                continue
+
+            closed[n] = 1
+            if labelled:
+                label[n] = lc
+            if z[n] <= zc:
+                z[n] = zc
+                pit.append(n)
+            else:
+                heapq.heappush(heap, (z[n], n))
+
+    filled = np.frombuffer(z, dtype=np.float64).reshape(rows + 2, cols + 2)[1:-1, 1:-1]
+    filled = np.where(valid, filled, dem).astype(dem.dtype)
+
+    if not labelled:
+        return filled
+
+    labels = np.frombuffer(label, dtype=np.int32).reshape(rows + 2, cols + 2)[1:-1, 1:-1].copy()
+    return filled, labels, next_label - 1, spill_edges
+
+def solve_spill_graph(num_nodes, edges_a, edges_b, weights, ocean=0):
+    """
+    Lowest spill elevation of every node in a watershed graph
+
+    Runs a minimax Priority-Flood over the graph from the ocean node, so each
+    node gets the lowest elevation water must rise to before it can drain.
+    """
+    adjacency = [[] for _ in range(num_nodes)]
+    for a, b, w in zip(edges_a.tolist(), edges_b.tolist(), weights.tolist()):
+        adjacency[a].append((b, w))
+        adjacency[b].append((a, w))
+
+    spill = np.full(num_nodes, np.inf)
+    spill[ocean] = -np.inf
+    done = bytearray(num_nodes)
+    heap = [(-np.inf, ocean)]
+
+    while heap:
+        level, node = heapq.heappop(heap)
+        if done[node]:
+            continue
+        done[node] = 1
+        for other, w in adjacency[node]:
+            candidate = level if level > w else w
+            if not done[other] and candidate < spill[other]:
+                spill[other] = candidate
+                heapq.heappush(heap, (candidate, other))
+
+    return spill
+
+def has_lower_neighbour(filled_p, valid_p):
+    """
+    Core cells with at least one strictly lower valid neighbour
+    """
+    core = neighbour(filled_p, 0, 0)
+    lower = np.zeros(core.shape, dtype=bool)
+    for _, dy, dx in D8_DIRECTIONS:
+        lower |= neighbour(valid_p, dy, dx) & (neighbour(filled_p, dy, dx) < core)
+    return lower & neighbour(valid_p, 0, 0)
+
+def flat_distances(filled_p, valid_p, dist_p):
+    """
+    Distance (in cells) from each flat cell to the edge of its flat
+
+    A flat cell has no lower neighbour and does not drain off the data. Its
+    distance is the number of equal-elevation steps to a cell that can drain,
+    so pointers on flats can always step towards an outlet. `dist_p` carries
+    known distances in the ring (from neighbouring tiles) and is ignored in
+    the core. Unreachable flat cells keep UNREACHED.
+    """
+    core = neighbour(filled_p, 0, 0)
+    valid = neighbour(valid_p, 0, 0)
+    flat = valid & ~has_lower_neighbour(filled_p, valid_p) & ~outlet_mask(valid_p)
+
+    dist = np.where(valid & ~flat, 0, UNREACHED).astype(np.int32)
+    if not flat.any():
+        return dist
+
+    ring = dist_p.astype(np.int32).copy()
+    ring[1:-1, 1:-1] = dist
+    ring[~valid_p] = UNREACHED
+
+    best = np.full(core.shape, UNREACHED, dtype=np.int64)
+    for _, dy, dx in D8_DIRECTIONS:
+        other = neighbour(ring, dy, dx).astype(np.int64)
+        same = neighbour(filled_p, dy, dx) == core
+        step = np.where(same & (other < UNREACHED), other + 1, UNREACHED)
+        np.minimum(best, step, out=best)
+    best[~flat] = UNREACHED
+
+    # Breadth-first wavefront over the flat cells only, one distance per step.
+    # Seeds start at their known distance and join the wave at that step.
+    width = filled_p.shape[1]
+    z = filled_p.ravel()
+    is_flat = pad(flat, False).ravel()
+    offsets = [dy * width + dx for _, dy, dx in D8_DIRECTIONS]
+
+    fr, fc = np.nonzero(flat & (best < UNREACHED))
+    seeds = (fr + 1) * width + fc + 1
+    seed_dist = best[fr, fc]
+    order = np.argsort(seed_dist, kind="stable")
+    seeds, seed_dist = seeds[order], seed_dist[order]
+
+    d = np.full(is_flat.size, UNREACHED, dtype=np.int32)
+    d[seeds] = seed_dist
+    frontier = seeds[:0]
+    level = int(seed_dist[0]) if seeds.size else 0
+    next_seed = 0
+    while frontier.size or next_seed < seeds.size:
+        if not frontier.size:
+            level = int(seed_dist[next_seed])
+        stop = np.searchsorted(seed_dist, level, side="right")
+        joining = seeds[next_seed:stop]
+        frontier = np.concatenate([frontier, joining[d[joining] == level]])
+        next_seed = stop
+
+        reached = []
+        for off in offsets:
+            n = frontier + off
+            step = is_flat[n] & (z[n] == z[frontier]) & (d[n] > level + 1)
+            n = n[step]
+            d[n] = level + 1
+            reached.append(n)
+        frontier = np.concatenate(reached)
+        level += 1
+
+    d = d.reshape(filled_p.shape)[1:-1, 1:-1]
+    return np.where(flat, np.minimum(d, UNREACHED), dist).astype(np.int32)
+
+def d8_pointer(filled_p, valid_p, dist_p, cell_size=(1.0, 1.0)):
+    """
+    D8 steepest-descent pointer for the core cells
+
+    Cells without a lower neighbour follow their flat distances downhill
+    towards the edge of the flat. Cells that cannot drain, and cells that
+    drain off the data with no lower neighbour, get 0.
+
+    Parameters:
+    filled_p (ndarray): Padded depression-filled elevations
+    valid_p (ndarray): Padded validity mask
+    dist_p (ndarray): Padded flat distances (see flat_distances)
+    cell_size (tuple): (x, y) cell size used to weight diagonal drops
+    """
+    dx_size, dy_size = abs(cell_size[0]), abs(cell_size[1])
+    core = neighbour(filled_p, 0, 0).astype(np.float64)
+    dist = neighbour(dist_p, 0, 0)
+    valid = neighbour(valid_p, 0, 0)
+
+    pointer = np.zeros(core.shape, dtype=np.uint8)
+    best_slope = np.zeros(core.shape, dtype=np.float64)
+    flat_choice = np.zeros(core.shape, dtype=np.uint8)
+
+    for code, dy, dx in D8_DIRECTIONS:
+        length = np.hypot(dx * dx_size, dy * dy_size)
+        other_valid = neighbour(valid_p, dy, dx)
+        other = neighbour(filled_p, dy, dx).astype(np.float64)
+
+        slope = np.where(other_valid, (core - other) / length, 0.0)
+        steeper = slope > best_slope
+        pointer[steeper] = code
+        best_slope[steeper] = slope[steeper]
+
+        towards_edge = (other_valid & (other == core) & (flat_choice == 0) &
+                        (dist > 0) & (dist < UNREACHED) &
+                        (neighbour(dist_p, dy, dx) == dist - 1))
+        flat_choice[towards_edge] = code
+
+    on_flat = (pointer == 0) & (dist > 0)
+    pointer[on_flat] = flat_choice[on_flat]
+    pointer[~valid] = 0
+    return pointer
+
+def downstream_index(pointer):
+    """
+    Flat index of each core cell's downstream cell
+
+    Returns (down, leaves) where down is -1 when the cell has no pointer or its
+    pointer leaves the array, and leaves flags the latter case.
+    """
+    rows, cols = pointer.shape
+    r, c = np.indices(pointer.shape)
+    down = np.full(pointer.shape, -1, dtype=np.int64)
+    leaves = np.zeros(pointer.shape, dtype=bool)
+
+    for code, dy, dx in D8_DIRECTIONS:
+        mask = pointer == code
+        nr, nc = r[mask] + dy, c[mask] + dx
+        inside = (nr >= 0) & (nr < rows) & (nc >= 0) & (nc < cols)
+        target = np.where(inside, nr * cols + nc, -1)
+        down[mask] = target
+        leaves[mask] = ~inside
+
+    return down.ravel(), leaves.ravel()
+
+def topological_levels(down):
+    """
+    Group cells into upstream-to-downstream wavefronts
+
+    Returns a list of index arrays; every cell appears after all the cells
+    that drain into it. This is the vectorized topological order used by
+    d8_accumulation and can be cached for repeated weighted accumulation.
+    """
+    n = down.size
+    has_down = down >= 0
+    indegree = np.bincount(down[has_down], minlength=n)
+    frontier = np.flatnonzero(indegree == 0)
+    levels = []
+
+    while frontier.size:
+        levels.append(frontier)
+        targets = down[frontier]
+        targets = targets[targets >= 0]
+        if not targets.size:
+            break
+        np.subtract.at(indegree, targets, 1)
+        targets = np.unique(targets)
+        frontier = targets[indegree[targets] == 0]
+
+    return levels
+
+def d8_accumulation(pointer, weights=None, levels=None):
+    """
+    D8 flow accumulation in cells (each cell counts itself), optionally weighted
+
+    Parameters:
+    pointer (ndarray): D8 pointer grid
+    weights (ndarray): Per-cell contribution (defaults to 1 everywhere). A
+        trailing axis accumulates several weightings in the same pass.
+    levels (list): Cached topological_levels for this pointer grid
+    """
+    down, _ = downstream_index(pointer)
+    if levels is None:
+        levels = topological_levels(down)
+
+    if weights is None:
+        accum = np.ones(down.size, dtype=np.float64)
+    else:
+        accum = np.asarray(weights, dtype=np.float64).reshape((down.size,) + np.shape(weights)[2:]).copy()
+
+    for level in levels:
+        targets = down[level]
+        mask = targets >= 0
+        np.add.at(accum, targets[mask], accum[level[mask]])
+
+    return accum.reshape(pointer.shape + accum.shape[1:])
+
+def accumulation_order(down, levels=None):
+    """
+    Topological layout of a D8 grid for repeated weighted accumulation
+
+    Cells are laid out level by level (perm), each level's draining cells
+    first and sorted by their downstream cell. Most cells are the only one in
+    their level draining into their downstream cell; they are added with one
+    gather and scatter per level, and cells sharing a downstream cell are
+    summed with reduceat first. Every index except perm is a position in the
+    layout, and the arrays are small enough to save and reuse for every
+    weighting of the same grid.
+    """
+    if levels is None:
+        levels = topological_levels(down)
+
+    perm, single_sources, single_targets = [], [], []
+    multi_sources, multi_targets, multi_starts = [], [], []
+    level_single, level_multi, level_multi_sources = [0], [0], [0]
+    position = 0
+    for level in levels:
+        target = down[level]
+        keep = target >= 0
+        cells, target = level[keep], target[keep]
+        order = np.argsort(target, kind="stable")
+        cells, target = cells[order], target[order]
+        first = np.ones(target.size, dtype=bool)
+        first[1:] = target[1:] != target[:-1]
+        group = np.cumsum(first) - 1
+        single = np.bincount(group)[group] == 1 if target.size else first
+
+        perm += [cells, level[~keep]]
+        sources = position + np.arange(cells.size)
+        single_sources.append(sources[single])
+        single_targets.append(target[single])
+        multi_sources.append(sources[~single])
+        multi_targets.append(target[~single][first[~single]])
+        multi_starts.append(np.flatnonzero(first[~single]))
+        level_single.append(level_single[-1] + single_sources[-1].size)
+        level_multi.append(level_multi[-1] + multi_targets[-1].size)
+        level_multi_sources.append(level_multi_sources[-1] + multi_sources[-1].size)
+        position += level.size
+
+    def join(parts):
+        return np.concatenate(parts).astype(np.int64) if parts else np.zeros(0, dtype=np.int64)
+
+    perm = join(perm)
+    rank = np.empty(down.size, dtype=np.int64)
+    rank[perm] = np.arange(perm.size)
+    return {
+        "perm": perm,
+        "single_sources": join(single_sources),
+        "single_targets": rank[join(single_targets)],
+        "multi_sources": join(multi_sources),
+        "multi_targets": rank[join(multi_targets)],
+        "multi_starts": join(multi_starts),
+        "level_single": np.array(level_single, dtype=np.int64),
+        "level_multi": np.array(level_multi, dtype=np.int64),
+        "level_multi_sources": np.array(level_multi_sources, dtype=np.int64),
+    }
+
+def accumulate_ordered(order, weights):
+    """
+    Weighted D8 accumulation over a cached accumulation_order
+
+    `weights` has one row per cell of the flattened grid and any number of
+    trailing columns (such as rainfall scenarios); every column is accumulated
+    in the same pass. The result keeps the dtype of weights.
+    """
+    perm = order["perm"]
+    accum = np.asarray(weights)[perm]
+    accumulate_permuted(order, accum)
+    result = np.empty_like(accum)
+    result[perm] = accum
+    return result
+
+def accumulate_permuted(order, accum):
+    """
+    accumulate_ordered in place, on weights already in order["perm"] order
+
+    accum[i] holds the weight of cell order["perm"][i] and becomes its
+    accumulation, so callers that fill and read the rows in that order need
+    no copy of the (cells x columns) array.
+    """
+    single_sources, single_targets = order["single_sources"], order["single_targets"]
+    multi_sources, multi_targets = order["multi_sources"], order["multi_targets"]
+    multi_starts = order["multi_starts"]
+    level_single, level_multi = order["level_single"], order["level_multi"]
+    level_multi_sources = order["level_multi_sources"]
+
+    # Targets are unique within a level and lie in later levels
+    for i in range(len(level_single) - 1):
+        a, b = level_single[i], level_single[i + 1]
+        if a < b:
+            accum[single_targets[a:b]] += accum[single_sources[a:b]]
+        a, b = level_multi[i], level_multi[i + 1]
+        if a < b:
+            sources = multi_sources[level_multi_sources[i]:level_multi_sources[i + 1]]
+            accum[multi_targets[a:b]] += np.add.reduceat(accum[sources], multi_starts[a:b], axis=0)
+    return accum
+
+def terminal_cells(down):
+    """
+    Last cell reached by following each cell's downstream path
+
+    Uses pointer doubling, so it takes O(log path length) vectorized passes.
+    """
+    jump = np.where(down >= 0, down, np.arange(down.size))
+    while True:
+        nxt = jump[jump]
+        if np.array_equal(nxt, jump):
+            return jump
+        jump = nxt
+
+def extract_streams(accum, valid, threshold):
+    """
+    Stream cells (1) where accumulation exceeds the threshold, 0 elsewhere
+    """
+    return ((accum > threshold) & valid).astype(np.uint8)
+
+def gaussian_radius(sigma):
+    """
+    WhiteboxTools' Gaussian filter sigma clamp and kernel radius
+
+    Returns (sigma, radius) where radius is the first offset whose weight
+    drops to 0.001.
+    """
+    sigma = min(max(sigma, 0.5), 20.0)
+    scale = 1.0 / (np.sqrt(2.0 * np.pi) * sigma)
+    for i in range(250):
+        if scale * np.exp(-(i * i) / (2.0 * sigma * sigma)) <= 0.001:
+            return sigma, i
+    return sigma, 250
+
+def gaussian_smooth(values, sigma, radius):
+    """
+    Gaussian filter truncated at `radius` cells, with zeros beyond the array
+
+    Small kernels use scipy's separable filter. From FFT_MIN_RADIUS the two
+    1-D passes are FFT convolutions instead, whose cost does not grow with
+    the radius.
+    """
+    if radius < FFT_MIN_RADIUS:
+        return gaussian_filter(values, sigma, mode="constant", truncate=radius / sigma)
+    offsets = np.arange(-radius, radius + 1)
+    kernel = np.exp(-(offsets * offsets) / (2.0 * sigma * sigma))
+    kernel /= kernel.sum()
+    smoothed = fftconvolve(values, kernel[:, None], mode="same")
+    return fftconvolve(smoothed, kernel[None, :], mode="same")
+
+def stream_influence(accum_p, valid_p, sigma, radius):
+    """
+    Natural log of the Gaussian-smoothed accumulation for the core cells
+
+    `accum_p` and `valid_p` are padded by `radius` cells. The smoothing is a
+    normalised convolution, so cells next to nodata or the DEM edge only
+    average over valid neighbours (as WhiteboxTools does).
+    """
+    core = (slice(radius, accum_p.shape[0] - radius),
+            slice(radius, accum_p.shape[1] - radius))
+    smoothed = gaussian_smooth(np.where(valid_p, accum_p, 0.0), sigma, radius)
+    weight = gaussian_smooth(valid_p.astype(np.float64), sigma, radius)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        influence = np.log(smoothed[core] / weight[core])
+    influence[~valid_p[core]] = np.nan
+    return influence
+
+def block_stats(values):
+    """
+    (count, mean, M2) of the finite values in a block
+    """
+    values = values[np.isfinite(values)].astype(np.float64)
+    if not values.size:
+        return 0, 0.0, 0.0
+    mean = values.mean()
+    return values.size, mean, float(((values - mean) ** 2).sum())
+
+def merge_stats(a, b):
+    """
+    Combine two (count, mean, M2) triples (Chan et al. parallel variance)
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    n = n_a + n_b
+    if n == 0:
+        return 0, 0.0, 0.0
+    delta = mean_b - mean_a
+    mean = mean_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta * delta * n_a * n_b / n
+    return n, mean, m2
+
+def contrast_stretch(values, mean, stdev, clip=2.0, num_tones=3):
+    """
+    Standard deviation contrast stretch into tones 0..num_tones-1
+    """
+    lower = mean - clip * stdev
+    upper = mean + clip * stdev
+    span = upper - lower if upper > lower else 1.0
+    tones = np.floor((values - lower) / span * num_tones)
+    return np.clip(tones, 0, num_tones - 1)
+
+def rescale(values, in_min, in_max, out_min=1.0, out_max=4.0):
+    """
+    Linearly rescale values from [in_min, in_max] to [out_min, out_max]
+    """
+    if in_max <= in_min:
+        return np.full(values.shape, out_min, dtype=np.float64)
+    return out_min + (values - in_min) / (in_max - in_min) * (out_max - out_min)
+
+def route_flow(dem, valid, cell_size):
+    """
+    Fill, D8 pointer and D8 accumulation for a whole raster in memory
+
+    Returns a dict of filled, pointer and accum arrays, with NaN (or 0 for
+    the pointer) where the DEM has no data.
+    """
+    valid_p = pad(valid, False)
+    filled = fill_depressions(dem, valid, outlet_mask(valid_p))
+    filled = np.where(valid, filled, np.nan)
+
+    filled_p = pad(filled, np.nan)
+    dist_p = np.full(valid_p.shape, UNREACHED, dtype=np.int32)
+    dist_p[1:-1, 1:-1] = flat_distances(filled_p, valid_p, dist_p)
+    pointer = d8_pointer(filled_p, valid_p, dist_p, cell_size)
+
+    accum = d8_accumulation(pointer, valid.astype(np.float64))
+    accum[~valid] = np.nan
+
+    return {"filled": filled, "pointer": pointer, "accum": accum}
+
+def influence_from_accum(accum, valid, sigma):
+    """
+    Gaussian, ln, standard deviation stretch and 1-4 rescale of an accumulation grid
+    """
+    sigma, radius = gaussian_radius(sigma)
+    influence = stream_influence(
+        np.pad(accum, radius, constant_values=np.nan),
+        np.pad(valid, radius, constant_values=False),
+        sigma,
+        radius
+    )
+
+    count, mean, m2 = block_stats(influence)
+    stdev = np.sqrt(m2 / count) if count else 0.0
+    tones = contrast_stretch(influence, mean, stdev)
+    return rescale(tones, np.nanmin(tones), np.nanmax(tones))
+
+def delineate(dem, valid, cell_size, flow_accum_threshold, max_influence_distance):
+    """
+    Run the whole basin delineation chain in memory
+
+    Mirrors the WhiteboxTools sequence in tiles.py (fill, D8 pointer, D8
+    accumulation, streams, Gaussian, ln, contrast stretch, rescale to 1-4)
+    without writing any intermediate to disk.
+
+    Returns a dict of filled, pointer, accum, streams and influence arrays,
+    with NaN (or 0 for integer grids) where the DEM has no data.
+    """
+    results = route_flow(dem, valid, cell_size)
+    results["streams"] = extract_streams(results["accum"], valid, flow_accum_threshold)
+    results["influence"] = influence_from_accum(results["accum"], valid,
+                                                max_influence_distance / 4)
+    return results
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Stage-level run reports for the tiles.py pipeline
+
+While a RunReport is active, every stage run through cache.run_stage (and any
+block wrapped in stage()) is recorded with:
+- wall time, and CPU time including waited-for subprocesses (WhiteboxTools,
+  pool workers)
+- peak RSS of this process during the stage (on Linux the high-water mark is
+  reset at each stage start; elsewhere it is the process peak so far), and
+  the largest peak of any finished subprocess
+- size of every input and output file, with the dimensions and type of the
+  rasters among them
+- whether the stage was served from the stage cache
+
+Stages nest (the numpy backend's steps run inside its delineate stage). Each
+record carries its pid and wall-clock start and end, so a py-spy recording of
+the same run (py-spy record --pid ...) can be cut by stage. With profile_dir
+set, each outermost stage also runs under cProfile and its stats are dumped to
+<profile_dir>/<index>_<stage>.prof, readable by pstats, snakeviz or flameprof.
+
+Usage:
+    python tiles.py --profile run.json [--profile-stages profiles/]
+    python profiling.py before.json after.json
+"""
+
+import argparse
+import cProfile
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+RASTER_EXTENSIONS = (".tif", ".tiff", ".vrt")
+
+# Report that stage() records into, set while a RunReport is entered
+_active = None
+
+def reset_peak_rss():
+    """
+    Reset this process's peak RSS where the kernel allows it (Linux)
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """
+    Peak RSS of this process in MB since the last reset
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KB elsewhere
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def children_peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+def cpu_seconds():
+    """
+    User plus system time of this process and its waited-for children
+    """
+    return sum(usage.ru_utime + usage.ru_stime
+               for usage in (resource.getrusage(resource.RUSAGE_SELF),
+                             resource.getrusage(resource.RUSAGE_CHILDREN)))
+
+def file_info(paths):
+    """
+    Size of each file, plus width, height, band count and type for rasters
+    """
+    info = []
+    for path in paths:
+        entry = {"path": path, "bytes": os.path.getsize(path) if os.path.exists(path) else None}
+        if entry["bytes"] is not None and path.lower().endswith(RASTER_EXTENSIONS):
+            from osgeo import gdal
+            ds = gdal.Open(path)
+            if ds is not None:
+                entry.update({
+                    "width": ds.RasterXSize,
+                    "height": ds.RasterYSize,
+                    "bands": ds.RasterCount,
+                    "type": gdal.GetDataTypeName(ds.GetRasterBand(1).DataType),
+                })
+            ds = None
+        info.append(entry)
+    return info
+
+class RunReport:
+    """
+    Record every pipeline stage run while entered, and write the report as JSON on exit
+
+    Parameters:
+    path (str): JSON report to write (None keeps it in memory only)
+    profile_dir (str): Directory for per-stage cProfile dumps (None disables them)
+    metadata (dict): Extra run details to store, such as the command line
+    """
+
+    def __init__(self, path=None, profile_dir=None, metadata=None):
+        self.path = path
+        self.profile_dir = profile_dir
+        self.metadata = metadata or {}
+        self.stages = []
+        self._stack = []
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def __enter__(self):
+        global _active
+        _active = self
+        self.started = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = cpu_seconds()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _active
+        _active = None
+        self.wall_s = time.perf_counter() - self._wall
+        self.cpu_s = cpu_seconds() - self._cpu
+        if self.path:
+            self.write(self.path)
+        return False
+
+    @contextmanager
+    def stage(self, name, inputs=(), outputs=()):
+        """
+        Record one stage; yields its record so callers can add fields
+        """
+        parent = self._stack[-1] if self._stack else None
+        if parent is not None:
+            # The reset below would lose the parent's peak so far
+            parent["_peak"] = max(parent["_peak"], peak_rss_mb())
+
+        record = {"name": name, "parent": parent["name"] if parent else None,
+                  "pid": os.getpid(), "inputs": file_info(inputs), "_peak": 0.0}
+        self.stages.append(record)
+        self._stack.append(record)
+
+        profiler = None
+        if self.profile_dir and parent is None:
+            profiler = cProfile.Profile()
+
+        reset_peak_rss()
+        start_cpu = cpu_seconds()
+        record["started"] = time.time()
+        start_wall = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield record
+        finally:
+            if profiler:
+                profiler.disable()
+                index = len([r for r in self.stages if r["parent"] is None])
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{index:02d}_{name}.prof"))
+            record["wall_s"] = round(time.perf_counter() - start_wall, 3)
+            record["cpu_s"] = round(cpu_seconds() - start_cpu, 3)
+            record["ended"] = time.time()
+            record["peak_rss_mb"] = round(max(peak_rss_mb(), record.pop("_peak")), 1)
+            record["children_peak_rss_mb"] = round(children_peak_rss_mb(), 1)
+            record["outputs"] = file_info(outputs)
+            self._stack.pop()
+            if parent is not None:
+                parent["_peak"] = max(parent["_peak"], record["peak_rss_mb"])
+
+    def to_dict(self):
+        return {
+            "metadata": self.metadata,
+            "started": self.started,
+            "wall_s": round(getattr(self, "wall_s", time.perf_counter() - self._wall), 3),
+            "cpu_s": round(getattr(self, "cpu_s", cpu_seconds() - self._cpu), 3),
+            "peak_rss_mb": round(max([r.get("peak_rss_mb", 0.0) for r in self.stages]
+                                     + [peak_rss_mb()]), 1),
+            "stages": self.stages,
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+@contextmanager
+def stage(name, inputs=(), outputs=()):
+    """
+    Record a stage in the active run report; a no-op when there is none
+    """
+    if _active is None:
+        yield {}
+        return
+    with _active.stage(name, inputs, outputs) as record:
+        yield record
+
+def _stage_keys(report):
+    """
+    (name, occurrence) for every stage, so repeated stage names still line up
+    """
+    seen = {}
+    keyed = {}
+    for record in report["stages"]:
+        n = seen.get(record["name"], 0)
+        seen[record["name"]] = n + 1
+        keyed[(record["name"], n)] = record
+    return keyed
+
+def _output_bytes(record):
+    return sum(entry["bytes"] or 0 for entry in record.get("outputs", []))
+
+def compare_reports(before, after):
+    """
+    Per-stage changes between two run reports
+
+    Returns rows of (stage, wall before, wall after, CPU before, CPU after,
+    peak RSS before, peak RSS after, output bytes before, output bytes after),
+    with None for a stage missing from one report, and prints them as a table
+    with the change in wall time.
+    """
+    a = _stage_keys(before)
+    b = _stage_keys(after)
+    keys = list(a) + [key for key in b if key not in a]
+
+    rows = []
+    print(f"{'stage':<40} {'wall s':^18} {'change':>8} {'cpu s':^18} {'peak MB':^16} {'out MB':^16}")
+    for key in keys:
+        old, new = a.get(key), b.get(key)
+        values = []
+        for record in (old, new):
+            values.append(None if record is None else (
+                record["wall_s"], record["cpu_s"], record["peak_rss_mb"], _output_bytes(record)))
+        rows.append((key[0],) + tuple(
+            None if v is None else v[i] for i in range(4) for v in values))
+
+        label = key[0] if key[1] == 0 else f"{key[0]} #{key[1] + 1}"
+        record = new or old
+        if record.get("parent"):
+            label = "  " + label
+        if old is None or new is None:
+            print(f"{label:<40} {'only in ' + ('after' if old is None else 'before'):^18}")
+            continue
+        change = (new["wall_s"] - old["wall_s"]) / old["wall_s"] * 100 if old["wall_s"] else 0.0
+        print(f"{label:<40} {old['wall_s']:>7.2f} -> {new['wall_s']:<7.2f} {change:>+7.0f}% "
+              f"{old['cpu_s']:>7.2f} -> {new['cpu_s']:<7.2f} "
+              f"{old['peak_rss_mb']:>6.0f} -> {new['peak_rss_mb']:<6.0f} "
+              f"{_output_bytes(old) / 1024 ** 2:>6.1f} -> {_output_bytes(new) / 1024 ** 2:<6.1f}")
+
+    total_change = ((after["wall_s"] - before["wall_s"]) / before["wall_s"] * 100
+                    if before["wall_s"] else 0.0)
+    print(f"{'total':<40} {before['wall_s']:>7.2f} -> {after['wall_s']:<7.2f} {total_change:>+7.0f}% "
+          f"{before['cpu_s']:>7.2f} -> {after['cpu_s']:<7.2f} "
+          f"{before['peak_rss_mb']:>6.0f} -> {after['peak_rss_mb']:<6.0f}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two tiles.py run reports stage by stage")
+    parser.add_argument("before", help="Run report JSON of the earlier run")
+    parser.add_argument("after", help="Run report JSON of the later run")
+    args = parser.parse_args()
+
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+    compare_reports(before, after)
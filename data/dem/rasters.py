@@ -0,0 +1,118 @@
+"""
+Small GDAL helpers shared by the water accumulation pipeline
+"""
+
+from osgeo import gdal
+import numpy as np
+
+# Creation options for rasters written by this pipeline: internally tiled and
+# compressed so downstream windowed readers only touch the blocks they need
+GTIFF_OPTIONS = [
+    "TILED=YES",
+    "BLOCKXSIZE=512",
+    "BLOCKYSIZE=512",
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=2",
+    "BIGTIFF=IF_SAFER",
+]
+
+# Cloud-Optimized GeoTIFF options for source rasters such as the merged DEM:
+# the same block layout plus internal overviews for cheap coarse reads
+COG_OPTIONS = [
+    "BLOCKSIZE=512",
+    "COMPRESS=DEFLATE",
+    "PREDICTOR=YES",
+    "OVERVIEWS=AUTO",
+    "BIGTIFF=IF_SAFER",
+    "NUM_THREADS=ALL_CPUS",
+]
+
+def iter_windows(band, window_size=None):
+    """
+    Yield (xoff, yoff, xsize, ysize) windows covering a raster band
+
+    Parameters:
+    band (gdal.Band): Band to iterate over
+    window_size (int or tuple): Window size in cells, either a single value or
+        (xsize, ysize). Defaults to the band's native block size.
+    """
+    if window_size is None:
+        win_x, win_y = band.GetBlockSize()
+    elif isinstance(window_size, int):
+        win_x = win_y = window_size
+    else:
+        win_x, win_y = window_size
+
+    for yoff in range(0, band.YSize, win_y):
+        ysize = min(win_y, band.YSize - yoff)
+        for xoff in range(0, band.XSize, win_x):
+            xsize = min(win_x, band.XSize - xoff)
+            yield xoff, yoff, xsize, ysize
+
+def create_like(template_ds, output_file, data_type, nodata=None, factor=1, bands=1):
+    """
+    Create a tiled GeoTIFF with the same grid as template_ds
+
+    With factor > 1 the grid is coarsened: each cell covers factor x factor
+    template cells (partial cells at the right and bottom edges included).
+    """
+    driver = gdal.GetDriverByName('GTiff')
+    dst_ds = driver.Create(output_file,
+                          -(-template_ds.RasterXSize // factor),
+                          -(-template_ds.RasterYSize // factor),
+                          bands,
+                          data_type,
+                          options=GTIFF_OPTIONS)
+
+    gt = template_ds.GetGeoTransform()
+    dst_ds.SetProjection(template_ds.GetProjection())
+    dst_ds.SetGeoTransform((gt[0], gt[1] * factor, gt[2] * factor,
+                            gt[3], gt[4] * factor, gt[5] * factor))
+
+    if nodata is not None:
+        for i in range(bands):
+            dst_ds.GetRasterBand(i + 1).SetNoDataValue(nodata)
+
+    return dst_ds
+
+def write_array_raster(template_ds, output_file, array, data_type, nodata=None, window_size=512):
+    """
+    Write a full-size array (or memmap) to a GeoTIFF window by window
+
+    NaNs in floating point arrays are written as the nodata value.
+    """
+    dst_ds = create_like(template_ds, output_file, data_type, nodata)
+    dst_band = dst_ds.GetRasterBand(1)
+
+    for xoff, yoff, xsize, ysize in iter_windows(dst_band, window_size):
+        block = np.asarray(array[yoff:yoff + ysize, xoff:xoff + xsize])
+        if nodata is not None and np.issubdtype(block.dtype, np.floating):
+            block = np.where(np.isnan(block), nodata, block)
+        dst_band.WriteArray(np.ascontiguousarray(block), xoff, yoff)
+
+    dst_ds = None
+    return output_file
+
+def patch_array_raster(output_file, array, nodata=None, window_size=512):
+    """
+    Write a full-size array into an existing raster, only where a window differs
+
+    NaNs in floating point arrays are written as the nodata value. Returns
+    the number of windows rewritten.
+    """
+    ds = gdal.Open(output_file, gdal.GA_Update)
+    band = ds.GetRasterBand(1)
+
+    written = 0
+    for xoff, yoff, xsize, ysize in iter_windows(band, window_size):
+        current = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        block = np.asarray(array[yoff:yoff + ysize, xoff:xoff + xsize])
+        if nodata is not None and np.issubdtype(block.dtype, np.floating):
+            block = np.where(np.isnan(block), nodata, block)
+        block = block.astype(current.dtype)
+        if not np.array_equal(block, current):
+            band.WriteArray(np.ascontiguousarray(block), xoff, yoff)
+            written += 1
+
+    ds = None
+    return written
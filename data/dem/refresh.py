@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+"""
+Incremental refresh of the tiles.py outputs after a DEM update
+
+When USGS republishes a tile only the basins around it change, yet tiles.py
+recomputes the whole county. Here the new DEM is diffed against the previous
+one and the in-process hydrology (hydrology.py) is rerun only as far as the
+change can reach:
+
+- Depression filling is rerun over the drainage basins (of the previous D8
+  pointer) holding or touching a changed cell. Cells outside them keep their
+  filled elevations and seed the flood at the region's edge. A neighbouring
+  basin joins the region when the new surface would let it spill lower,
+  until no cell around the region could.
+- Flat distances and pointers are recomputed around the cells whose filled
+  elevation changed, together with every flat they touch.
+- Accumulation is recomputed over the basins (of the new pointer) holding a
+  changed pointer or a changed pointer's previous target.
+- The influence stretch uses statistics of the whole raster, so influence,
+  streams and classes are recomputed from the patched accumulation in one
+  cheap whole-raster pass.
+
+Only the windows of each raster that differ are rewritten, the zoom pyramid
+is rebuilt from the patched accumulation, and with --pmtiles the tile archive
+is updated with build_pmtiles.py's incremental mode, so only tiles over
+changed blocks are rendered again.
+
+The previous outputs must come from the in-process engine (tiles.py
+--backend numpy, or --tiles), and the refreshed rasters are then identical
+to a full rebuild with it, as long as no cell drains more than 2**24 cells
+(the largest count flow_accum.tif's float32 holds exactly).
+
+Usage:
+    python download_usgs_dem.py --keep-previous
+    python refresh.py dem.previous.tif dem.tif tiles/ --pmtiles
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from osgeo import gdal
+from scipy import ndimage
+
+import hydrology as hy
+import tiles
+from cache import StageCache, code_version, run_stage
+from rasters import patch_array_raster
+from tiled import read_window
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TILE_BUILDER_DIR = os.path.join(HERE, "..", "water-tile-generation")
+
+# 8-connected neighbourhood for dilation and flat labelling
+NEIGHBOURHOOD = np.ones((3, 3), dtype=bool)
+
+def read_dem(path):
+    """
+    (elevations as float32, valid mask, geotransform) of a DEM, as tiles.py reads it
+    """
+    ds = gdal.Open(path)
+    band = ds.GetRasterBand(1)
+    dem = band.ReadAsArray().astype(np.float32)
+    nodata = band.GetNoDataValue()
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+    geotransform = ds.GetGeoTransform()
+    ds = None
+    return dem, valid, geotransform
+
+def read_outputs(output_dir):
+    """
+    Filled elevations, D8 pointer and accumulation from a tiles.py output directory
+
+    Returns a dict shaped like hy.route_flow's: NaN (or 0 for the pointer)
+    where there is no data.
+    """
+    filled = gdal.Open(os.path.join(output_dir, "filled_dem.tif")).ReadAsArray()
+    pointer = gdal.Open(os.path.join(output_dir, "flow_dir.tif")).ReadAsArray()
+    accum = gdal.Open(os.path.join(output_dir, "flow_accum.tif")).ReadAsArray()
+    valid = pointer >= 0
+    return {
+        "filled": np.where(valid, filled, np.nan).astype(np.float64),
+        "pointer": np.where(valid, pointer, 0).astype(np.uint8),
+        "accum": np.where(valid, accum, np.nan).astype(np.float64),
+        "valid": valid,
+    }
+
+def bounding_tile(mask, margin):
+    """
+    (xoff, yoff, xsize, ysize) of the cells of mask plus `margin` cells, clipped to the grid
+    """
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    y0, y1 = max(rows[0] - margin, 0), min(rows[-1] + 1 + margin, mask.shape[0])
+    x0, x1 = max(cols[0] - margin, 0), min(cols[-1] + 1 + margin, mask.shape[1])
+    return int(x0), int(y0), int(x1 - x0), int(y1 - y0)
+
+def _window(tile):
+    xoff, yoff, xsize, ysize = tile
+    return slice(yoff, yoff + ysize), slice(xoff, xoff + xsize)
+
+def _padded(array_, tile, fill):
+    """
+    A tile of a full-size array with its one-cell ring (fill beyond the grid)
+    """
+    return read_window(lambda x, y, w, h: array_[y:y + h, x:x + w],
+                       array_.shape, tile, 1, fill, array_.dtype)
+
+def _select(labels, chosen):
+    """
+    Cells whose label is one of `chosen` (labels are flat cell indices)
+    """
+    flags = np.zeros(labels.size, dtype=bool)
+    flags[chosen] = True
+    return flags[labels]
+
+def refill(dem, valid, previous, basins, changed):
+    """
+    Filled elevations of the new DEM, recomputed only over the basins the change reaches
+
+    Parameters:
+    dem, valid (ndarray): New DEM and its validity
+    previous (dict): Previous outputs (read_outputs)
+    basins (ndarray): Terminal cell of every cell under the previous pointer
+    changed (ndarray): Cells whose elevation or validity changed
+
+    Returns (filled, region) where region marks the cells that were flooded again.
+    """
+    old_filled = previous["filled"]
+    touched = ndimage.binary_dilation(changed, NEIGHBOURHOOD)
+    region = _select(basins, basins[touched]) | changed
+
+    while True:
+        tile = bounding_tile(region, 1)
+        window = _window(tile)
+        inside = region[window]
+
+        # Cells outside the region are held at their filled elevation, so the
+        # flood cannot lower them and they seed it where it reaches them
+        dem_w = np.where(inside, dem[window], old_filled[window])
+        valid_p = _padded(valid, tile, False)
+        valid_w = valid_p[1:-1, 1:-1]
+        filled_w = hy.fill_depressions(dem_w, valid_w, hy.outlet_mask(valid_p))
+        filled_w = np.where(valid_w, filled_w, np.nan)
+
+        # Lowest level each cell around the region could now spill into it at
+        # (-inf next to cells that became nodata, which now drain off the data)
+        level_p = hy.pad(np.where(inside, np.where(valid_w, filled_w, -np.inf), np.inf), np.inf)
+        spill = np.full(inside.shape, np.inf)
+        for _, dy, dx in hy.D8_DIRECTIONS:
+            np.minimum(spill, hy.neighbour(level_p, dy, dx), out=spill)
+
+        around = valid_w & ~inside & (spill < np.inf)
+        lower = around & (np.maximum(dem[window], spill) < old_filled[window])
+        if not lower.any():
+            break
+        region |= _select(basins, basins[window][lower])
+
+    filled = old_filled.copy()
+    filled[window][inside] = filled_w[inside]
+    return filled, region
+
+def _flats(filled_p, valid_p):
+    """
+    Core cells of a padded tile that lie on a flat (see hy.flat_distances)
+    """
+    valid = valid_p[1:-1, 1:-1]
+    return valid & ~hy.has_lower_neighbour(filled_p, valid_p) & ~hy.outlet_mask(valid_p)
+
+def repoint(filled, valid, previous, cell_size):
+    """
+    D8 pointer of the new filled surface, recomputed only where it can differ
+
+    A pointer depends on the filled elevations around its cell and, on a
+    flat, on the flat's distances to its edge, so the pointers of every cell
+    next to a changed elevation and of every flat touching one are
+    recomputed. The tile grows until those flats lie inside it.
+
+    Returns (pointer, recomputed) where recomputed marks the cells whose pointer was recomputed.
+    """
+    old_filled = previous["filled"]
+    changed = ((filled != old_filled) & ~(np.isnan(filled) & np.isnan(old_filled)) |
+               (valid != previous["valid"]))
+    pointer = previous["pointer"].copy()
+    recomputed = np.zeros(changed.shape, dtype=bool)
+    if not changed.any():
+        return pointer, recomputed
+
+    near = ndimage.binary_dilation(changed, NEIGHBOURHOOD)
+    rows, cols = changed.shape
+    margin = 2
+    while True:
+        tile = bounding_tile(near, margin)
+        xoff, yoff, xsize, ysize = tile
+        window = _window(tile)
+        filled_p = _padded(filled, tile, np.nan)
+        valid_p = _padded(valid, tile, False)
+
+        flat = _flats(filled_p, valid_p)
+        labels, _ = ndimage.label(flat, structure=NEIGHBOURHOOD)
+        touching = ndimage.binary_dilation(near[window], NEIGHBOURHOOD)
+        affected = np.isin(labels, np.unique(labels[touching & flat]))
+
+        # Flats cut by the tile edge (rather than the grid's) need a larger tile
+        cut = ((affected[0].any() and yoff > 0) or
+               (affected[-1].any() and yoff + ysize < rows) or
+               (affected[:, 0].any() and xoff > 0) or
+               (affected[:, -1].any() and xoff + xsize < cols))
+        if not cut:
+            break
+        margin *= 2
+
+    dist_p = np.full(valid_p.shape, hy.UNREACHED, dtype=np.int32)
+    dist_p[1:-1, 1:-1] = hy.flat_distances(filled_p, valid_p, dist_p)
+    pointer_w = hy.d8_pointer(filled_p, valid_p, dist_p, cell_size)
+
+    redo = ndimage.binary_dilation(near[window] | affected, NEIGHBOURHOOD)
+    pointer[window][redo] = pointer_w[redo]
+    recomputed[window] = redo
+    return pointer, recomputed
+
+def reaccumulate(pointer, valid, previous, down_old):
+    """
+    D8 accumulation of the new pointer, recomputed over the basins whose flow changed
+
+    A cell's accumulation changes only if it lies downstream of a changed
+    pointer, under either the new pointer or the previous one, and every such
+    cell is in the new basin of a changed cell or of a changed cell's
+    previous target. Basins drain to their own outlet, so each one
+    accumulates on its own.
+
+    Returns (accum, region) where region marks the cells that were accumulated again.
+    """
+    moved = np.flatnonzero((pointer != previous["pointer"]) | (valid != previous["valid"]))
+    accum = previous["accum"].copy()
+    region = np.zeros(pointer.shape, dtype=bool)
+    if not moved.size:
+        return accum, region
+
+    targets = down_old[moved]
+    seeds = np.concatenate([moved, targets[targets >= 0]])
+    down, _ = hy.downstream_index(pointer)
+    basins = hy.terminal_cells(down)
+    region = _select(basins, basins[seeds]).reshape(pointer.shape)
+
+    window = _window(bounding_tile(region, 0))
+    inside = region[window]
+    accum_w = hy.d8_accumulation(np.where(inside, pointer[window], 0),
+                                 (inside & valid[window]).astype(np.float64))
+    accum[window][inside] = np.where(valid[window], accum_w, np.nan)[inside]
+    return accum, region
+
+def refresh_outputs(previous_dem, dem_path, output_dir, flow_accum_threshold,
+                    max_influence_distance):
+    """
+    Patch the tiles.py delineation outputs in output_dir for a new DEM
+
+    Parameters:
+    previous_dem (str): DEM the outputs in output_dir were computed from
+    dem_path (str): Updated DEM on the same grid
+    output_dir (str): tiles.py output directory
+    flow_accum_threshold (int): Threshold for stream extraction
+    max_influence_distance (float): Distance for influence calculation
+
+    Returns a dict of cell counts per stage and windows rewritten per raster.
+    """
+    old_dem, old_valid, old_geotransform = read_dem(previous_dem)
+    dem, valid, geotransform = read_dem(dem_path)
+    if dem.shape != old_dem.shape or geotransform != old_geotransform:
+        raise ValueError(f"{dem_path} is not on the grid of {previous_dem}; run tiles.py instead")
+
+    previous = read_outputs(output_dir)
+    if not np.array_equal(previous["valid"], old_valid):
+        raise ValueError(f"The rasters in {output_dir} were not computed from {previous_dem}")
+
+    changed = (valid != old_valid) | (valid & (dem != old_dem))
+    report = {"changed": int(changed.sum()), "filled": 0, "pointer": 0, "accumulated": 0}
+    print(f"{report['changed']} of {changed.size} cells changed")
+    if not report["changed"]:
+        return report
+
+    down_old, _ = hy.downstream_index(previous["pointer"])
+    basins = hy.terminal_cells(down_old)
+
+    print("Filling depressions in the affected basins...")
+    start = time.time()
+    filled, region = refill(dem, valid, previous, basins.reshape(dem.shape), changed)
+    report["filled"] = int(region.sum())
+    print(f"  {report['filled']} cells ({time.time() - start:.1f}s)")
+
+    print("Calculating flow direction around changed elevations...")
+    start = time.time()
+    pointer, region = repoint(filled, valid, previous, (geotransform[1], geotransform[5]))
+    report["pointer"] = int(region.sum())
+    print(f"  {report['pointer']} cells ({time.time() - start:.1f}s)")
+
+    print("Calculating flow accumulation in the basins whose flow changed...")
+    start = time.time()
+    accum, region = reaccumulate(pointer, valid, previous, down_old)
+    report["accumulated"] = int(region.sum())
+    print(f"  {report['accumulated']} cells ({time.time() - start:.1f}s)")
+
+    print("Extracting streams and calculating stream influence...")
+    streams = hy.extract_streams(accum, valid, flow_accum_threshold)
+    influence = hy.influence_from_accum(accum, valid, max_influence_distance / 4)
+
+    outputs = [
+        ("filled_dem.tif", filled, hy.NODATA),
+        ("flow_dir.tif", np.where(valid, pointer, hy.NODATA).astype(np.int16), hy.NODATA),
+        ("flow_accum.tif", accum, hy.NODATA),
+        ("streams.tif", streams, 0),
+        ("stream_influence.tif", influence, hy.NODATA),
+    ]
+    for filename, array_, nodata in outputs:
+        report[filename] = patch_array_raster(os.path.join(output_dir, filename), array_, nodata)
+        print(f"  {filename}: {report[filename]} windows rewritten")
+    return report
+
+def refresh(previous_dem, dem_path, output_dir, flow_accum_threshold=500,
+            max_influence_distance=1, num_classes=4, cache=None, pmtiles=None, workers=None):
+    """
+    Bring tiles.py's outputs, the zoom pyramid and optionally the tile archive up to a new DEM
+
+    Parameters:
+    previous_dem (str): DEM the outputs in output_dir were computed from
+    dem_path (str): Updated DEM on the same grid
+    output_dir (str): tiles.py output directory
+    flow_accum_threshold (int): Threshold for stream extraction
+    max_influence_distance (float): Distance for influence calculation
+    num_classes (int): Number of classes in stream_influence_reclass.tif
+    cache (StageCache): Records the result as tiles.py's numpy delineation of
+        dem_path, and skips the refresh when that is already cached
+    pmtiles (str): PMTiles archive to update incrementally (None to leave it)
+    workers (int): Worker processes for the tile archive
+    """
+    report = {}
+
+    def patch():
+        report.update(refresh_outputs(previous_dem, dem_path, output_dir, flow_accum_threshold,
+                                      max_influence_distance))
+
+    # The same stage as tiles.py --backend numpy, whose outputs these are
+    run_stage(cache, "delineate_numpy", [dem_path],
+              {"threshold": flow_accum_threshold, "distance": max_influence_distance},
+              [os.path.join(output_dir, name) for name in tiles.DELINEATION_OUTPUTS],
+              code_version(tiles.__file__, hy.__file__), patch)
+
+    print("Reclassifying influence...")
+    influence = gdal.Open(os.path.join(output_dir, "stream_influence.tif")).ReadAsArray()
+    classes = tiles.classify_block(influence, tiles.class_edges(num_classes))
+    reclass = os.path.join(output_dir, "stream_influence_reclass.tif")
+    report["stream_influence_reclass.tif"] = patch_array_raster(reclass, classes)
+    print(f"  stream_influence_reclass.tif: {report['stream_influence_reclass.tif']} "
+          "windows rewritten")
+
+    manifest = None
+    if os.path.exists(os.path.join(output_dir, "pyramid", "pyramid.json")):
+        print("Rebuilding the zoom pyramid...")
+        manifest = tiles.build_pyramid(output_dir, max_influence_distance / 4, num_classes,
+                                       cache=cache)
+
+    if pmtiles is not None:
+        sys.path.insert(0, TILE_BUILDER_DIR)
+        from build_pmtiles import build_pmtiles
+        print("Updating the tile archive...")
+        # The state file build_pmtiles.py keeps next to itself for this archive
+        state_path = os.path.join(TILE_BUILDER_DIR, os.path.basename(pmtiles) + ".state.json")
+        stats = build_pmtiles(reclass, pmtiles, workers=workers, state_path=state_path,
+                              incremental=True, pyramid=manifest)
+        report["tiles_rendered"] = stats["rendered"]
+
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the tiles.py outputs for an updated DEM")
+    parser.add_argument("previous_dem", help="DEM the current outputs were computed from")
+    parser.add_argument("dem", help="Updated DEM on the same grid")
+    parser.add_argument("output_dir", nargs="?", default="tiles", help="tiles.py output directory")
+    parser.add_argument("--threshold", type=int, default=500, help="Stream extraction threshold")
+    parser.add_argument("--influence-distance", type=float, default=1, help="Influence distance")
+    parser.add_argument("--classes", type=int, default=4, help="Number of classes")
+    parser.add_argument("--pmtiles", nargs="?", metavar="ARCHIVE",
+                        const=os.path.join(HERE, "..", "..", "static", "tiles.pmtiles"),
+                        help="Also update the tile archive (default static/tiles.pmtiles)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for the tile archive")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the stage cache")
+    parser.add_argument("--cache-dir", default=".stage_cache", help="Stage cache directory")
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else StageCache(os.path.join(os.getcwd(), args.cache_dir))
+    report = refresh(args.previous_dem, args.dem, args.output_dir, args.threshold,
+                     args.influence_distance, args.classes, cache, args.pmtiles, args.workers)
+    print(f"\nRefresh complete: {report}")
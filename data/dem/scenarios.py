@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Rainfall scenarios for the water accumulation pipeline
+
+The plain pipeline accumulates one unit of rain per cell. Here each scenario
+weights the cells by a rainfall depth instead, either from a rainfall raster
+(resampled onto the flow_dir grid) or from a storm footprint reconstructed
+from a NOAA event: rain falls off as a Gaussian of the distance from the line
+between the event's begin and end coordinates.
+
+The D8 pointer grid does not change between scenarios, so its topological
+order is computed once (and kept in the stage cache, keyed by flow_dir.tif).
+Every scenario is then accumulated in the same pass over that order, as one
+column of a cells x scenarios array, which makes 50 scenarios cost about as
+much as one accumulation. That array is the only copy of the scenarios: it is
+float32, filled straight from the scenario iterator in the order's
+permutation (storm footprints only over their window), accumulated in place
+and un-permuted one scenario at a time.
+Influence and reclassification are fanned out per scenario across a process
+pool, as in sweep.py.
+
+Each scenario gets <output_dir>/<label>/stream_influence_reclass.tif, and
+scenario_summary.csv holds the class areas of all of them.
+
+Usage:
+    python scenarios.py tiles/ scenarios/ --rain storm_a.tif storm_b.tif
+    python scenarios.py tiles/ scenarios/ --events ../noaa_maricopa_floods.parquet --storm-sigma 3
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pyarrow.parquet as pq
+from osgeo import gdal, osr
+
+import hydrology as hy
+from cache import StageCache, code_version, run_stage
+from rasters import write_array_raster
+from sweep import cell_area
+from tiles import class_edges, classify_block
+
+METRES_PER_DEGREE = 111320.0
+EVENT_COLUMNS = ["event_id", "begin_date", "begin_lat", "begin_lon", "end_lat", "end_lon"]
+
+def read_pointer(flow_dir_path):
+    """
+    D8 pointer grid (0 where there is none) and its valid mask
+    """
+    ds = gdal.Open(flow_dir_path)
+    band = ds.GetRasterBand(1)
+    pointer = band.ReadAsArray()
+    valid = np.ones(pointer.shape, dtype=bool)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        valid &= pointer != nodata
+    pointer = np.where(valid, pointer, 0).astype(np.uint8)
+    return pointer, valid
+
+def load_accumulation_order(flow_dir_path, output_dir, pointer, cache=None):
+    """
+    hy.accumulation_order of the pointer grid, computed once per flow_dir.tif
+    """
+    order_path = os.path.join(output_dir, "accumulation_order.npz")
+
+    def compute():
+        down, _ = hy.downstream_index(pointer)
+        np.savez(order_path, **hy.accumulation_order(down))
+
+    run_stage(cache, "accumulation_order", [flow_dir_path], {}, [order_path],
+              code_version(hy.__file__), compute)
+    with np.load(order_path) as order:
+        return {name: order[name] for name in order.files}
+
+def rain_raster_scenarios(paths, template_ds):
+    """
+    (label, (row, col) origin, depth grid) for each rainfall raster, bilinearly
+    resampled onto the template grid, one at a time
+    """
+    gt = template_ds.GetGeoTransform()
+    bounds = (gt[0], gt[3] + gt[5] * template_ds.RasterYSize,
+              gt[0] + gt[1] * template_ds.RasterXSize, gt[3])
+    for path in paths:
+        warped = gdal.Warp("", path, format="MEM", outputBounds=bounds,
+                           width=template_ds.RasterXSize, height=template_ds.RasterYSize,
+                           dstSRS=template_ds.GetProjection(), resampleAlg="bilinear",
+                           dstNodata=0)
+        depth = warped.GetRasterBand(1).ReadAsArray().astype(np.float32)
+        depth[~np.isfinite(depth) | (depth < 0)] = 0
+        label = re.sub(r"[^\w.-]", "_", os.path.splitext(os.path.basename(path))[0])
+        yield f"rain_{label}", (0, 0), depth
+
+def read_storm_events(path):
+    """
+    NOAA events with begin and end coordinates, from the Parquet store or the JSON export
+    """
+    if path.endswith(".parquet"):
+        rows = pq.read_table(path, columns=EVENT_COLUMNS).to_pylist()
+    else:
+        with open(path) as f:
+            rows = json.load(f)
+    events = []
+    for row in rows:
+        try:
+            coords = [float(row[name]) for name in ("begin_lat", "begin_lon", "end_lat", "end_lon")]
+        except (TypeError, ValueError):
+            continue
+        events.append({"event_id": row["event_id"], "begin_date": row.get("begin_date"),
+                       "coords": coords})
+    return events
+
+def storm_tracks(template_ds, events):
+    """
+    Event tracks in the grid's coordinates and the metres per unit along them
+
+    Returns (tracks, scales): begin x, begin y, end x, end y per event, and
+    the metres per x and y unit. Geographic grids are scaled at the track's
+    mean latitude; projected grids are reprojected from WGS84 and scaled by
+    their linear unit.
+    """
+    coords = np.array([event["coords"] for event in events], dtype=np.float64).reshape(-1, 4)
+    begin_lat, begin_lon, end_lat, end_lon = coords.T
+    srs = osr.SpatialReference(wkt=template_ds.GetProjection())
+    if srs.IsGeographic():
+        tracks = np.column_stack([begin_lon, begin_lat, end_lon, end_lat])
+        lat0 = (begin_lat + end_lat) / 2
+        scales = np.column_stack([METRES_PER_DEGREE * np.cos(np.radians(lat0)),
+                                  np.full(lat0.shape, METRES_PER_DEGREE)])
+        return tracks, scales
+
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for ref in (srs, wgs84):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(wgs84, srs)
+    lons = np.concatenate([begin_lon, end_lon])
+    lats = np.concatenate([begin_lat, end_lat])
+    points = np.array(transform.TransformPoints(np.column_stack([lons, lats]))).reshape(-1, 3)
+    begin, end = np.split(points[:, :2], 2)
+    return np.hstack([begin, end]), np.full((len(coords), 2), srs.GetLinearUnits())
+
+def storm_footprint(track, scale, gt, shape, sigma_km, depth_mm):
+    """
+    Rain depth over the grid for a storm tracking from begin to end
+
+    track is (begin x, begin y, end x, end y) in the grid's coordinates and
+    scale the metres per x and y unit (see storm_tracks). Depth is depth_mm on
+    the track and falls off as a Gaussian with sigma_km of the distance from
+    it, cut at three sigma. Returns the (row, col) origin and depths of the
+    window within reach of the track (zero elsewhere), or None when the
+    footprint misses the grid.
+    """
+    begin_x, begin_y, end_x, end_y = track
+    x_scale, y_scale = scale
+    reach = 3 * sigma_km * 1000
+
+    # Only the window within reach of the track
+    xs = (min(begin_x, end_x) - reach / x_scale, max(begin_x, end_x) + reach / x_scale)
+    ys = (min(begin_y, end_y) - reach / y_scale, max(begin_y, end_y) + reach / y_scale)
+    rows = sorted((y - gt[3]) / gt[5] for y in ys)
+    cols = sorted((x - gt[0]) / gt[1] for x in xs)
+    row0 = max(int(np.floor(rows[0])), 0)
+    row1 = min(int(np.ceil(rows[1])), shape[0])
+    col0 = max(int(np.floor(cols[0])), 0)
+    col1 = min(int(np.ceil(cols[1])), shape[1])
+    if row0 >= row1 or col0 >= col1:
+        return None
+
+    y = (gt[3] + (np.arange(row0, row1) + 0.5) * gt[5] - begin_y)[:, None] * y_scale
+    x = (gt[0] + (np.arange(col0, col1) + 0.5) * gt[1] - begin_x)[None, :] * x_scale
+    track_x = (end_x - begin_x) * x_scale
+    track_y = (end_y - begin_y) * y_scale
+    length2 = track_x ** 2 + track_y ** 2
+    t = np.clip((x * track_x + y * track_y) / length2, 0, 1) if length2 else 0.0
+    distance2 = (x - t * track_x) ** 2 + (y - t * track_y) ** 2
+
+    sigma = sigma_km * 1000
+    depth = np.where(distance2 <= reach ** 2, depth_mm * np.exp(-distance2 / (2 * sigma ** 2)), 0)
+    return (row0, col0), depth.astype(np.float32)
+
+def storm_scenarios(events_path, template_ds, sigma_km, depth_mm, max_scenarios=None):
+    """
+    (label, (row, col) origin, depth window) for each NOAA event whose footprint reaches the grid
+    """
+    gt = template_ds.GetGeoTransform()
+    shape = (template_ds.RasterYSize, template_ds.RasterXSize)
+    events = read_storm_events(events_path)
+    tracks, scales = storm_tracks(template_ds, events)
+    count = 0
+    for event, track, scale in zip(events, tracks, scales):
+        footprint = storm_footprint(track, scale, gt, shape, sigma_km, depth_mm)
+        if footprint is None:
+            continue
+        yield (f"event_{event['event_id']}",) + footprint
+        count += 1
+        if max_scenarios and count >= max_scenarios:
+            return
+
+def _scenario_job(job):
+    flow_dir_path, output_dir, index, label, sigma, num_classes, area = job
+
+    accum = np.load(os.path.join(output_dir, "_accum.npy"), mmap_mode="r")[index]
+    valid = np.isfinite(accum)
+    influence = hy.influence_from_accum(accum, valid, sigma)
+
+    classes = classify_block(influence, class_edges(num_classes))
+
+    out_dir = os.path.join(output_dir, label)
+    os.makedirs(out_dir, exist_ok=True)
+    template_ds = gdal.Open(flow_dir_path)
+    write_array_raster(template_ds, os.path.join(out_dir, "flow_accum.tif"),
+                       accum, gdal.GDT_Float32, hy.NODATA)
+    write_array_raster(template_ds, os.path.join(out_dir, "stream_influence_reclass.tif"),
+                       classes, gdal.GDT_Byte, 0)
+    template_ds = None
+
+    counts = np.bincount(classes[valid], minlength=num_classes + 1)
+    total = counts[1:].sum()
+    return [{
+        "scenario": label,
+        "class": value,
+        "cells": int(counts[value]),
+        "area_km2": round(counts[value] * area / 1e6, 4),
+        "share": round(counts[value] / total, 6) if total else 0.0,
+        "max_accum": round(float(np.nanmax(accum)), 3),
+    } for value in range(1, num_classes + 1)]
+
+def run_scenarios(tiles_dir, output_dir, scenarios, sigma=0.25, num_classes=4, workers=None,
+                  cache=None, count=None):
+    """
+    Weighted accumulation, influence and reclassification for every rainfall scenario
+
+    Parameters:
+    tiles_dir (str): tiles.py output directory holding flow_dir.tif
+    output_dir (str): Directory for the cached order and every scenario
+    scenarios (iterable): (label, (row, col) origin, rain depth window) on the
+        flow_dir grid; depths outside the window are zero
+    count (int): Number of scenarios, so a generator is consumed one scenario
+        at a time (default: the iterable is listed first)
+    sigma (float): Gaussian sigma for the influence step (max_influence_distance / 4)
+    num_classes (int): Number of classes for the reclassification
+    workers (int): Worker processes for the per-scenario influence stages
+    cache (StageCache): Reuse the topological order while flow_dir.tif is unchanged
+
+    Returns the summary rows written to scenario_summary.csv.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    flow_dir_path = os.path.join(tiles_dir, "flow_dir.tif")
+    template_ds = gdal.Open(flow_dir_path)
+    pointer, valid = read_pointer(flow_dir_path)
+
+    print("Loading the topological order of the D8 grid...")
+    order = load_accumulation_order(flow_dir_path, output_dir, pointer, cache)
+
+    if count is None:
+        scenarios = list(scenarios)
+        count = len(scenarios)
+    if not count:
+        print("No scenarios to run")
+        return []
+
+    # Rows in the order's permutation, so the accumulation runs in place
+    perm = order["perm"]
+    rank = np.empty(perm.size, dtype=perm.dtype)
+    rank[perm] = np.arange(perm.size, dtype=perm.dtype)
+    cols = pointer.shape[1]
+    weights = np.zeros((pointer.size, count), dtype=np.float32)
+    labels = []
+    for i, (label, (row0, col0), depth) in enumerate(scenarios):
+        rows, width = depth.shape
+        depth = np.where(valid[row0:row0 + rows, col0:col0 + width], depth, 0)
+        if depth.shape == pointer.shape:
+            weights[:, i] = depth.ravel()[perm]
+        else:
+            cells = np.arange(row0, row0 + rows)[:, None] * cols + np.arange(col0, col0 + width)
+            weights[rank[cells.ravel()], i] = depth.ravel()
+        labels.append(label)
+    del rank
+    if len(labels) != count:
+        raise ValueError(f"expected {count} scenarios, got {len(labels)}")
+
+    print(f"Accumulating {count} scenarios in one pass...")
+    start = time.perf_counter()
+    hy.accumulate_permuted(order, weights)
+    print(f"  {time.perf_counter() - start:.2f}s")
+
+    # One contiguous grid per scenario for the workers, un-permuted one at a time
+    stacked = np.lib.format.open_memmap(os.path.join(output_dir, "_accum.npy"), mode="w+",
+                                        dtype=np.float32, shape=(count,) + pointer.shape)
+    column = np.empty(pointer.size, dtype=np.float32)
+    for i in range(count):
+        column[perm] = weights[:, i]
+        stacked[i] = np.where(valid, column.reshape(pointer.shape), np.nan)
+    stacked.flush()
+    del weights, column, stacked
+
+    area = cell_area(template_ds)
+    template_ds = None
+    jobs = [(flow_dir_path, output_dir, i, label, sigma, num_classes, area)
+            for i, label in enumerate(labels)]
+    print(f"Classifying {len(jobs)} scenarios across {workers or os.cpu_count()} workers...")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = [row for result in executor.map(_scenario_job, jobs) for row in result]
+
+    os.remove(os.path.join(output_dir, "_accum.npy"))
+
+    summary_path = os.path.join(output_dir, "scenario_summary.csv")
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"✓ Wrote {len(labels)} scenarios and {summary_path}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Weighted accumulation for rainfall scenarios")
+    parser.add_argument("tiles_dir", help="tiles.py output directory (with flow_dir.tif)")
+    parser.add_argument("output_dir", help="Output directory")
+    parser.add_argument("--rain", nargs="+", default=[], help="Rainfall depth rasters, one scenario each")
+    parser.add_argument("--events", default=None,
+                        help="NOAA events (Parquet or JSON) to turn into storm footprints")
+    parser.add_argument("--storm-sigma", type=float, default=3.0,
+                        help="Gaussian fall-off of storm rain from the event track, in km")
+    parser.add_argument("--storm-depth", type=float, default=25.0,
+                        help="Rain depth on the event track, in mm")
+    parser.add_argument("--max-scenarios", type=int, default=None,
+                        help="Use at most this many events")
+    parser.add_argument("--sigma", type=float, default=0.25,
+                        help="Gaussian sigma of the influence step (max_influence_distance / 4)")
+    parser.add_argument("--classes", type=int, default=4, help="Number of classes")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the stage cache")
+    parser.add_argument("--cache-dir", default=".stage_cache", help="Stage cache directory")
+    args = parser.parse_args()
+
+    if not args.rain and not args.events:
+        parser.error("give --rain rasters and/or --events")
+
+    cache = None if args.no_cache else StageCache(os.path.join(os.getcwd(), args.cache_dir))
+    template = gdal.Open(os.path.join(args.tiles_dir, "flow_dir.tif"))
+    # Storm footprints are small windows; rain rasters are warped one at a time
+    storms = []
+    if args.events:
+        storms = list(storm_scenarios(args.events, template, args.storm_sigma, args.storm_depth,
+                                      args.max_scenarios))
+    scenarios = itertools.chain(rain_raster_scenarios(args.rain, template), storms)
+
+    run_scenarios(args.tiles_dir, args.output_dir, scenarios, args.sigma, args.classes,
+                  args.workers, cache, count=len(args.rain) + len(storms))
+    template = None
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Parameter sweep for the water accumulation pipeline
+
+Fill, D8 pointer and flow accumulation do not depend on the parameters we
+tune, so they are computed once. The downstream stages are then fanned out
+across a process pool by the one parameter each depends on: streams once per
+threshold, and the Gaussian influence, stretch and rescale once per sigma,
+each influence job writing the reclassified raster for every class count.
+
+Streams go to threshold_<T>/, reclassified influence to
+sigma_<S>_classes_<N>/, and sweep_summary.csv holds the class-area
+statistics for every (threshold, sigma, class count) combination.
+
+Usage:
+    python sweep.py dem.tif sweep/ --thresholds 250 500 1000 --sigmas 0.25 0.5 --classes 3 4
+"""
+
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from osgeo import gdal, osr
+
+import hydrology as hy
+from rasters import write_array_raster
+from tiles import class_edges, classify_block
+
+def streams_label(threshold):
+    """
+    Directory name for the streams of one threshold
+    """
+    return f"threshold_{threshold}"
+
+def classes_label(sigma, num_classes):
+    """
+    Directory name for the reclassified influence of one (sigma, class count) pair
+    """
+    return f"sigma_{sigma:g}_classes_{num_classes}"
+
+def cell_area(dem_ds):
+    """
+    Area of one cell in square metres (approximate for geographic rasters)
+    """
+    gt = dem_ds.GetGeoTransform()
+    area = abs(gt[1] * gt[5])
+
+    srs = osr.SpatialReference(wkt=dem_ds.GetProjection())
+    if srs.IsGeographic():
+        center_lat = gt[3] + gt[5] * dem_ds.RasterYSize / 2
+        metres_per_degree = 111320.0
+        area *= metres_per_degree ** 2 * np.cos(np.radians(center_lat))
+    return area
+
+def _streams_job(job):
+    dem_path, sweep_dir, threshold = job
+
+    accum = np.load(os.path.join(sweep_dir, "_accum.npy"), mmap_mode="r")
+    streams = hy.extract_streams(accum, np.isfinite(accum), threshold)
+
+    out_dir = os.path.join(sweep_dir, streams_label(threshold))
+    os.makedirs(out_dir, exist_ok=True)
+    dem_ds = gdal.Open(dem_path)
+    write_array_raster(dem_ds, os.path.join(out_dir, "streams.tif"), streams, gdal.GDT_Byte, 0)
+    dem_ds = None
+    return int(streams.sum())
+
+def _influence_job(job):
+    dem_path, sweep_dir, sigma, class_counts = job
+
+    accum = np.load(os.path.join(sweep_dir, "_accum.npy"), mmap_mode="r")
+    valid = np.isfinite(accum)
+    influence = hy.influence_from_accum(accum, valid, sigma)
+
+    dem_ds = gdal.Open(dem_path)
+    counts = {}
+    for num_classes in class_counts:
+        out_dir = os.path.join(sweep_dir, classes_label(sigma, num_classes))
+        os.makedirs(out_dir, exist_ok=True)
+
+        classes = classify_block(influence, class_edges(num_classes))
+        write_array_raster(dem_ds, os.path.join(out_dir, "stream_influence_reclass.tif"),
+                           classes, gdal.GDT_Byte, 0)
+        counts[num_classes] = np.bincount(classes[valid], minlength=num_classes + 1)
+    dem_ds = None
+    return counts
+
+def run_sweep(dem_path, sweep_dir, thresholds, sigmas, class_counts, workers=None):
+    """
+    Run the pipeline for every combination of parameters
+
+    Parameters:
+    dem_path (str): Path to input DEM file
+    sweep_dir (str): Directory for the shared upstream rasters and every combination
+    thresholds (list): Stream extraction thresholds
+    sigmas (list): Gaussian sigmas for the influence step (max_influence_distance / 4)
+    class_counts (list): Numbers of classes for the reclassification
+    workers (int): Worker processes for the downstream stages
+
+    Returns the summary rows written to sweep_summary.csv.
+    """
+    if not (thresholds and sigmas and class_counts):
+        raise ValueError("give at least one threshold, sigma and class count")
+    if min(class_counts) < 1:
+        raise ValueError(f"class counts must be positive, got {list(class_counts)}")
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    dem_ds = gdal.Open(dem_path)
+    dem_band = dem_ds.GetRasterBand(1)
+    dem = dem_band.ReadAsArray().astype(np.float32)
+    nodata = dem_band.GetNoDataValue()
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+
+    # Shared upstream stages, computed once for the whole sweep
+    print("Filling, routing and accumulating flow (once)...")
+    gt = dem_ds.GetGeoTransform()
+    routed = hy.route_flow(dem, valid, (gt[1], gt[5]))
+    write_array_raster(dem_ds, os.path.join(sweep_dir, "filled_dem.tif"),
+                       routed["filled"], gdal.GDT_Float32, hy.NODATA)
+    write_array_raster(dem_ds, os.path.join(sweep_dir, "flow_dir.tif"),
+                       np.where(valid, routed["pointer"], hy.NODATA).astype(np.int16),
+                       gdal.GDT_Int16, hy.NODATA)
+    write_array_raster(dem_ds, os.path.join(sweep_dir, "flow_accum.tif"),
+                       routed["accum"], gdal.GDT_Float32, hy.NODATA)
+    np.save(os.path.join(sweep_dir, "_accum.npy"), routed["accum"])
+    area = cell_area(dem_ds)
+    dem_ds = None
+    del routed, dem
+
+    combos = len(thresholds) * len(sigmas) * len(class_counts)
+    print(f"Running {len(thresholds)} stream and {len(sigmas)} influence jobs "
+          f"({combos} combinations) across {workers or os.cpu_count()} workers...")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # The influence jobs dominate, so they are queued first
+        influence = executor.map(_influence_job, [(dem_path, sweep_dir, sigma, list(class_counts))
+                                                  for sigma in sigmas])
+        streams = executor.map(_streams_job, [(dem_path, sweep_dir, threshold)
+                                              for threshold in thresholds])
+        class_cells = dict(zip(sigmas, influence))
+        stream_cells = dict(zip(thresholds, streams))
+
+    os.remove(os.path.join(sweep_dir, "_accum.npy"))
+
+    rows = []
+    for threshold, sigma, num_classes in itertools.product(thresholds, sigmas, class_counts):
+        counts = class_cells[sigma][num_classes]
+        total = counts[1:].sum()
+        for value in range(1, num_classes + 1):
+            rows.append({
+                "threshold": threshold,
+                "sigma": sigma,
+                "num_classes": num_classes,
+                "class": value,
+                "cells": int(counts[value]),
+                "area_km2": round(counts[value] * area / 1e6, 4),
+                "share": round(counts[value] / total, 6) if total else 0.0,
+                "stream_cells": stream_cells[threshold],
+            })
+
+    summary_path = os.path.join(sweep_dir, "sweep_summary.csv")
+    with open(summary_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print(f"✓ Wrote {len(thresholds)} stream and {len(sigmas) * len(class_counts)} class rasters "
+          f"and {summary_path}")
+    return rows
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sweep stream and influence parameters")
+    parser.add_argument("dem", help="Input DEM")
+    parser.add_argument("sweep_dir", help="Output directory")
+    parser.add_argument("--thresholds", type=int, nargs="+", default=[500],
+                        help="Stream extraction thresholds")
+    parser.add_argument("--sigmas", type=float, nargs="+", default=[0.25],
+                        help="Gaussian sigmas (max_influence_distance / 4)")
+    parser.add_argument("--classes", type=int, nargs="+", default=[4],
+                        help="Class counts for the reclassification")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes")
+    args = parser.parse_args()
+
+    run_sweep(args.dem, args.sweep_dir, args.thresholds, args.sigmas, args.classes, args.workers)
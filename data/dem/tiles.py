@@ -1,12 +1,35 @@
+import argparse
+import contextlib
+import functools
+import json
+import math
 import os
+import sys
 import whitebox
-from osgeo import gdal
+from osgeo import gdal, osr
 import numpy as np
+import hydrology as hy
+import profiling
+from cache import StageCache, code_version, run_stage
+from rasters import create_like, iter_windows, write_array_raster
+from tiled import delineate_basins_tiled, parse_tiles
 
 # Initialize WhiteboxTools
 wbt = whitebox.WhiteboxTools()
 
-def delineate_basins(dem_path, output_dir, flow_accum_threshold, max_influence_distance):
+_wbt_version = None
+
+def wbt_version():
+    """
+    WhiteboxTools version string, used to key cached whitebox stages
+    """
+    global _wbt_version
+    if _wbt_version is None:
+        _wbt_version = wbt.version() or whitebox.__name__
+    return _wbt_version
+
+def delineate_basins(dem_path, output_dir, flow_accum_threshold, max_influence_distance,
+                     backend=None, tiles=None, workers=None, cache=None):
     """
     Delineate basins from a DEM and create water accumulation visualization
 
@@ -15,6 +38,49 @@ def delineate_basins(dem_path, output_dir, flow_accum_threshold, max_influence_d
     output_dir (str): Directory to save output files
     flow_accum_threshold (int): Threshold for stream extraction (lower for desert = more sensitive)
     max_influence_distance (float): Distance for influence calculation
+    backend (str): Hydrology backend, one of BACKENDS ("whitebox", "whitebox_chain" or "numpy");
+        defaults to "whitebox", or "numpy" for a tiled run
+    tiles (tuple): Tile grid as (columns, rows) to run tiled across a process pool (numpy
+        backend only)
+    workers (int): Worker processes for the tiled run (defaults to one per CPU)
+    cache (StageCache): Skip stages whose inputs and parameters are unchanged
+    """
+    if tiles is not None:
+        # The tiled engine exchanges state across seams in-process; WhiteboxTools cannot
+        if backend not in (None, "numpy"):
+            raise ValueError(f"tiled runs use the numpy backend, not {backend!r}")
+        outputs = [os.path.join(output_dir, name) for name in DELINEATION_OUTPUTS]
+        here = os.path.dirname(os.path.abspath(__file__))
+        run_stage(
+            cache, "delineate_tiled", [dem_path],
+            {"threshold": flow_accum_threshold, "distance": max_influence_distance},
+            outputs, code_version(os.path.join(here, "tiled.py"), hy.__file__),
+            lambda: delineate_basins_tiled(dem_path, output_dir, flow_accum_threshold,
+                                           max_influence_distance, tiles, workers)
+        )
+        return os.path.join(output_dir, "stream_influence.tif")
+
+    return BACKENDS[backend or "whitebox"](dem_path, output_dir, flow_accum_threshold,
+                             max_influence_distance, cache=cache)
+
+# Rasters written by every delineation backend
+DELINEATION_OUTPUTS = [
+    "filled_dem.tif",
+    "flow_dir.tif",
+    "flow_accum.tif",
+    "streams.tif",
+    "stream_influence.tif",
+]
+
+def delineate_basins_whitebox(dem_path, output_dir, flow_accum_threshold, max_influence_distance,
+                              cache=None, influence_chain="fused"):
+    """
+    Run the flow stages with WhiteboxTools binaries, file to file
+
+    The influence chain (Gaussian, ln, stretch, rescale) runs as one fused
+    in-process stage that writes stream_influence.tif once, or with
+    influence_chain="whitebox" as the four WhiteboxTools tools it replaces
+    (the "whitebox_chain" backend, an independent reference for parity checks).
     """
     os.makedirs(output_dir, exist_ok=True)
 
@@ -27,134 +93,482 @@ def delineate_basins(dem_path, output_dir, flow_accum_threshold, max_influence_d
 
     # Fill depressions in DEM
     print("Filling depressions...")
-    wbt.fill_depressions(dem_path, filled_dem)
+    run_stage(cache, "fill_depressions", [dem_path], {}, [filled_dem], wbt_version(),
+              lambda: wbt.fill_depressions(dem_path, filled_dem))
 
     # Calculate flow direction
     print("Calculating flow direction...")
-    wbt.d8_pointer(filled_dem, flow_dir)
+    run_stage(cache, "d8_pointer", [filled_dem], {}, [flow_dir], wbt_version(),
+              lambda: wbt.d8_pointer(filled_dem, flow_dir))
 
     # Calculate flow accumulation
     print("Calculating flow accumulation...")
-    wbt.d8_flow_accumulation(filled_dem, flow_accum)
+    run_stage(cache, "d8_flow_accumulation", [filled_dem], {}, [flow_accum], wbt_version(),
+              lambda: wbt.d8_flow_accumulation(filled_dem, flow_accum))
 
     # Extract streams (lower threshold for Phoenix desert hydrology)
     print(f"Extracting streams with threshold {flow_accum_threshold}...")
-    wbt.extract_streams(flow_accum, streams, threshold=flow_accum_threshold)
+    run_stage(cache, "extract_streams", [flow_accum], {"threshold": flow_accum_threshold},
+              [streams], wbt_version(),
+              lambda: wbt.extract_streams(flow_accum, streams, threshold=flow_accum_threshold))
+
+    if influence_chain == "whitebox":
+        whitebox_influence(flow_accum, influence, max_influence_distance/4, cache)
+    else:
+        # Gaussian, ln, contrast stretch and 1-4 rescale, fused into one stage
+        print("Calculating stream influence...")
+        run_stage(cache, "influence", [flow_accum],
+                  {"sigma": max_influence_distance/4, "stdev": 2, "num_tones": 3,
+                   "out_min_val": 1, "out_max_val": 4},
+                  [influence], code_version(__file__, hy.__file__),
+                  lambda: fused_influence(flow_accum, influence, max_influence_distance/4))
+
+    print(f"Analysis complete! Results saved to: {output_dir}")
+    return influence
 
-    # Calculate influence areas
+def whitebox_influence(flow_accum, influence, sigma, cache=None):
+    """
+    Gaussian, ln, standard deviation stretch and 1-4 rescale with the WhiteboxTools tools
+
+    The four-stage chain that fused_influence replaces, each stage rewriting
+    the influence raster.
+    """
     print("Calculating stream influence...")
-    wbt.gaussian_filter(
-        flow_accum,
-        influence,
-        sigma=max_influence_distance/4
-    )
+    run_stage(cache, "gaussian_filter", [flow_accum], {"sigma": sigma},
+              [influence], wbt_version(),
+              lambda: wbt.gaussian_filter(
+                  flow_accum,
+                  influence,
+                  sigma=sigma
+              ))
 
     # Get natural log of influence areas
     print("Calculating natural log of stream influence...")
-    wbt.ln(influence, influence)
+    run_stage(cache, "ln", [influence], {}, [influence], wbt_version(),
+              lambda: wbt.ln(influence, influence))
 
     # Standard deviation contrast stretch
     print("Calculating standard deviation contrast stretch...")
-    wbt.standard_deviation_contrast_stretch(
-        influence,
-        influence,
-        stdev=2,
-        num_tones=3
-    )
+    run_stage(cache, "standard_deviation_contrast_stretch", [influence],
+              {"stdev": 2, "num_tones": 3}, [influence], wbt_version(),
+              lambda: wbt.standard_deviation_contrast_stretch(
+                  influence,
+                  influence,
+                  stdev=2,
+                  num_tones=3
+              ))
 
     # Rescale to 1-4 range for visualization
     print("Rescaling influence...")
-    wbt.rescale_value_range(
-        influence,
-        influence,
-        out_min_val=1,
-        out_max_val=4
+    run_stage(cache, "rescale_value_range", [influence],
+              {"out_min_val": 1, "out_max_val": 4}, [influence], wbt_version(),
+              lambda: wbt.rescale_value_range(
+                  influence,
+                  influence,
+                  out_min_val=1,
+                  out_max_val=4
+              ))
+    return influence
+
+def delineate_basins_numpy(dem_path, output_dir, flow_accum_threshold, max_influence_distance,
+                           cache=None):
+    """
+    Run the delineation chain in-process on NumPy arrays
+
+    The DEM is read once, every intermediate stays in memory, and the same
+    rasters as the WhiteboxTools backend are written at the end. With a cache
+    the whole in-memory chain is a single stage.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    run_stage(
+        cache, "delineate_numpy", [dem_path],
+        {"threshold": flow_accum_threshold, "distance": max_influence_distance},
+        [os.path.join(output_dir, name) for name in DELINEATION_OUTPUTS],
+        code_version(__file__, hy.__file__),
+        lambda: _delineate_numpy(dem_path, output_dir, flow_accum_threshold,
+                                 max_influence_distance)
     )
 
+    influence = os.path.join(output_dir, "stream_influence.tif")
     print(f"Analysis complete! Results saved to: {output_dir}")
     return influence
 
-def reclassify_influence_raster(input_file, output_file, num_classes=4):
+def _delineate_numpy(dem_path, output_dir, flow_accum_threshold, max_influence_distance):
+
+    dem_ds = gdal.Open(dem_path)
+    dem_band = dem_ds.GetRasterBand(1)
+    dem = dem_band.ReadAsArray().astype(np.float32)
+    nodata = dem_band.GetNoDataValue()
+    valid = np.isfinite(dem)
+    if nodata is not None:
+        valid &= dem != nodata
+
+    geotransform = dem_ds.GetGeoTransform()
+    print("Running in-process hydrology (fill, pointer, accumulation, influence)...")
+    # The steps of hy.delineate, recorded separately when profiling
+    with profiling.stage("numpy_route_flow"):
+        results = hy.route_flow(dem, valid, (geotransform[1], geotransform[5]))
+    with profiling.stage("numpy_extract_streams"):
+        results["streams"] = hy.extract_streams(results["accum"], valid, flow_accum_threshold)
+    with profiling.stage("numpy_influence"):
+        results["influence"] = hy.influence_from_accum(results["accum"], valid,
+                                                       max_influence_distance / 4)
+
+    pointer = np.where(valid, results["pointer"], hy.NODATA).astype(np.int16)
+    outputs = [
+        ("filled_dem.tif", results["filled"], gdal.GDT_Float32, hy.NODATA),
+        ("flow_dir.tif", pointer, gdal.GDT_Int16, hy.NODATA),
+        ("flow_accum.tif", results["accum"], gdal.GDT_Float32, hy.NODATA),
+        ("streams.tif", results["streams"], gdal.GDT_Byte, 0),
+        ("stream_influence.tif", results["influence"], gdal.GDT_Float32, hy.NODATA),
+    ]
+    paths = [os.path.join(output_dir, filename) for filename, *_ in outputs]
+    with profiling.stage("numpy_write_outputs", outputs=paths):
+        for path, (_, array_, data_type, nodata_value) in zip(paths, outputs):
+            write_array_raster(dem_ds, path, array_, data_type, nodata_value)
+    dem_ds = None
+
+BACKENDS = {
+    "whitebox": delineate_basins_whitebox,
+    "whitebox_chain": functools.partial(delineate_basins_whitebox, influence_chain="whitebox"),
+    "numpy": delineate_basins_numpy,
+}
+
+# Rows of flow accumulation per block in the fused influence stage
+INFLUENCE_BLOCK_ROWS = 512
+
+def _influence_strips(band, sigma, radius, block_rows):
     """
-    Reclassify the influence raster using GDAL
+    Yield (yoff, influence) for row strips of a flow accumulation band
+
+    Each strip is read with `radius` rows of halo (invalid beyond the
+    raster), so it matches the same rows of a whole-raster pass.
     """
-    src_ds = gdal.Open(input_file)
+    rows, cols = band.YSize, band.XSize
+    nodata = band.GetNoDataValue()
+    for yoff in range(0, rows, block_rows):
+        ysize = min(block_rows, rows - yoff)
+        top, bottom = max(yoff - radius, 0), min(yoff + ysize + radius, rows)
+        accum = band.ReadAsArray(0, top, cols, bottom - top).astype(np.float64)
+        valid = np.isfinite(accum)
+        if nodata is not None:
+            valid &= accum != nodata
+
+        padding = ((radius - (yoff - top), radius - (bottom - yoff - ysize)), (radius, radius))
+        accum_p = np.pad(np.where(valid, accum, np.nan), padding, constant_values=np.nan)
+        valid_p = np.pad(valid, padding, constant_values=False)
+        yield yoff, hy.stream_influence(accum_p, valid_p, sigma, radius)
+
+def influence_stretch(band, sigma, radius, block_rows=INFLUENCE_BLOCK_ROWS):
+    """
+    (mean, stdev, tone_min, tone_max) of the stretch of a flow accumulation band's influence
+
+    One streaming pass over row strips: each strip's (count, mean, M2) is
+    merged with Chan's parallel update, and the influence range fixes the
+    tone range (the stretch is monotonic).
+    """
+    total = (0, 0.0, 0.0)
+    low, high = np.inf, -np.inf
+    for _, influence in _influence_strips(band, sigma, radius, block_rows):
+        total = hy.merge_stats(total, hy.block_stats(influence))
+        values = influence[~np.isnan(influence)]
+        if values.size:
+            low, high = min(low, values.min()), max(high, values.max())
+    count, mean, m2 = total
+    stdev = np.sqrt(m2 / count) if count else 0.0
+    tone_min, tone_max = hy.contrast_stretch(np.array([low, high]), mean, stdev)
+    return mean, stdev, tone_min, tone_max
+
+def write_influence(band, output_ds, sigma, radius, stretch, block_rows=INFLUENCE_BLOCK_ROWS,
+                    edges=None):
+    """
+    Write the stretched, 1-4 rescaled influence of a flow accumulation band to output_ds
+
+    With edges, the rescaled values are classified (classify_block) instead.
+    """
+    mean, stdev, tone_min, tone_max = stretch
+    out_band = output_ds.GetRasterBand(1)
+    for yoff, influence in _influence_strips(band, sigma, radius, block_rows):
+        rescaled = hy.rescale(hy.contrast_stretch(influence, mean, stdev), tone_min, tone_max)
+        rescaled[np.isnan(influence)] = np.nan
+        if edges is not None:
+            # Classified from float32, as the written influence raster would be
+            out_band.WriteArray(classify_block(rescaled.astype(np.float32), edges), 0, yoff)
+        else:
+            out_band.WriteArray(np.where(np.isnan(rescaled), hy.NODATA, rescaled).astype(np.float32),
+                                0, yoff)
+
+def fused_influence(accum_file, output_file, sigma, block_rows=INFLUENCE_BLOCK_ROWS):
+    """
+    Gaussian, ln, standard deviation stretch and 1-4 rescale of flow accumulation in one stage
+
+    Replaces four whole-raster passes that each rewrote the influence raster:
+    influence_stretch streams over the accumulation once for the stretch
+    statistics, then each strip is recomputed and the rescaled raster is
+    written once.
+
+    Parameters:
+    accum_file (str): Path to the flow accumulation raster
+    output_file (str): Path for the rescaled (1-4) influence raster
+    sigma (float): Gaussian sigma in cells (clamped as WhiteboxTools does)
+    block_rows (int): Rows per strip
+    """
+    sigma, radius = hy.gaussian_radius(sigma)
+    src_ds = gdal.Open(accum_file)
     src_band = src_ds.GetRasterBand(1)
-    src_data = src_band.ReadAsArray()
+    stretch = influence_stretch(src_band, sigma, radius, block_rows)
+
+    dst_ds = create_like(src_ds, output_file, gdal.GDT_Float32, nodata=hy.NODATA)
+    write_influence(src_band, dst_ds, sigma, radius, stretch, block_rows)
+    src_ds = None
+    dst_ds = None
 
-    driver = gdal.GetDriverByName('GTiff')
-    dst_ds = driver.Create(output_file,
-                          src_ds.RasterXSize,
-                          src_ds.RasterYSize,
-                          1,
-                          gdal.GDT_Byte)
+def classify_block(block, edges):
+    """
+    Classify a block of values into 1..len(edges)-1 in a single vectorized pass
 
-    dst_ds.SetProjection(src_ds.GetProjection())
-    dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
+    The first class includes its lower edge, every class includes its upper
+    edge, and anything outside the edges (or NaN) becomes 0 (nodata).
+    """
+    if np.issubdtype(block.dtype, np.floating):
+        edges = np.asarray(edges, dtype=block.dtype)
+    else:
+        edges = np.asarray(edges, dtype=np.float64)
+
+    classes = np.searchsorted(edges, block, side="left")
+    classes[block == edges[0]] = 1
+    classes[classes > len(edges) - 1] = 0
+    return classes.astype(np.uint8)
+
+def reclassify_influence_raster(input_file, output_file, num_classes=4, window_size=None,
+                                cache=None):
+    """
+    Reclassify the influence raster using GDAL
 
-    min_val = 1
-    max_val = 4
-    interval = (max_val - min_val) / num_classes
+    The raster is streamed window by window, so peak memory is bounded by the
+    window size rather than the raster size.
 
-    dst_data = np.zeros_like(src_data, dtype=np.uint8)
+    Parameters:
+    input_file (str): Path to the rescaled (1-4) influence raster
+    output_file (str): Path for the classified uint8 GeoTIFF
+    num_classes (int): Number of equal-interval classes between 1 and 4
+    window_size (int or tuple): Window size in cells (defaults to native blocks)
+    cache (StageCache): Skip the stage when the input and num_classes are unchanged
+    """
+    run_stage(cache, "reclassify_influence", [input_file], {"num_classes": num_classes},
+              [output_file], code_version(__file__),
+              lambda: _reclassify(input_file, output_file, num_classes, window_size))
+    return output_file
 
-    for i in range(num_classes):
-        lower = min_val + (i * interval)
-        upper = min_val + ((i + 1) * interval)
+def class_edges(num_classes, min_val=1, max_val=4):
+    """
+    Equal-interval class edges over the rescaled influence range
+    """
+    interval = (max_val - min_val) / num_classes
+    return [min_val + (i * interval) for i in range(num_classes + 1)]
 
-        if i == 0:
-            mask = (src_data >= lower) & (src_data <= upper)
-        else:
-            mask = (src_data > lower) & (src_data <= upper)
+def _reclassify(input_file, output_file, num_classes, window_size):
+    src_ds = gdal.Open(input_file)
+    src_band = src_ds.GetRasterBand(1)
 
-        dst_data[mask] = i + 1
+    dst_ds = create_like(src_ds, output_file, gdal.GDT_Byte, nodata=0)
 
+    edges = class_edges(num_classes)
     dst_band = dst_ds.GetRasterBand(1)
-    dst_band.WriteArray(dst_data)
-    dst_band.SetNoDataValue(0)
+
+    for xoff, yoff, xsize, ysize in iter_windows(src_band, window_size):
+        src_data = src_band.ReadAsArray(xoff, yoff, xsize, ysize)
+        dst_band.WriteArray(classify_block(src_data, edges), xoff, yoff)
 
     src_ds = None
     dst_ds = None
 
-    return output_file
+# Zoom range of the map (MAP_CONSTANTS.CONFIG in src/lib/components/Map/map.ts) and its tile size
+PYRAMID_ZOOMS = (9, 15)
+TILE_PIXELS = 512
+EARTH_CIRCUMFERENCE_M = 40075016.686
 
-def convert_raster_to_vector(input_raster, output_vector):
+def cell_size_m(ds):
     """
-    Convert a raster file to vector format using WhiteboxTools
+    (larger cell side in metres, centre latitude) of a raster (approximate when geographic)
     """
-    wbt.set_nodata_value(
-        input_raster,
-        input_raster,
-        back_value=1,
-    )
+    gt = ds.GetGeoTransform()
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    centre = gt[3] + gt[5] * ds.RasterYSize / 2
+    if srs.IsGeographic():
+        return max(abs(gt[5]), abs(gt[1]) * math.cos(math.radians(centre))) * 111320.0, centre
+    return max(abs(gt[1]), abs(gt[5])), None
+
+def pyramid_factors(cell_m, lat, zooms=PYRAMID_ZOOMS):
+    """
+    Power-of-two coarsening factors whose cells still fit within a tile pixel at some zoom
+    """
+    factors = set()
+    scale = math.cos(math.radians(lat)) if lat is not None else 1.0
+    for zoom in range(zooms[0], zooms[1] + 1):
+        pixel_m = EARTH_CIRCUMFERENCE_M / (TILE_PIXELS * 2 ** zoom) * scale
+        if pixel_m >= 2 * cell_m:
+            factors.add(2 ** int(math.log2(pixel_m / cell_m)))
+    return sorted(factors)
+
+def aggregate_accumulation(accum_file, output_file, factor, block_rows=INFLUENCE_BLOCK_ROWS):
+    """
+    Coarsen flow accumulation by the largest value in each factor x factor block
 
-    wbt.raster_to_vector_polygons(input_raster, output_vector)
-    return output_vector
+    The channel through a block carries the largest upstream area in it, so
+    streams stay connected at every level; values stay in native cells.
+    """
+    src_ds = gdal.Open(accum_file)
+    band = src_ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    dst_ds = create_like(src_ds, output_file, gdal.GDT_Float32, nodata=hy.NODATA, factor=factor)
+    dst_band = dst_ds.GetRasterBand(1)
 
-if __name__ == "__main__":
-    pwd = os.getcwd()
-    dem_path = os.path.join(pwd, "dem.tif")
-    output_dir = os.path.join(pwd, "tiles")
+    rows, cols = src_ds.RasterYSize, src_ds.RasterXSize
+    step = max(block_rows // factor, 1) * factor
+    for yoff in range(0, rows, step):
+        data = band.ReadAsArray(0, yoff, cols, min(step, rows - yoff)).astype(np.float64)
+        missing = ~np.isfinite(data)
+        if nodata is not None:
+            missing |= data == nodata
+        data[missing] = -np.inf
+        padded = np.pad(data, ((0, -data.shape[0] % factor), (0, -cols % factor)),
+                        constant_values=-np.inf)
+        coarse = padded.reshape(padded.shape[0] // factor, factor, -1, factor).max(axis=(1, 3))
+        dst_band.WriteArray(np.where(np.isinf(coarse), hy.NODATA, coarse).astype(np.float32),
+                            0, yoff // factor)
+    src_ds = None
+    dst_ds = None
 
-    # Phoenix desert hydrology parameters:
-    # - Lower flow accumulation threshold (500 instead of 1000)
-    # - Influence distance of 1
-    print("Starting Phoenix water accumulation analysis...")
-    print("Note: Using desert-adapted parameters")
+def build_pyramid(output_dir, sigma, num_classes=4, zooms=PYRAMID_ZOOMS, cache=None):
+    """
+    Write coarser class rasters for the low zooms, consistent with the native one
 
-    delineate_basins(dem_path, output_dir, 500, 1)
+    Each level aggregates flow accumulation (aggregate_accumulation) and runs
+    the influence chain on it with sigma scaled to the level's cells. Maxima
+    run higher than the native cells they cover, so each level is stretched
+    with its own statistics, which keeps the native class proportions at
+    every zoom. pyramid/pyramid.json lists the
+    native raster and the levels with their cell sizes, for build_pmtiles.py
+    to pick one per zoom.
 
-    # Reclassify influence
-    print("Reclassifying influence...")
-    input_file = os.path.join(output_dir, "stream_influence.tif")
-    output_file = os.path.join(output_dir, "stream_influence_reclass.tif")
-    reclassify_influence_raster(input_file, output_file, num_classes=4)
+    Parameters:
+    output_dir (str): tiles.py output directory (flow_accum.tif, stream_influence_reclass.tif)
+    sigma (float): Gaussian sigma of the native influence step in native cells
+    num_classes (int): Number of classes, as for reclassify_influence_raster
+    zooms (tuple): (min, max) map zoom the levels are for
+    cache (StageCache): Skip the stage when flow_accum.tif and the settings are unchanged
 
-    # Convert to vector
-    print("Converting to vector format...")
-    vector_file = os.path.join(output_dir, "stream_influence_reclass.shp")
-    convert_raster_to_vector(output_file, vector_file)
+    Returns the manifest path.
+    """
+    accum_file = os.path.join(output_dir, "flow_accum.tif")
+    pyramid_dir = os.path.join(output_dir, "pyramid")
+    manifest_path = os.path.join(pyramid_dir, "pyramid.json")
+    ds = gdal.Open(accum_file)
+    cell_m, lat = cell_size_m(ds)
+    ds = None
+    factors = pyramid_factors(cell_m, lat, zooms)
+
+    outputs = [manifest_path] + [os.path.join(pyramid_dir, name) for factor in factors
+                                 for name in (f"flow_accum_{factor}x.tif",
+                                              f"stream_influence_reclass_{factor}x.tif")]
+    run_stage(cache, "pyramid", [accum_file],
+              {"sigma": sigma, "num_classes": num_classes, "factors": factors},
+              outputs, code_version(__file__, hy.__file__),
+              lambda: _build_pyramid(accum_file, pyramid_dir, manifest_path, sigma, num_classes,
+                                     factors, cell_m, lat))
+    return manifest_path
+
+def _build_pyramid(accum_file, pyramid_dir, manifest_path, sigma, num_classes, factors,
+                   cell_m, lat):
+    os.makedirs(pyramid_dir, exist_ok=True)
+    levels = [{"factor": 1, "path": "../stream_influence_reclass.tif", "cell_size_m": cell_m}]
+    for factor in factors:
+        print(f"  level {factor}x...")
+        accum_level = os.path.join(pyramid_dir, f"flow_accum_{factor}x.tif")
+        classes_level = os.path.join(pyramid_dir, f"stream_influence_reclass_{factor}x.tif")
+        aggregate_accumulation(accum_file, accum_level, factor)
+
+        level_ds = gdal.Open(accum_level)
+        level_band = level_ds.GetRasterBand(1)
+        level_sigma, level_radius = hy.gaussian_radius(sigma / factor)
+        stretch = influence_stretch(level_band, level_sigma, level_radius)
+        classes_ds = create_like(level_ds, classes_level, gdal.GDT_Byte, nodata=0)
+        write_influence(level_band, classes_ds, level_sigma, level_radius, stretch,
+                        edges=class_edges(num_classes))
+        level_ds = None
+        classes_ds = None
+        levels.append({"factor": factor, "path": os.path.basename(classes_level),
+                       "cell_size_m": cell_m * factor})
+
+    with open(manifest_path, "w") as f:
+        json.dump({"latitude": lat, "levels": levels}, f, indent=2)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Phoenix water accumulation analysis")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=None,
+                        help="Hydrology backend (default: whitebox, or numpy with --tiles; numpy "
+                             "runs every stage in-process; whitebox_chain runs the influence chain "
+                             "as the original WhiteboxTools tools)")
+    parser.add_argument("--tiles", type=parse_tiles, default=None,
+                        help="Run tiled across a process pool, e.g. 4 or 4x2 (columns x rows)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes for --tiles (defaults to one per CPU)")
+    parser.add_argument("--force", action="store_true",
+                        help="Recompute every stage even when a cached result matches")
+    parser.add_argument("--no-cache", action="store_true", help="Disable the stage cache")
+    parser.add_argument("--cache-dir", default=".stage_cache", help="Stage cache directory")
+    parser.add_argument("--cache-size", type=float, default=20,
+                        help="Stage cache size limit in GB (least recently used entries are evicted)")
+    parser.add_argument("--profile", metavar="REPORT", default=None,
+                        help="Write a JSON run report with per-stage time, memory and file sizes")
+    parser.add_argument("--profile-stages", metavar="DIR", default=None,
+                        help="Also run each stage under cProfile, dumping .prof files to DIR")
+    parser.add_argument("--no-pyramid", action="store_true",
+                        help="Skip the coarse class rasters for the low map zooms")
+    args = parser.parse_args()
+    if args.tiles is not None and args.backend not in (None, "numpy"):
+        parser.error("--tiles runs the numpy backend; drop --backend or use --backend numpy")
+    backend = args.backend or ("numpy" if args.tiles is not None else "whitebox")
+
+    pwd = os.getcwd()
+    dem_path = os.path.join(pwd, "dem.tif")
+    output_dir = os.path.join(pwd, "tiles")
 
-    print("\nAnalysis complete!")
-    print(f"Vector output: {vector_file}")
-    print("\nNext step: Convert the shapefile to PMTiles using tippecanoe")
+    cache = None
+    if not args.no_cache:
+        cache = StageCache(os.path.join(pwd, args.cache_dir),
+                           max_bytes=int(args.cache_size * 1024 ** 3),
+                           force=args.force)
+
+    report = contextlib.nullcontext()
+    if args.profile or args.profile_stages:
+        report = profiling.RunReport(args.profile, args.profile_stages,
+                                     metadata={"argv": sys.argv, "backend": backend,
+                                               "tiles": args.tiles, "dem": dem_path})
+
+    with report:
+        # Phoenix desert hydrology parameters:
+        # - Lower flow accumulation threshold (500 instead of 1000)
+        # - Influence distance of 1
+        print("Starting Phoenix water accumulation analysis...")
+        print("Note: Using desert-adapted parameters")
+
+        delineate_basins(dem_path, output_dir, 500, 1, backend=backend,
+                         tiles=args.tiles, workers=args.workers, cache=cache)
+
+        # Reclassify influence
+        print("Reclassifying influence...")
+        input_file = os.path.join(output_dir, "stream_influence.tif")
+        output_file = os.path.join(output_dir, "stream_influence_reclass.tif")
+        reclassify_influence_raster(input_file, output_file, num_classes=4, cache=cache)
+
+        if not args.no_pyramid:
+            print("Building the zoom pyramid...")
+            build_pyramid(output_dir, 1 / 4, num_classes=4, cache=cache)
+
+        print("\nAnalysis complete!")
+        print(f"Raster output: {output_file}")
+        print("\nNext step: Build the map tiles with ../water-tile-generation/build_pmtiles.py")
+        if args.profile:
+            print(f"Run report: {args.profile}")
@@ -4,18 +4,46 @@ Fetch historical flood data from NOAA and USGS for Phoenix, AZ
 Converts data to POI GeoJSON format for map display
 """
 
-import requests
+import argparse
+import hashlib
+import importlib.util
 import json
+import os
 from datetime import datetime, timedelta
 import csv
 from io import StringIO
 
+from poi_index import write_poi_index
+from usgs_client import NWISClient
+
 # API Keys (optional - not required for this script as it uses preprocessed data)
 # NOAA API Token: https://www.ncdc.noaa.gov/cdo-web/token
 # USGS API Key: https://apps.nationalmap.gov/apikeys/
 NOAA_TOKEN = os.environ.get("NOAA_TOKEN", "")
 USGS_API_KEY = os.environ.get("USGS_API_KEY", "")
 
+# Columns of the preprocessed events used to build POIs
+NOAA_EVENT_COLUMNS = [
+    'event_id', 'event_type', 'begin_date', 'begin_time', 'end_time',
+    'begin_location', 'end_location', 'begin_lat', 'begin_lon',
+    'event_narrative', 'episode_narrative', 'injuries_direct', 'injuries_indirect',
+    'deaths_direct', 'deaths_indirect', 'damage_property_num', 'damage_crops_num'
+]
+
+# POI properties sampled from the hydrology rasters
+HYDROLOGY_PROPERTIES = ["accum_class", "upstream_cells", "stream_distance_m"]
+
+# sample_hydrology.TILES_DIR, which is only imported (with GDAL) when the rasters exist
+TILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dem", "tiles")
+
+HYDROLOGY_RASTERS = ["flow_accum.tif", "flow_dir.tif", "streams.tif", "stream_influence_reclass.tif"]
+
+# Narrative text is served separately, fetched when a POI is opened
+NARRATIVE_DIR = "../static/narratives"
+
+# Keys and fingerprints of the features in the last pois.json, for --incremental
+POI_STATE_PATH = "pois_state.json"
+
 # Phoenix metro area bounds (matches water accumulation data extent)
 PHOENIX_BOUNDS = {
     "min_lat": 33.25,
@@ -24,26 +52,16 @@ PHOENIX_BOUNDS = {
     "max_lon": -111.85
 }
 
-def fetch_usgs_stream_gauges():
+def fetch_usgs_stream_gauges(client=None):
     """
     Fetch USGS stream gauge sites in Phoenix area
     """
     print("Fetching USGS stream gauge sites...")
-
-    # USGS Site Web Service
-    url = "https://waterservices.usgs.gov/nwis/site/"
-
-    params = {
-        "format": "json",
-        "bBox": f"{PHOENIX_BOUNDS['min_lon']},{PHOENIX_BOUNDS['min_lat']},{PHOENIX_BOUNDS['max_lon']},{PHOENIX_BOUNDS['max_lat']}",
-        "siteType": "ST",  # Stream
-        "siteStatus": "all"
-    }
+    client = client or NWISClient()
 
     try:
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        # USGS Site Web Service
+        data = client.sites(PHOENIX_BOUNDS, site_type="ST")  # Stream
 
         sites = []
         if "value" in data and "timeSeries" in data["value"]:
@@ -64,49 +82,55 @@ def fetch_usgs_stream_gauges():
         return []
 
 
-def fetch_usgs_flood_events(site_no, start_date, end_date):
+def fetch_usgs_flood_events_batch(site_nos, start_date, end_date, client=None):
     """
-    Fetch flood stage exceedance data for a specific USGS site
+    Fetch flood stage exceedance data for many USGS sites at once
+
+    Sites are batched into a few NWIS requests that run concurrently over a
+    pooled session. Returns a dict of site_no -> True when the site has
+    gage height data in the period.
     """
-    url = "https://waterservices.usgs.gov/nwis/iv/"
-
-    params = {
-        "format": "json",
-        "sites": site_no,
-        "startDT": start_date,
-        "endDT": end_date,
-        "parameterCd": "00065",  # Gage height
-        "siteStatus": "all"
-    }
+    client = client or NWISClient()
 
     try:
-        response = requests.get(url, params=params, timeout=30)
-        response.raise_for_status()
-        data = response.json()
+        series = client.instantaneous_values(site_nos, start_date, end_date,
+                                             parameter="00065")  # Gage height
 
         # Check if there's data and if gage height exceeded flood stage
         # This is simplified - in reality you'd compare to NWS flood stage values
-        if "value" in data and "timeSeries" in data["value"]:
-            return True
-
-        return False
+        return {site_no: bool(series.get(site_no)) for site_no in site_nos}
 
     except Exception as e:
-        print(f"Error fetching flood events for {site_no}: {e}")
-        return False
+        print(f"Error fetching flood events for {len(site_nos)} sites: {e}")
+        return {site_no: False for site_no in site_nos}
+
+
+def fetch_usgs_flood_events(site_no, start_date, end_date, client=None):
+    """
+    Fetch flood stage exceedance data for a specific USGS site
+    """
+    return fetch_usgs_flood_events_batch([site_no], start_date, end_date, client)[site_no]
 
 
 def fetch_noaa_storm_events():
     """
-    Load preprocessed NOAA Storm Events from JSON file
+    Load preprocessed NOAA Storm Events
     Data was preprocessed from Maricopa County floods CSV (2000-2021)
+
+    Reads the Parquet output when present and pyarrow is installed, loading
+    only the Phoenix bounding box; falls back to the JSON export.
     """
     print("Loading NOAA Storm Events from preprocessed data...")
 
     try:
         # Load preprocessed flood events
-        with open('noaa_maricopa_floods.json', 'r') as f:
-            raw_events = json.load(f)
+        if os.path.exists('noaa_maricopa_floods.parquet') and importlib.util.find_spec('pyarrow'):
+            from flood_events import read_events, records
+            raw_events = records(read_events('noaa_maricopa_floods.parquet',
+                                             columns=NOAA_EVENT_COLUMNS, bbox=PHOENIX_BOUNDS))
+        else:
+            with open('noaa_maricopa_floods.json', 'r') as f:
+                raw_events = json.load(f)
 
         print(f"  ✓ Loaded {len(raw_events)} events from preprocessed data")
 
@@ -175,76 +199,220 @@ def fetch_noaa_storm_events():
         return []
 
 
-def convert_to_poi_geojson(usgs_sites, noaa_events):
+def text_id(text):
     """
-    Convert flood data to POI GeoJSON format for the map
+    Content address of a narrative ("" when there is no text)
     """
-    print("Converting to GeoJSON format...")
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16] if text else ""
 
-    features = []
 
-    # Add NOAA storm events
+def write_narrative_shards(noaa_events, shard_dir=NARRATIVE_DIR):
+    """
+    Write each distinct narrative once, as <shard_dir>/<text_id>.txt
+
+    Episode narratives shared by several events are stored once. Shards that
+    no event references any more are removed; existing ones are left alone,
+    since their name is their content. Returns the total size in bytes.
+    """
+    texts = {}
     for event in noaa_events:
-        # Create Google search URL for the event
-        search_query = f"{event['event_type']} {event.get('begin_location', '')} Phoenix {event['date']}"
-        google_url = f"https://www.google.com/search?q={search_query.replace(' ', '+')}"
-
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [event["lon"], event["lat"]]
-            },
-            "properties": {
-                "name": event["name"],
-                "neighbourhood": event.get("begin_location", "Phoenix Metro"),
-                "date": event["date"],
-                "url": google_url,
-                "source": event.get("source", "NOAA"),
-                "event_type": event.get("event_type", "Flood"),
-                "narrative": event.get("narrative", ""),
-                "episode_narrative": event.get("episode_narrative", ""),
-                "begin_location": event.get("begin_location", ""),
-                "end_location": event.get("end_location", ""),
-                "begin_time": event.get("begin_time", ""),
-                "end_time": event.get("end_time", ""),
-                "deaths_direct": event.get("deaths_direct", "0"),
-                "deaths_indirect": event.get("deaths_indirect", "0"),
-                "injuries_direct": event.get("injuries_direct", "0"),
-                "injuries_indirect": event.get("injuries_indirect", "0"),
-                "damage_property": event.get("damage_property", "0"),
-                "damage_crops": event.get("damage_crops", "0"),
-                "event_id": event.get("event_id", "")
-            }
+        for key in ("narrative", "episode_narrative"):
+            text = event.get(key, "")
+            if text:
+                texts[text_id(text)] = text
+
+    os.makedirs(shard_dir, exist_ok=True)
+    existing = {name[:-4] for name in os.listdir(shard_dir) if name.endswith(".txt")}
+    for key in texts.keys() - existing:
+        with open(os.path.join(shard_dir, f"{key}.txt"), "w", encoding="utf-8", newline="") as f:
+            f.write(texts[key])
+    for key in existing - texts.keys():
+        os.remove(os.path.join(shard_dir, f"{key}.txt"))
+
+    return sum(len(text.encode("utf-8")) for text in texts.values())
+
+
+def event_to_feature(event):
+    """
+    GeoJSON feature for one NOAA storm event
+    """
+    # Create Google search URL for the event
+    search_query = f"{event['event_type']} {event.get('begin_location', '')} Phoenix {event['date']}"
+    google_url = f"https://www.google.com/search?q={search_query.replace(' ', '+')}"
+
+    feature = {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [event["lon"], event["lat"]]
+        },
+        "properties": {
+            "name": event["name"],
+            "neighbourhood": event.get("begin_location", "Phoenix Metro"),
+            "date": event["date"],
+            "url": google_url,
+            "source": event.get("source", "NOAA"),
+            "event_type": event.get("event_type", "Flood"),
+            "narrative_id": text_id(event.get("narrative", "")),
+            "episode_narrative_id": text_id(event.get("episode_narrative", "")),
+            "begin_location": event.get("begin_location", ""),
+            "end_location": event.get("end_location", ""),
+            "begin_time": event.get("begin_time", ""),
+            "end_time": event.get("end_time", ""),
+            "deaths_direct": event.get("deaths_direct", "0"),
+            "deaths_indirect": event.get("deaths_indirect", "0"),
+            "injuries_direct": event.get("injuries_direct", "0"),
+            "injuries_indirect": event.get("injuries_indirect", "0"),
+            "damage_property": event.get("damage_property", "0"),
+            "damage_crops": event.get("damage_crops", "0"),
+            "event_id": event.get("event_id", "")
         }
-        features.append(feature)
+    }
+    for key in HYDROLOGY_PROPERTIES:
+        if key in event:
+            feature["properties"][key] = event[key]
+    return feature
 
-    # Add USGS gauge sites (for sites with known flooding)
-    for site in usgs_sites[:5]:  # Limit to first 5 for demo
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [site["lon"], site["lat"]]
-            },
-            "properties": {
-                "name": site["name"],
-                "neighbourhood": "USGS Stream Gauge",
-                "date": "2024",
-                "url": f"https://waterdata.usgs.gov/monitoring-location/{site['site_no']}/"
-            }
+
+def site_to_feature(site):
+    """
+    GeoJSON feature for one USGS gauge site
+    """
+    feature = {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [site["lon"], site["lat"]]
+        },
+        "properties": {
+            "name": site["name"],
+            "neighbourhood": "USGS Stream Gauge",
+            "date": "2024",
+            "url": f"https://waterdata.usgs.gov/monitoring-location/{site['site_no']}/"
         }
-        features.append(feature)
+    }
+    for key in HYDROLOGY_PROPERTIES:
+        if key in site:
+            feature["properties"][key] = site[key]
+    return feature
+
+
+def poi_records(usgs_sites, noaa_events):
+    """
+    (key, record, to_feature) for every POI, in output order
+    """
+    records = [(f"noaa:{event['event_id']}", event, event_to_feature) for event in noaa_events]
+
+    # Add USGS gauge sites (for sites with known flooding)
+    records += [(f"usgs:{site['site_no']}", site, site_to_feature)
+                for site in usgs_sites[:5]]  # Limit to first 5 for demo
+    return records
+
+
+def fingerprint(record):
+    """
+    Content hash of a source record
+    """
+    return hashlib.sha256(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+
+def build_version(sample):
+    """
+    Hash of everything besides the records that shapes the features
+
+    Covers this script and, when sampling, the raster sampler, the point
+    index it reads and the hydrology rasters, so a change to any of them
+    invalidates every previously emitted feature.
+    """
+    digest = hashlib.sha256()
+    paths = [__file__]
+    if sample:
+        import point_query
+        import sample_hydrology
+        paths += [sample_hydrology.__file__, point_query.__file__]
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    if sample:
+        for name in HYDROLOGY_RASTERS:
+            stat = os.stat(os.path.join(TILES_DIR, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def build_pois(usgs_sites, noaa_events, output_path, incremental=False,
+               state_path=POI_STATE_PATH):
+    """
+    Build the POI FeatureCollection, reusing features from the previous run
+
+    The state file remembers the key (NOAA event_id or USGS site_no) and
+    source fingerprint of every feature in output_path. With incremental=True
+    only new or changed records are sampled and converted; unchanged ones are
+    copied from the previous output and records that disappeared are dropped.
+    Features are always emitted in full-build order, so the result is
+    byte-identical to a full rebuild.
+
+    Writes output_path and then the state file, each through a temporary file
+    and a rename, so the state never describes an output that was not written.
+    """
+    sample = all(os.path.exists(os.path.join(TILES_DIR, name)) for name in HYDROLOGY_RASTERS)
+    if not sample:
+        print("  ⚠ Hydrology rasters not found, skipping sampling (run dem/tiles.py first)")
+    version = build_version(sample)
+
+    previous = {}
+    if incremental and os.path.exists(state_path) and os.path.exists(output_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        with open(output_path) as f:
+            features = json.load(f)["features"]
+        if state["version"] == version and len(state["keys"]) == len(features):
+            previous = dict(zip(state["keys"], zip(state["fingerprints"], features)))
+
+    # Fingerprint before sampling, which adds properties in place
+    records = poi_records(usgs_sites, noaa_events)
+    fingerprints = [fingerprint(record) for _, record, _ in records]
+    pending = [record for (key, record, _), fp in zip(records, fingerprints)
+               if previous.get(key, (None,))[0] != fp]
+
+    # Relate every new POI to the water accumulation analysis
+    if sample and pending:
+        print(f"Sampling hydrology rasters at {len(pending)} POI locations...")
+        from sample_hydrology import enrich_pois
+        enrich_pois(pending)
+
+    features = []
+    for (key, record, to_feature), fp in zip(records, fingerprints):
+        if previous.get(key, (None,))[0] == fp:
+            features.append(previous[key][1])
+        else:
+            features.append(to_feature(record))
+
+    keys = [key for key, _, _ in records]
+    removed = len(set(previous) - set(keys))
+    print(f"  {len(pending)} new or changed, {len(records) - len(pending)} reused, {removed} removed")
 
     geojson = {
         "type": "FeatureCollection",
         "features": features
     }
+    write_json(output_path, geojson, indent=2)
+    write_json(state_path, {"version": version, "keys": keys, "fingerprints": fingerprints})
 
     return geojson
 
 
-def main():
+def write_json(path, data, **kwargs):
+    """
+    Write JSON to a temporary file and rename it over path
+    """
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, **kwargs)
+    os.replace(tmp, path)
+
+
+def main(incremental=False):
     print("=" * 60)
     print("Phoenix Flood Data Fetcher")
     print("=" * 60)
@@ -253,19 +421,31 @@ def main():
     usgs_sites = fetch_usgs_stream_gauges()
     noaa_events = fetch_noaa_storm_events()
 
-    # Convert to GeoJSON
-    geojson = convert_to_poi_geojson(usgs_sites, noaa_events)
-
-    # Save to file
+    # Convert to GeoJSON and save it
     output_path = "../src/lib/data/pois.json"
-    with open(output_path, 'w') as f:
-        json.dump(geojson, f, indent=2)
+    print("Converting to GeoJSON format...")
+    geojson = build_pois(usgs_sites, noaa_events, output_path, incremental)
+
+    # Narratives are kept out of the core payload
+    narrative_bytes = write_narrative_shards(noaa_events)
+
+    # Marker grouping and per-zoom clusters, so the map only has to look them up
+    index_path = "../src/lib/data/poi_index.json"
+    write_poi_index(geojson, index_path)
 
     print(f"\n✓ Saved {len(geojson['features'])} flood POIs to {output_path}")
+    print(f"✓ Saved marker groups and clusters to {index_path}")
+    print(f"✓ Saved {narrative_bytes / 1024:.0f} KB of narratives to {NARRATIVE_DIR} "
+          f"(pois.json: {os.path.getsize(output_path) / 1024:.0f} KB)")
     print(f"  - USGS sites: {min(5, len(usgs_sites))}")
     print(f"  - NOAA events: {len(noaa_events)}")
     print("\nReload the map to see the flood markers!")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Build the flood POIs for the map")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only process records that are new or changed since the last run")
+    args = parser.parse_args()
+
+    main(args.incremental)
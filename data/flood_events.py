@@ -0,0 +1,149 @@
+"""
+Typed columnar storage for preprocessed flood events
+
+Events are stored as Parquet with proper numeric and date types, one row
+group per written chunk, so readers can load only the columns they need and
+skip row groups by bounding box and date range using the Parquet statistics.
+records() converts a table back to the string-valued dicts of the original
+JSON output, which remains available as an export.
+"""
+
+from datetime import date
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+EVENT_SCHEMA = pa.schema([
+    ('event_id', pa.int64()),
+    ('event_type', pa.dictionary(pa.int8(), pa.string())),
+    ('begin_date', pa.date32()),
+    ('begin_time', pa.int16()),
+    ('end_date', pa.date32()),
+    ('end_time', pa.int16()),
+    ('begin_location', pa.string()),
+    ('end_location', pa.string()),
+    ('begin_lat', pa.float64()),
+    ('begin_lon', pa.float64()),
+    ('end_lat', pa.float64()),
+    ('end_lon', pa.float64()),
+    ('cz_name', pa.dictionary(pa.int16(), pa.string())),
+    ('event_narrative', pa.string()),
+    ('episode_narrative', pa.string()),
+    ('injuries_direct', pa.int32()),
+    ('injuries_indirect', pa.int32()),
+    ('deaths_direct', pa.int32()),
+    ('deaths_indirect', pa.int32()),
+    ('damage_property_num', pa.int64()),
+    ('damage_crops_num', pa.int64()),
+    ('magnitude', pa.float64()),
+    ('magnitude_type', pa.string()),
+])
+
+def _typed(values, field):
+    """
+    Convert a column of strings (blank meaning missing) to the field's type
+    """
+    strings = pa.array([str(v) for v in values], pa.string())
+    if pa.types.is_dictionary(field.type):
+        return strings.dictionary_encode().cast(field.type)
+    if pa.types.is_string(field.type):
+        return strings
+
+    blank = pc.equal(pc.utf8_trim_whitespace(strings), '')
+    strings = pc.if_else(blank, pa.scalar(None, pa.string()), strings)
+    if pa.types.is_date(field.type):
+        # MM/DD/YYYY, as written by the NOAA exports
+        return pc.strptime(strings, format='%m/%d/%Y', unit='s').cast(field.type)
+    if pa.types.is_integer(field.type):
+        return pc.round(strings.cast(pa.float64())).cast(field.type)
+    return strings.cast(field.type)
+
+def to_table(columns):
+    """
+    Build a typed table from string-valued columns (lat/lon may already be floats)
+    """
+    arrays = []
+    for field in EVENT_SCHEMA:
+        values = columns[field.name]
+        if pa.types.is_floating(field.type) and not isinstance(values[0] if len(values) else '', str):
+            arrays.append(pa.array(values, field.type))
+        else:
+            arrays.append(_typed(values, field))
+    return pa.Table.from_arrays(arrays, schema=EVENT_SCHEMA)
+
+class EventWriter:
+    """
+    Stream event chunks into a Parquet file, one row group per chunk
+
+    Use as a context manager; each write() takes string-valued columns as
+    produced by preprocess_noaa_data and appends them as a row group.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self._writer = pq.ParquetWriter(path, EVENT_SCHEMA, compression='zstd')
+
+    def write(self, columns):
+        table = to_table(columns)
+        if table.num_rows:
+            self._writer.write_table(table)
+            self.rows += table.num_rows
+
+    def close(self):
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_events(path, columns=None, bbox=None, start=None, end=None, either_end=False):
+    """
+    Read events, pushing column selection and bbox/date filters into the Parquet scan
+
+    Parameters:
+    path (str): Parquet file written by EventWriter
+    columns (list): Columns to load (default: all)
+    bbox (dict): min_lat, max_lat, min_lon, max_lon on the begin coordinates
+    start (date): First begin_date to keep
+    end (date): Last begin_date to keep
+    either_end (bool): Keep events whose begin or end coordinates fall in bbox
+    """
+    dates = []
+    if start:
+        dates.append(('begin_date', '>=', start))
+    if end:
+        dates.append(('begin_date', '<=', end))
+    if not bbox:
+        return pq.read_table(path, columns=columns, filters=dates or None)
+
+    filters = []
+    for point in ('begin', 'end') if either_end else ('begin',):
+        filters.append([
+            (f'{point}_lat', '>=', bbox['min_lat']), (f'{point}_lat', '<=', bbox['max_lat']),
+            (f'{point}_lon', '>=', bbox['min_lon']), (f'{point}_lon', '<=', bbox['max_lon']),
+        ] + dates)
+    return pq.read_table(path, columns=columns, filters=filters)
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, date):
+        return value.strftime('%m/%d/%Y')
+    if isinstance(value, float):
+        return f"{value:g}"
+    return str(value)
+
+def records(table):
+    """
+    Convert a table to the string-valued event dicts of the JSON export
+
+    Coordinates stay numeric, as in the original JSON.
+    """
+    rows = table.to_pylist()
+    coords = {'begin_lat', 'begin_lon', 'end_lat', 'end_lon'}
+    return [{name: value if name in coords else _text(value) for name, value in row.items()}
+            for row in rows]
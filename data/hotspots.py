@@ -0,0 +1,376 @@
+"""
+Spatio-temporal flood event hotspots on the grid of the dem/tiles.py outputs
+
+Every NOAA event is binned onto the cells under its begin and end
+coordinates, or with --segments onto every cell along the track between
+them, and each event counts once per cell. The whole event set is binned
+with a few vectorised passes: footprint cells are deduplicated per event with
+one sort over (event, cell) keys, and the rasters are the run lengths of the
+sorted (cell), (year, cell) and (month, cell) keys. Only the cells events
+touch are ever held in memory: the rasters are scattered into zeroed windows
+of rows and the class raster is read the same way, so the county grid at
+full resolution needs memory in proportion to the events, not the cells.
+Writes to the output directory:
+- event_count.tif: events touching each cell
+- damage_density.tif: property and crop damage per km², each event's damage
+  spread evenly over the cells it touches
+- event_count_by_year.tif / event_count_by_month.tif: one band per year and
+  per calendar month
+- class_density.csv: event and damage density inside each water
+  accumulation class of stream_influence_reclass.tif, and relative to the
+  whole grid
+- events_by_month.csv: events per year and month, overall and per class
+
+--factor coarsens the rasters (counts deduplicated per coarse cell), while
+the class table is always computed at the native resolution.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from osgeo import gdal, osr
+
+from flood_events import read_events
+from sample_hydrology import TILES_DIR, cell_size_m, to_raster_coords
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "dem"))
+from rasters import create_like, iter_windows
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EVENT_COLUMNS = ["begin_date", "begin_lat", "begin_lon", "end_lat", "end_lon",
+                 "damage_property_num", "damage_crops_num"]
+CLASS_RASTER = "stream_influence_reclass.tif"
+NUM_CLASSES = 4
+# Rows per window when scattering into or reading full-width rasters
+WINDOW_ROWS = 256
+
+def grid_bbox(ds):
+    """
+    WGS84 min_lat, max_lat, min_lon, max_lon of a raster, for read_events
+    """
+    gt = ds.GetGeoTransform()
+    xs = [gt[0], gt[0] + gt[1] * ds.RasterXSize]
+    ys = [gt[3], gt[3] + gt[5] * ds.RasterYSize]
+    corners = [(x, y) for x in xs for y in ys]
+
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for ref in (srs, wgs84):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if not srs.IsSame(wgs84):
+        transform = osr.CoordinateTransformation(srs, wgs84)
+        corners = [point[:2] for point in transform.TransformPoints(corners)]
+
+    lons, lats = zip(*corners)
+    return {"min_lat": min(lats), "max_lat": max(lats), "min_lon": min(lons), "max_lon": max(lons)}
+
+def _numbers(values):
+    """
+    Float array from JSON export values (strings, blank meaning missing, or numbers)
+    """
+    strings = pc.utf8_trim_whitespace(pa.array(["" if v is None else str(v) for v in values],
+                                                pa.string()))
+    strings = pc.if_else(pc.equal(strings, ""), pa.scalar(None, pa.string()), strings)
+    return strings.cast(pa.float64()).to_numpy(zero_copy_only=False)
+
+def load_events(path, bbox=None):
+    """
+    Event columns as NumPy arrays, from the Parquet store or the JSON export
+
+    Returns a dict of begin/end lat/lon (NaN when missing), year and month
+    (0 when the date is missing) and damage (property plus crops, in USD).
+    With a bbox, Parquet reads only the row groups that can hold events
+    starting or ending inside it.
+    """
+    if path.endswith(".parquet"):
+        table = read_events(path, columns=EVENT_COLUMNS, bbox=bbox, either_end=True)
+        columns = {name: table[name] for name in EVENT_COLUMNS}
+        dates = columns.pop("begin_date")
+        events = {name: pc.cast(column, pa.float64()).to_numpy(zero_copy_only=False)
+                  for name, column in columns.items()}
+    else:
+        with open(path) as f:
+            rows = json.load(f)
+        dates = pc.strptime(pa.array([row.get("begin_date") or None for row in rows], pa.string()),
+                            format="%m/%d/%Y", unit="s")
+        events = {name: _numbers([row.get(name, "") for row in rows])
+                  for name in EVENT_COLUMNS[1:]}
+
+    damage = (np.nan_to_num(events.pop("damage_property_num")) +
+              np.nan_to_num(events.pop("damage_crops_num")))
+    events["damage"] = damage
+    events["year"] = pc.fill_null(pc.year(dates), 0).to_numpy(zero_copy_only=False)
+    events["month"] = pc.fill_null(pc.month(dates), 0).to_numpy(zero_copy_only=False)
+    return events
+
+def footprints(ds, events, segments=False):
+    """
+    (event index, flat cell index) of every grid cell each event touches, each pair once
+
+    An event touches the cells under its begin and end coordinates (the
+    begin alone when the end is missing) and, with segments, every cell the
+    straight track between them passes, sampled at least once per cell.
+    """
+    begin_x, begin_y = to_raster_coords(ds, events["begin_lat"], events["begin_lon"])
+    no_end = np.isnan(events["end_lat"]) | np.isnan(events["end_lon"])
+    end_lat = np.where(no_end, events["begin_lat"], events["end_lat"])
+    end_lon = np.where(no_end, events["begin_lon"], events["end_lon"])
+    end_x, end_y = to_raster_coords(ds, end_lat, end_lon)
+
+    gt = ds.GetGeoTransform()
+    begin_col, begin_row = (begin_x - gt[0]) / gt[1], (begin_y - gt[3]) / gt[5]
+    end_col, end_row = (end_x - gt[0]) / gt[1], (end_y - gt[3]) / gt[5]
+
+    located = np.isfinite(begin_col) & np.isfinite(begin_row)
+    ids = np.flatnonzero(located)
+    if segments:
+        # Samples per track: one more than its length in cells, so no cell is skipped
+        length = np.maximum(np.abs(end_col - begin_col), np.abs(end_row - begin_row))[ids]
+        samples = np.ceil(length).astype(np.int64) + 1
+        event = np.repeat(ids, samples)
+        step = np.arange(event.size) - np.repeat(np.cumsum(samples) - samples, samples)
+        t = step / np.maximum(np.repeat(samples, samples) - 1, 1)
+    else:
+        event = np.repeat(ids, 2)
+        t = np.tile([0.0, 1.0], ids.size)
+
+    cols = np.floor(begin_col[event] + t * (end_col[event] - begin_col[event])).astype(np.int64)
+    rows = np.floor(begin_row[event] + t * (end_row[event] - begin_row[event])).astype(np.int64)
+    inside = (rows >= 0) & (rows < ds.RasterYSize) & (cols >= 0) & (cols < ds.RasterXSize)
+
+    cells = ds.RasterXSize
+    keys = _distinct(event[inside] * (ds.RasterYSize * cells) + rows[inside] * cells + cols[inside])
+    return keys // (ds.RasterYSize * cells), keys % (ds.RasterYSize * cells)
+
+def row_areas_km2(ds):
+    """
+    Area of the cells of each raster row in km²
+    """
+    gt = ds.GetGeoTransform()
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    lats = gt[3] + (np.arange(ds.RasterYSize) + 0.5) * gt[5]
+    dy, dx = cell_size_m(gt, srs, lats)
+    return np.broadcast_to(dy * dx / 1e6, lats.shape)
+
+def _coarse_cells(cells, width, factor):
+    rows, cols = np.divmod(cells, width)
+    return rows // factor * -(-width // factor) + cols // factor
+
+def build_hotspots(events_path, output_dir, tiles_dir=TILES_DIR, segments=False, factor=1):
+    """
+    Bin flood events onto the hydrology grid and compare their density across classes
+
+    Parameters:
+    events_path (str): noaa_maricopa_floods.parquet or .json
+    output_dir (str): Directory for the rasters and tables
+    tiles_dir (str): dem/tiles.py output directory (its class raster sets the grid)
+    segments (bool): Also bin the track between each event's begin and end
+    factor (int): Coarsen the rasters by this many cells per side
+
+    Returns the rows of class_density.csv.
+    """
+    start = time.time()
+    os.makedirs(output_dir, exist_ok=True)
+    ds = gdal.Open(os.path.join(tiles_dir, CLASS_RASTER))
+    width, height = ds.RasterXSize, ds.RasterYSize
+
+    events = load_events(events_path, grid_bbox(ds))
+    event, cell = footprints(ds, events, segments)
+    touched = _distinct(event)
+    print(f"{touched.size} of {events['damage'].size} events touch the grid "
+          f"({cell.size} event cells)")
+
+    # Damage spread evenly over each event's cells
+    share = events["damage"][event] / np.bincount(event, minlength=events["damage"].size)[event]
+
+    # Rasters on the (optionally coarsened) grid, as sparse (sorted cells, values)
+    coarse = _coarse_cells(cell, width, factor) if factor > 1 else cell
+    coarse_width = -(-width // factor)
+    num_coarse = coarse_width * -(-height // factor)
+    keys = _distinct(event * num_coarse + coarse)
+    counted = keys % num_coarse
+    _write_sparse(ds, os.path.join(output_dir, "event_count.tif"), [_runs(counted)],
+                  gdal.GDT_Int32, np.int32, factor)
+
+    # Damage per touched coarse cell over its area: summed row areas times
+    # the columns the cell spans
+    order = np.argsort(coarse, kind="stable")
+    starts = _run_starts(coarse[order])
+    damaged = coarse[order][starts]
+    damage = np.add.reduceat(share[order], starts) if starts.size else share[:0]
+    areas = row_areas_km2(ds)
+    coarse_rows, coarse_cols = np.divmod(damaged, coarse_width)
+    cell_areas = (np.bincount(np.arange(height) // factor, weights=areas)[coarse_rows] *
+                  np.minimum(factor, width - coarse_cols * factor))
+    _write_sparse(ds, os.path.join(output_dir, "damage_density.tif"),
+                  [(damaged, damage / cell_areas)], gdal.GDT_Float32, np.float32, factor)
+
+    # Per-year and per-month bands, from the run lengths of (time bin, cell) keys
+    years = events["year"][keys // num_coarse]
+    months = events["month"][keys // num_coarse]
+    dated = years > 0
+    first_year = int(years[dated].min()) if dated.any() else 0
+    labels = list(range(first_year, int(years[dated].max()) + 1)) if dated.any() else []
+    _write_sparse(ds, os.path.join(output_dir, "event_count_by_year.tif"),
+                  _band_runs(years[dated] - first_year, counted[dated], len(labels), num_coarse),
+                  gdal.GDT_Int32, np.int32, factor, [str(year) for year in labels])
+    _write_sparse(ds, os.path.join(output_dir, "event_count_by_month.tif"),
+                  _band_runs(months[dated] - 1, counted[dated], 12, num_coarse),
+                  gdal.GDT_Int32, np.int32, factor, [f"{month:02d}" for month in range(1, 13)])
+
+    # Class comparison at the native resolution, reading the class raster by rows
+    band = ds.GetRasterBand(1)
+    order = np.argsort(cell, kind="stable")
+    sorted_cells = cell[order]
+    class_of = np.zeros(cell.size, dtype=np.int64)
+    class_cells = np.zeros(256, dtype=np.int64)
+    class_area = np.zeros(256)
+    for _, yoff, _, ysize in iter_windows(band, (width, WINDOW_ROWS)):
+        block = band.ReadAsArray(0, yoff, width, ysize)
+        lo, hi = np.searchsorted(sorted_cells, [yoff * width, (yoff + ysize) * width])
+        class_of[order[lo:hi]] = block.ravel()[sorted_cells[lo:hi] - yoff * width]
+        for row, area in zip(block, areas[yoff:yoff + ysize]):
+            counts = np.bincount(row, minlength=256)
+            class_cells += counts
+            class_area += counts * area
+    ds = None
+    num_bins = max(NUM_CLASSES, int(np.flatnonzero(class_cells).max(initial=0))) + 1
+    class_cells, class_area = class_cells[:num_bins], class_area[:num_bins]
+    class_hits = np.bincount(class_of, minlength=num_bins)
+    class_keys = _distinct(event * num_bins + class_of)
+    class_event, class_value = class_keys // num_bins, class_keys % num_bins
+    class_events = np.bincount(class_value, minlength=num_bins)
+    class_damage = np.bincount(class_of, weights=share, minlength=num_bins)
+
+    analysed = np.arange(num_bins) > 0
+    overall_hits = class_hits[analysed].sum() / max(class_area[analysed].sum(), 1e-12)
+    rows = []
+    for value in np.flatnonzero(class_cells * analysed):
+        area = class_area[value]
+        hits_per_km2 = class_hits[value] / area if area else 0.0
+        rows.append({
+            "class": int(value),
+            "cells": int(class_cells[value]),
+            "area_km2": round(float(area), 3),
+            "events": int(class_events[value]),
+            "event_cells": int(class_hits[value]),
+            "event_cells_per_km2": round(float(hits_per_km2), 6),
+            "damage": round(float(class_damage[value]), 2),
+            "damage_per_km2": round(float(class_damage[value] / area if area else 0.0), 2),
+            # Density relative to the analysed area (classes 1 and up)
+            "relative_density": round(float(hits_per_km2 / overall_hits), 4) if overall_hits else 0.0,
+        })
+    _write_csv(os.path.join(output_dir, "class_density.csv"), rows)
+
+    # Events per (year, month), overall and by the classes they touch
+    touched = touched[events["year"][touched] > 0]
+    time_bin = (events["year"][touched] - first_year) * 12 + events["month"][touched] - 1
+    num_times = len(labels) * 12
+    per_month = np.bincount(time_bin, minlength=num_times)
+    month_damage = np.bincount(time_bin, weights=events["damage"][touched], minlength=num_times)
+    dated_class = events["year"][class_event] > 0
+    class_time = ((events["year"][class_event] - first_year) * 12 +
+                  events["month"][class_event] - 1)[dated_class]
+    per_class = np.bincount(class_time * num_bins + class_value[dated_class],
+                            minlength=num_times * num_bins).reshape(num_times, num_bins)
+    month_rows = []
+    for i in np.flatnonzero(per_month):
+        row = {"year": first_year + i // 12, "month": i % 12 + 1, "events": int(per_month[i]),
+               "damage": round(float(month_damage[i]), 2)}
+        row.update({f"class_{value}_events": int(per_class[i, value])
+                    for value in range(1, num_bins)})
+        month_rows.append(row)
+    _write_csv(os.path.join(output_dir, "events_by_month.csv"), month_rows)
+
+    print(f"✓ Wrote hotspots to {output_dir} in {time.time() - start:.1f}s")
+    return rows
+
+def _distinct(keys):
+    """
+    Sorted distinct values of an integer array (a sort and a neighbour
+    comparison, which outpaces np.unique on tens of millions of keys)
+    """
+    keys = np.sort(keys)
+    return keys[_run_starts(keys)]
+
+def _run_starts(keys):
+    """
+    Index where each run of equal values in a sorted array begins
+    """
+    if not keys.size:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+
+def _runs(keys):
+    """
+    Distinct values of an integer array and how often each occurs
+    """
+    keys = np.sort(keys)
+    first = _run_starts(keys)
+    return keys[first], np.diff(np.append(first, keys.size))
+
+def _band_runs(bins, cells, num_bands, num_cells):
+    """
+    Sparse (sorted cells, counts) per band, from the run lengths of (bin, cell) keys
+    """
+    keys, counts = _runs(bins * num_cells + cells)
+    bounds = np.searchsorted(keys, np.arange(num_bands + 1) * num_cells)
+    return [(keys[lo:hi] - i * num_cells, counts[lo:hi])
+            for i, (lo, hi) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+def _write_sparse(template_ds, path, bands, data_type, dtype, factor, descriptions=None):
+    """
+    Write bands given as (sorted flat cells, values), zero elsewhere
+
+    Each band is scattered into one zeroed window of WINDOW_ROWS rows at a
+    time, so no full-grid array is ever allocated.
+    """
+    ds = create_like(template_ds, path, data_type, factor=factor, bands=max(len(bands), 1))
+    width = ds.RasterXSize
+    for i, (cells, values) in enumerate(bands):
+        band = ds.GetRasterBand(i + 1)
+        for _, yoff, _, ysize in iter_windows(band, (width, WINDOW_ROWS)):
+            block = np.zeros(ysize * width, dtype=dtype)
+            lo, hi = np.searchsorted(cells, [yoff * width, (yoff + ysize) * width])
+            block[cells[lo:hi] - yoff * width] = values[lo:hi]
+            band.WriteArray(block.reshape(ysize, width), 0, yoff)
+        if descriptions:
+            band.SetDescription(descriptions[i])
+    ds = None
+
+def _write_csv(path, rows):
+    with open(path, "w", newline="") as f:
+        if rows:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == "__main__":
+    default_events = os.path.join(HERE, "noaa_maricopa_floods.parquet")
+    if not os.path.exists(default_events):
+        default_events = os.path.join(HERE, "noaa_maricopa_floods.json")
+
+    parser = argparse.ArgumentParser(description="Flood event hotspots on the hydrology grid")
+    parser.add_argument("--events", default=default_events,
+                        help="NOAA events, Parquet store or JSON export")
+    parser.add_argument("--tiles-dir", default=TILES_DIR, help="dem/tiles.py output directory")
+    parser.add_argument("--output", default=os.path.join(HERE, "hotspots"), help="Output directory")
+    parser.add_argument("--segments", action="store_true",
+                        help="Also bin the track between each event's begin and end coordinates")
+    parser.add_argument("--factor", type=int, default=1,
+                        help="Coarsen the rasters by this many cells per side")
+    args = parser.parse_args()
+
+    rows = build_hotspots(args.events, args.output, args.tiles_dir, args.segments, args.factor)
+    for row in rows:
+        print(f"  class {row['class']}: {row['events']} events, "
+              f"{row['event_cells_per_km2']:.4f} event cells/km², "
+              f"{row['relative_density']:.2f}x average")
@@ -0,0 +1,201 @@
+"""
+Precomputed marker grouping and per-zoom clustering for the map
+
+The front end shows one marker per POI name. This module computes, once at
+build time:
+- groups: the name -> {links, coordinates, neighborhood} lookup that
+  src/routes/+page.js used to build with a reduce on every load
+- markers: the feature shown for each name (the one with the latest date,
+  as map.ts picked it)
+- clusters: for every zoom from MIN_ZOOM to MAX_ZOOM, the markers merged
+  into clusters of at most CLUSTER_RADIUS screen pixels, each carrying its
+  marker and event counts and summed damage and casualties. Clusters are
+  hierarchical: each zoom's clusters are built from the next zoom's, and
+  list those children. A cluster holding a single marker carries its name.
+"""
+
+import json
+import math
+import re
+
+import numpy as np
+
+# Zoom range of the map (MAP_CONSTANTS.CONFIG in src/lib/components/Map/map.ts)
+MIN_ZOOM = 9
+MAX_ZOOM = 15
+
+# Cluster radius in screen pixels, and MapLibre's world size at zoom 0
+CLUSTER_RADIUS = 60
+TILE_SIZE = 512
+
+AGGREGATES = ["damage_property", "damage_crops", "deaths", "injuries"]
+
+def _leading_int(value):
+    """
+    Integer prefix of a string, like JavaScript's parseInt (None when there is none)
+    """
+    match = re.match(r"\s*([+-]?\d+)", str(value))
+    return int(match.group(1)) if match else None
+
+def _number(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+def group_features(features):
+    """
+    Group features by name, as +page.js did: links by date, first coordinates
+    """
+    groups = {}
+    for feature in features:
+        props = feature["properties"]
+        name = props["name"]
+        if name not in groups:
+            groups[name] = {
+                "links": {},
+                "coordinates": feature["geometry"]["coordinates"],
+                "neighborhood": props.get("neighbourhood")
+            }
+        groups[name]["links"].setdefault(props["date"], []).append(props["url"])
+    return groups
+
+def marker_features(features):
+    """
+    Index of the feature shown for each name, in first-seen order
+
+    A later feature replaces the current one when its date's leading integer
+    is greater, matching the selection map.ts used to make in the browser.
+    """
+    chosen = {}
+    for i, feature in enumerate(features):
+        name = feature["properties"]["name"]
+        if name not in chosen:
+            chosen[name] = i
+            continue
+        current = _leading_int(feature["properties"]["date"])
+        best = _leading_int(features[chosen[name]]["properties"]["date"])
+        if current is not None and (best is None or current > best):
+            chosen[name] = i
+    return chosen
+
+def mercator(lng, lat):
+    """
+    Web Mercator coordinates in [0, 1) world units
+    """
+    x = (np.asarray(lng, dtype=np.float64) + 180.0) / 360.0
+    sin = np.sin(np.radians(np.asarray(lat, dtype=np.float64)))
+    y = 0.5 - 0.25 * np.log((1 + sin) / (1 - sin)) / math.pi
+    return x, np.clip(y, 0.0, 1.0)
+
+def inverse_mercator(x, y):
+    lng = x * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * y))))
+    return lng, lat
+
+def cluster_level(x, y, weights, totals, zoom, radius=CLUSTER_RADIUS):
+    """
+    Merge points into grid clusters of radius screen pixels at a zoom
+
+    Returns (x, y, weights, totals, members) for the clusters, where
+    members[i] lists the indices of the input points in cluster i. Clusters
+    are ordered by grid cell, so the result is deterministic.
+    """
+    cell = radius / (TILE_SIZE * 2 ** zoom)
+    cols = np.floor(x / cell).astype(np.int64)
+    rows = np.floor(y / cell).astype(np.int64)
+    keys = rows * (int(1 / cell) + 2) + cols
+    cells, inverse = np.unique(keys, return_inverse=True)
+
+    n = len(cells)
+    w = np.bincount(inverse, weights=weights, minlength=n)
+    cx = np.bincount(inverse, weights=x * weights, minlength=n) / w
+    cy = np.bincount(inverse, weights=y * weights, minlength=n) / w
+    sums = np.stack([np.bincount(inverse, weights=totals[:, j], minlength=n)
+                     for j in range(totals.shape[1])], axis=1)
+
+    order = np.argsort(inverse, kind="stable")
+    bounds = np.searchsorted(inverse[order], np.arange(n + 1))
+    members = [order[bounds[i]:bounds[i + 1]].tolist() for i in range(n)]
+    return cx, cy, w, sums, members
+
+def build_clusters(features, markers, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM,
+                   radius=CLUSTER_RADIUS):
+    """
+    Per-zoom cluster lists, from max_zoom (clustering markers) down to min_zoom
+    """
+    names = list(markers)
+    if not names:
+        return {str(zoom): [] for zoom in range(min_zoom, max_zoom + 1)}
+
+    # Per-marker event counts and totals over every feature with that name
+    slot = {name: i for i, name in enumerate(names)}
+    events = np.zeros(len(names))
+    totals = np.zeros((len(names), len(AGGREGATES)))
+    for feature in features:
+        props = feature["properties"]
+        i = slot[props["name"]]
+        events[i] += 1
+        totals[i] += [
+            _number(props.get("damage_property")),
+            _number(props.get("damage_crops")),
+            _number(props.get("deaths_direct")) + _number(props.get("deaths_indirect")),
+            _number(props.get("injuries_direct")) + _number(props.get("injuries_indirect")),
+        ]
+
+    coords = np.array([features[markers[name]]["geometry"]["coordinates"] for name in names],
+                      dtype=np.float64)
+    x, y = mercator(coords[:, 0], coords[:, 1])
+    weights = np.ones(len(names))
+    totals = np.column_stack([events, totals])
+    labels = names
+
+    clusters = {}
+    for zoom in range(max_zoom, min_zoom - 1, -1):
+        x, y, weights, totals, members = cluster_level(x, y, weights, totals, zoom, radius)
+        lng, lat = inverse_mercator(x, y)
+        level = []
+        for i, member in enumerate(members):
+            cluster = {
+                "id": f"{zoom}/{i}",
+                "coordinates": [round(float(lng[i]), 6), round(float(lat[i]), 6)],
+                "count": int(weights[i]),
+                "events": int(totals[i, 0]),
+            }
+            for j, key in enumerate(AGGREGATES):
+                cluster[key] = round(float(totals[i, j + 1]), 2)
+            # Marker names at the deepest zoom, child cluster ids above it
+            if zoom == max_zoom:
+                cluster["children"] = [names[m] for m in member]
+            else:
+                cluster["children"] = [f"{zoom + 1}/{m}" for m in member]
+            # A cluster of one is drawn as that marker
+            if len(member) == 1 and labels[member[0]] is not None:
+                cluster["name"] = labels[member[0]]
+            level.append(cluster)
+        clusters[str(zoom)] = level
+        labels = [cluster.get("name") for cluster in level]
+    return clusters
+
+def build_poi_index(geojson, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, radius=CLUSTER_RADIUS):
+    """
+    Grouping, marker selection and clusters for a POI FeatureCollection
+    """
+    features = geojson["features"]
+    markers = marker_features(features)
+    return {
+        "minZoom": min_zoom,
+        "maxZoom": max_zoom,
+        "groups": group_features(features),
+        "markers": markers,
+        "clusters": build_clusters(features, markers, min_zoom, max_zoom, radius),
+    }
+
+def write_poi_index(geojson, output_path):
+    """
+    Write the POI index next to pois.json
+    """
+    index = build_poi_index(geojson)
+    with open(output_path, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    return index
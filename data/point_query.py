@@ -0,0 +1,451 @@
+"""
+Point queries of the hydrology rasters from dem/tiles.py
+
+"How exposed is this address?" is answered from compact, uncompressed copies
+of the tiles.py outputs, written once as .npy files and memory-mapped:
+- flow_accum (float32): upstream cells
+- flow_dir (uint8): WhiteboxTools D8 pointer (0 where there is none)
+- accum_class (uint8): water accumulation class (1-4, 0 outside the analysis)
+- stream_distance (float32): metres to the nearest stream cell, NaN beyond
+  search_radius_m, precomputed with a distance transform
+
+Single lookups go through an LRU cache of WINDOW x WINDOW windows, so repeated
+queries around the same area never touch the page cache. Batches are one
+vectorised gather per raster, in raster order. The index is rebuilt only when
+a source raster changes.
+
+Usage:
+    python point_query.py build
+    python point_query.py query 33.45 -112.07
+    python point_query.py batch points.csv --output exposure.csv
+    python point_query.py serve --port 8765
+
+HTTP endpoints (JSON):
+    GET  /point?lat=..&lon=..          one point
+    POST /points {"lats": [..], "lons": [..]}
+    GET  /catchment?lat=..&lon=..      upstream catchment (see catchment.py);
+                                       &outline=0 for the statistics alone
+    POST /catchments {"lats": [..], "lons": [..], "outline": false}
+    GET  /stats                        index size and window cache hit rate
+"""
+
+import argparse
+import csv
+import functools
+import json
+import math
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from osgeo import gdal, osr
+from scipy.ndimage import distance_transform_edt
+
+from sample_hydrology import TILES_DIR, cell_size_m
+
+INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "point_index")
+# Bump when the index layout changes
+INDEX_VERSION = 1
+
+# (layer, source raster in TILES_DIR, dtype, value for nodata)
+LAYERS = [
+    ("flow_accum", "flow_accum.tif", np.float32, np.nan),
+    ("flow_dir", "flow_dir.tif", np.uint8, 0),
+    ("accum_class", "stream_influence_reclass.tif", np.uint8, 0),
+]
+STREAMS = "streams.tif"
+
+# Rows converted per block while building
+BLOCK_ROWS = 1024
+# Side of the cached windows, and how many are kept
+WINDOW = 256
+CACHE_WINDOWS = 512
+
+def layer_path(index_dir, name):
+    return os.path.join(index_dir, f"{name}.npy")
+
+def _source_stamps(tiles_dir):
+    stamps = {}
+    for filename in [source for _, source, _, _ in LAYERS] + [STREAMS]:
+        stat = os.stat(os.path.join(tiles_dir, filename))
+        stamps[filename] = [stat.st_size, stat.st_mtime_ns]
+    return stamps
+
+def _copy_layer(source, output, dtype, fill):
+    """
+    Copy a single-band raster into an uncompressed .npy, with nodata as fill
+    """
+    ds = gdal.Open(source)
+    band = ds.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    out = np.lib.format.open_memmap(output, mode="w+", dtype=dtype,
+                                    shape=(ds.RasterYSize, ds.RasterXSize))
+    for row in range(0, ds.RasterYSize, BLOCK_ROWS):
+        rows = min(BLOCK_ROWS, ds.RasterYSize - row)
+        data = band.ReadAsArray(0, row, ds.RasterXSize, rows)
+        missing = ~np.isfinite(data) if np.issubdtype(data.dtype, np.floating) else np.zeros(data.shape, bool)
+        if nodata is not None:
+            missing |= data == nodata
+        if np.issubdtype(dtype, np.integer):
+            missing |= (data < 0) | (data > np.iinfo(dtype).max)
+        block = data.astype(dtype)
+        block[missing] = fill
+        out[row:row + rows] = block
+    out.flush()
+    return out.shape
+
+def _stream_distance(source, output, cell_y, cell_x, search_radius_m):
+    """
+    Distance in metres to the nearest stream cell, NaN beyond search_radius_m
+
+    Computed in row blocks with a margin of the search radius, so the whole
+    raster is never held in memory.
+    """
+    ds = gdal.Open(source)
+    band = ds.GetRasterBand(1)
+    height, width = ds.RasterYSize, ds.RasterXSize
+    margin = int(math.ceil(search_radius_m / cell_y))
+    out = np.lib.format.open_memmap(output, mode="w+", dtype=np.float32, shape=(height, width))
+    for row in range(0, height, BLOCK_ROWS):
+        rows = min(BLOCK_ROWS, height - row)
+        top = max(row - margin, 0)
+        bottom = min(row + rows + margin, height)
+        streams = band.ReadAsArray(0, top, width, bottom - top) == 1
+        if streams.any():
+            distance = distance_transform_edt(~streams, sampling=(cell_y, cell_x))
+            block = distance[row - top:row - top + rows].astype(np.float32)
+            block[block > search_radius_m] = np.nan
+        else:
+            block = np.full((rows, width), np.nan, dtype=np.float32)
+        out[row:row + rows] = block
+    out.flush()
+
+def build_index(tiles_dir=TILES_DIR, index_dir=INDEX_DIR, search_radius_m=5000.0, force=False):
+    """
+    Write the memory-mappable copies of the tiles.py rasters
+
+    Does nothing when the index was built from the same source files and
+    settings. Returns the index metadata.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    meta_path = os.path.join(index_dir, "meta.json")
+    stamps = _source_stamps(tiles_dir)
+    if not force and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if (meta.get("version") == INDEX_VERSION and meta.get("sources") == stamps
+                and meta.get("search_radius_m") == search_radius_m):
+            return meta
+
+    ds = gdal.Open(os.path.join(tiles_dir, LAYERS[0][1]))
+    gt = ds.GetGeoTransform()
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    cell_y, cell_x = cell_size_m(gt, srs, gt[3] + gt[5] * ds.RasterYSize / 2)
+
+    for name, source, dtype, fill in LAYERS:
+        print(f"Indexing {source}...")
+        _copy_layer(os.path.join(tiles_dir, source), layer_path(index_dir, name), dtype, fill)
+    print(f"Computing stream distances (up to {search_radius_m:g} m)...")
+    _stream_distance(os.path.join(tiles_dir, STREAMS), layer_path(index_dir, "stream_distance"),
+                     float(cell_y), float(cell_x), search_radius_m)
+
+    meta = {
+        "version": INDEX_VERSION,
+        "shape": [ds.RasterYSize, ds.RasterXSize],
+        "geotransform": list(gt),
+        "projection": ds.GetProjection(),
+        "cell_size_m": [float(cell_y), float(cell_x)],
+        "search_radius_m": search_radius_m,
+        "sources": stamps,
+    }
+    # Metadata last, so an interrupted build is never mistaken for a complete one
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def lonlat_transform(projection):
+    """
+    Function mapping lon/lat arrays to the raster's (x, y), or None when it is WGS84 already
+    """
+    srs = osr.SpatialReference(wkt=projection)
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for ref in (srs, wgs84):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if srs.IsSame(wgs84):
+        return None
+    transform = osr.CoordinateTransformation(wgs84, srs)
+
+    def to_raster(lons, lats):
+        points = np.array(transform.TransformPoints(np.column_stack([lons, lats])))
+        return points[:, 0], points[:, 1]
+    return to_raster
+
+def _json_value(value):
+    if isinstance(value, (float, np.floating)):
+        return None if math.isnan(value) else round(float(value), 3)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+class PointIndex:
+    """
+    Memory-mapped lookups of accumulation class, upstream cells and stream distance
+
+    Parameters:
+    index_dir (str): Directory written by build_index
+    window (int): Side of the cached windows in cells
+    cache_windows (int): Windows kept in the LRU cache
+    """
+
+    def __init__(self, index_dir=INDEX_DIR, window=WINDOW, cache_windows=CACHE_WINDOWS):
+        with open(os.path.join(index_dir, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.index_dir = index_dir
+        self.names = [name for name, _, _, _ in LAYERS] + ["stream_distance"]
+        self.layers = {name: np.load(layer_path(index_dir, name), mmap_mode="r")
+                       for name in self.names}
+        self.rows, self.cols = self.meta["shape"]
+        self.geotransform = self.meta["geotransform"]
+        cell_y, cell_x = self.meta["cell_size_m"]
+        self.cell_area_km2 = cell_y * cell_x / 1e6
+        self._to_raster = lonlat_transform(self.meta["projection"])
+        self.window = window
+        self._window = functools.lru_cache(maxsize=cache_windows)(self._read_window)
+
+    def cells(self, lats, lons):
+        """
+        (rows, cols, inside) of points given as lat/lon arrays
+        """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        xs, ys = (lons, lats) if self._to_raster is None else self._to_raster(lons, lats)
+        gt = self.geotransform
+        cols = np.floor((xs - gt[0]) / gt[1]).astype(np.int64)
+        rows = np.floor((ys - gt[3]) / gt[5]).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        return rows, cols, inside
+
+    def _read_window(self, wy, wx):
+        y, x = wy * self.window, wx * self.window
+        return {name: np.array(layer[y:y + self.window, x:x + self.window])
+                for name, layer in self.layers.items()}
+
+    def _result(self, lat, lon, values, row=None, col=None):
+        accum = values.get("flow_accum", np.nan)
+        return {
+            "lat": float(lat),
+            "lon": float(lon),
+            "row": row,
+            "col": col,
+            "accum_class": _json_value(values.get("accum_class", 0)),
+            "upstream_cells": None if np.isnan(accum) else int(accum),
+            "upstream_area_km2": None if np.isnan(accum) else round(float(accum) * self.cell_area_km2, 4),
+            "stream_distance_m": _json_value(values.get("stream_distance", np.nan)),
+            "flow_dir": _json_value(values.get("flow_dir", 0)),
+        }
+
+    def query(self, lat, lon):
+        """
+        Hydrology at one point, served from the window cache
+        """
+        rows, cols, inside = self.cells([lat], [lon])
+        if not inside[0]:
+            return self._result(lat, lon, {})
+        row, col = int(rows[0]), int(cols[0])
+        block = self._window(row // self.window, col // self.window)
+        r, c = row % self.window, col % self.window
+        return self._result(lat, lon, {name: block[name][r, c] for name in self.names}, row, col)
+
+    def query_many(self, lats, lons):
+        """
+        Hydrology at many points as arrays (NaN / 0 outside the rasters)
+        """
+        rows, cols, inside = self.cells(lats, lons)
+        flat = rows[inside] * self.cols + cols[inside]
+        # Gather in raster order so the memory map is read sequentially
+        order = np.argsort(flat, kind="stable")
+        flat_sorted = flat[order]
+
+        result = {}
+        for name in self.names:
+            layer = self.layers[name]
+            values = np.zeros(inside.shape, dtype=layer.dtype)
+            if np.issubdtype(layer.dtype, np.floating):
+                values[:] = np.nan
+            gathered = np.empty(flat.shape, dtype=layer.dtype)
+            gathered[order] = layer.reshape(-1)[flat_sorted]
+            values[inside] = gathered
+            result[name] = values
+
+        accum = result.pop("flow_accum")
+        return {
+            "accum_class": result["accum_class"],
+            "upstream_cells": accum,
+            "upstream_area_km2": accum * self.cell_area_km2,
+            "stream_distance_m": result["stream_distance"],
+            "flow_dir": result["flow_dir"],
+        }
+
+    def stats(self):
+        info = self._window.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            "shape": self.meta["shape"],
+            "cell_size_m": self.meta["cell_size_m"],
+            "windows_cached": info.currsize,
+            "window_hit_rate": round(info.hits / lookups, 4) if lookups else None,
+        }
+
+def batch_to_json(result):
+    """
+    query_many result as JSON-ready lists (NaN as null)
+    """
+    out = {}
+    for name, values in result.items():
+        if np.issubdtype(values.dtype, np.floating):
+            out[name] = [None if math.isnan(v) else round(v, 3) for v in values.tolist()]
+        else:
+            out[name] = values.tolist()
+    return out
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints over a PointIndex (and a CatchmentEngine when one is built)
+    """
+
+    index = None
+    catchments = None
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_points(self):
+        """
+        (lats, lons, body) of a JSON request body
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if "points" in body:
+            points = np.asarray(body["points"], dtype=np.float64).reshape(-1, 2)
+            return points[:, 0], points[:, 1], body
+        return (np.asarray(body["lats"], dtype=np.float64),
+                np.asarray(body["lons"], dtype=np.float64), body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        try:
+            if url.path == "/stats":
+                return self._send(200, self.index.stats())
+            if url.path in ("/point", "/catchment"):
+                lat, lon = float(params["lat"][0]), float(params["lon"][0])
+                if url.path == "/point":
+                    return self._send(200, self.index.query(lat, lon))
+                if self.catchments is None:
+                    return self._send(404, {"error": "no catchment index; run catchment.py build"})
+                outline = params.get("outline", ["1"])[0].lower() not in ("0", "false")
+                return self._send(200, self.catchments.trace(lat, lon, outline=outline))
+        except (KeyError, ValueError) as e:
+            return self._send(400, {"error": f"bad query: {e}"})
+        self._send(404, {"error": f"unknown endpoint {url.path}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        try:
+            if url.path == "/points":
+                lats, lons, _ = self._read_points()
+                return self._send(200, batch_to_json(self.index.query_many(lats, lons)))
+            if url.path == "/catchments":
+                if self.catchments is None:
+                    return self._send(404, {"error": "no catchment index; run catchment.py build"})
+                lats, lons, body = self._read_points()
+                outline = bool(body.get("outline", True))
+                return self._send(200, {"catchments": self.catchments.trace_many(lats, lons,
+                                                                                 outline=outline)})
+        except (KeyError, ValueError, TypeError) as e:
+            return self._send(400, {"error": f"bad request: {e}"})
+        self._send(404, {"error": f"unknown endpoint {url.path}"})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(index, host="127.0.0.1", port=8765, catchments=None):
+    QueryHandler.index = index
+    QueryHandler.catchments = catchments
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"Serving point queries on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def _open_catchments(index_dir):
+    from catchment import CatchmentEngine, flow_index_exists
+    if not flow_index_exists(index_dir):
+        print("No catchment index found; /catchment endpoints are disabled "
+              "(run python catchment.py build)")
+        return None
+    return CatchmentEngine(index_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Point queries of the water accumulation rasters")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Build the memory-mapped index from tiles.py outputs")
+    build.add_argument("--tiles-dir", default=TILES_DIR)
+    build.add_argument("--search-radius", type=float, default=5000.0,
+                       help="Stream distances beyond this many metres are left empty")
+    build.add_argument("--force", action="store_true")
+
+    query = commands.add_parser("query", help="Look up one point")
+    query.add_argument("lat", type=float)
+    query.add_argument("lon", type=float)
+
+    batch = commands.add_parser("batch", help="Look up every lat,lon row of a CSV")
+    batch.add_argument("input", help="CSV with lat and lon columns")
+    batch.add_argument("--output", default=None, help="CSV to write (defaults to stdout)")
+
+    server = commands.add_parser("serve", help="Serve JSON endpoints over HTTP")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        meta = build_index(args.tiles_dir, args.index_dir, args.search_radius, args.force)
+        print(f"Index ready in {args.index_dir}: {meta['shape'][1]}x{meta['shape'][0]} cells")
+    elif args.command == "query":
+        print(json.dumps(PointIndex(args.index_dir).query(args.lat, args.lon), indent=2))
+    elif args.command == "batch":
+        with open(args.input, newline="") as f:
+            rows = list(csv.DictReader(f))
+        index = PointIndex(args.index_dir)
+        start = time.perf_counter()
+        result = index.query_many([float(row["lat"]) for row in rows],
+                                  [float(row["lon"]) for row in rows])
+        elapsed = time.perf_counter() - start
+        columns = batch_to_json(result)
+        for i, row in enumerate(rows):
+            row.update({name: values[i] for name, values in columns.items()})
+
+        out = open(args.output, "w", newline="") if args.output else None
+        writer = csv.DictWriter(out or sys.stdout,
+                                fieldnames=list(rows[0]) if rows else ["lat", "lon"])
+        writer.writeheader()
+        writer.writerows(rows)
+        if out:
+            out.close()
+            print(f"{len(rows)} points in {elapsed:.3f}s -> {args.output}")
+    else:
+        serve(PointIndex(args.index_dir), args.host, args.port, _open_catchments(args.index_dir))
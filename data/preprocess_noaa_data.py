@@ -5,10 +5,61 @@ Filters to flood/flash flood events with valid lat/lon coordinates
 Output: clean JSON file with filtered flood events
 """
 
+import argparse
 import csv
 import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from flood_events import EventWriter, read_events, records
+
+# Bytes of CSV parsed at once when streaming the national detail files
+CSV_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Output schema shared by both input formats, in output order
+EVENT_FIELDS = [
+    'event_id', 'event_type', 'begin_date', 'begin_time', 'end_date', 'end_time',
+    'begin_location', 'end_location', 'begin_lat', 'begin_lon', 'end_lat', 'end_lon',
+    'cz_name', 'event_narrative', 'episode_narrative', 'injuries_direct',
+    'injuries_indirect', 'deaths_direct', 'deaths_indirect', 'damage_property_num',
+    'damage_crops_num', 'magnitude', 'magnitude_type'
+]
+COORD_FIELDS = ['begin_lat', 'begin_lon', 'end_lat', 'end_lon']
+
+# Storm Events detail file column for each output field that is copied as-is
+DETAIL_COLUMNS = {
+    'event_id': 'EVENT_ID',
+    'event_type': 'EVENT_TYPE',
+    'begin_time': 'BEGIN_TIME',
+    'end_time': 'END_TIME',
+    'begin_location': 'BEGIN_LOCATION',
+    'end_location': 'END_LOCATION',
+    'event_narrative': 'EVENT_NARRATIVE',
+    'episode_narrative': 'EPISODE_NARRATIVE',
+    'injuries_direct': 'INJURIES_DIRECT',
+    'injuries_indirect': 'INJURIES_INDIRECT',
+    'deaths_direct': 'DEATHS_DIRECT',
+    'deaths_indirect': 'DEATHS_INDIRECT',
+    'magnitude': 'MAGNITUDE',
+    'magnitude_type': 'MAGNITUDE_TYPE',
+}
+
+# Every detail-file column read by the ingest
+DETAIL_READ_COLUMNS = sorted(set(DETAIL_COLUMNS.values()) | {field.upper() for field in COORD_FIELDS} | {
+    'STATE', 'CZ_TYPE', 'CZ_NAME', 'BEGIN_YEARMONTH', 'BEGIN_DAY', 'END_YEARMONTH', 'END_DAY',
+    'DAMAGE_PROPERTY', 'DAMAGE_CROPS',
+})
+
+# Damage in the detail files is written like "10.00K"
+DAMAGE_MULTIPLIERS = {'K': 1e3, 'M': 1e6, 'B': 1e9}
+
 def parse_maricopa_floods(csv_path):
     """
     Parse Maricopa County floods CSV and extract events with valid coordinates
@@ -79,43 +130,280 @@ def parse_maricopa_floods(csv_path):
     return events
 
 
-def main():
+def iter_detail_batches(path, block_size=CSV_BLOCK_BYTES):
+    """
+    Stream a detail file (optionally gzipped) as record batches of string columns
+
+    Only the columns the filter and the output need are converted. Blank
+    fields are empty strings, rows with the wrong number of fields
+    (truncated files) are skipped, and UTF-8 is not validated here; text
+    that is kept is decoded leniently by filter_detail_batch.
+    """
+    reader = pa_csv.open_csv(
+        path,
+        read_options=pa_csv.ReadOptions(block_size=block_size),
+        parse_options=pa_csv.ParseOptions(newlines_in_values=True,
+                                          invalid_row_handler=lambda row: 'skip'),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=DETAIL_READ_COLUMNS,
+            column_types={name: pa.string() for name in DETAIL_READ_COLUMNS},
+            strings_can_be_null=False,
+            check_utf8=False,
+        ),
+    )
+    for batch in reader:
+        yield batch
+
+
+def to_float(values):
+    """
+    Parse strings as float64, with blanks and malformed values as NaN
+    """
+    values = np.asarray(values, dtype=str)
+    out = np.full(values.shape, np.nan)
+    filled = values != ''
+    try:
+        out[filled] = values[filled].astype(np.float64)
+    except ValueError:
+        for i in np.flatnonzero(filled):
+            try:
+                out[i] = float(values[i])
+            except ValueError:
+                pass
+    return out
+
+
+def parse_damage(values):
+    """
+    Convert detail-file damage strings ("10.00K", "1.5M", "0") to whole-dollar strings
+    """
+    values = np.char.upper(np.char.strip(np.asarray(values, dtype=str)))
+    suffix = np.array([v[-1:] for v in values])
+    multiplier = np.ones(values.shape)
+    for letter, factor in DAMAGE_MULTIPLIERS.items():
+        multiplier[suffix == letter] = factor
+    has_suffix = multiplier != 1
+    amount = to_float(np.where(has_suffix, np.char.rstrip(values, 'KMB'), values))
+    amount = np.nan_to_num(amount * multiplier)
+    return np.array([str(int(round(a))) for a in amount], dtype=object)
+
+
+def detail_dates(yearmonth, day):
+    """
+    BEGIN_YEARMONTH/BEGIN_DAY columns as MM/DD/YYYY strings
+    """
+    yearmonth = np.asarray(yearmonth, dtype=str)
+    day = np.char.zfill(np.asarray(day, dtype=str), 2)
+    dates = np.char.add(np.char.add(np.char.add(np.char.add(
+        [ym[4:6] for ym in yearmonth], '/'), day), '/'), [ym[:4] for ym in yearmonth])
+    return dates.astype(object)
+
+
+def valid_coordinates(columns):
+    """
+    Mask of events with all four coordinates present, non-zero and in range
+    """
+    lat = [columns['begin_lat'], columns['end_lat']]
+    lon = [columns['begin_lon'], columns['end_lon']]
+    mask = np.ones(len(lat[0]), dtype=bool)
+    for values in lat + lon:
+        mask &= np.isfinite(values) & (values != 0)
+    mask &= (np.abs(columns['begin_lat']) <= 90) & (np.abs(columns['begin_lon']) <= 180)
+    return mask
+
+
+def filter_detail_batch(batch, state, county, event_types):
+    """
+    Filter one detail-file record batch into output columns
+
+    The event type, state and county filters run in Arrow over the whole
+    batch; only the surviving rows are converted to Python strings and
+    parsed into coordinates, dates and damage values.
+    """
+    if not batch.num_rows:
+        return None
+
+    mask = pc.is_in(batch['EVENT_TYPE'], value_set=pa.array(list(event_types), pa.string()))
+    if state:
+        mask = pc.and_(mask, pc.equal(pc.ascii_upper(batch['STATE']), state.upper()))
+    if county:
+        mask = pc.and_(mask, pc.equal(pc.ascii_upper(batch['CZ_NAME']), county.upper()))
+    kept = batch.filter(mask)
+    if not kept.num_rows:
+        return None
+
+    def take(name):
+        # Invalid UTF-8 in the matching rows is replaced rather than failing the file
+        values = kept[name].cast(pa.binary()).to_pylist()
+        return np.array([value.decode('utf-8', 'replace') for value in values], dtype=object)
+
+    columns = {field: take(column) for field, column in DETAIL_COLUMNS.items()}
+    for field in COORD_FIELDS:
+        columns[field] = to_float(take(field.upper()))
+    columns['begin_date'] = detail_dates(take('BEGIN_YEARMONTH'), take('BEGIN_DAY'))
+    columns['end_date'] = detail_dates(take('END_YEARMONTH'), take('END_DAY'))
+    cz_type = np.asarray(take('CZ_TYPE'), dtype=str)
+    columns['cz_name'] = np.where(cz_type == 'C', np.char.add(np.asarray(take('CZ_NAME'), dtype=str), ' CO.'),
+                                  take('CZ_NAME')).astype(object)
+    columns['damage_property_num'] = parse_damage(take('DAMAGE_PROPERTY'))
+    columns['damage_crops_num'] = parse_damage(take('DAMAGE_CROPS'))
+
+    valid = valid_coordinates(columns)
+    return {field: columns[field][valid] for field in EVENT_FIELDS}
+
+
+def concat_columns(parts):
+    """
+    Concatenate columnar chunks, returning an empty table when there are none
+    """
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return {field: np.array([], dtype=np.float64 if field in COORD_FIELDS else object)
+                for field in EVENT_FIELDS}
+    return {field: np.concatenate([part[field] for part in parts]) for field in EVENT_FIELDS}
+
+
+def ingest_detail_file(path, state='ARIZONA', county='MARICOPA',
+                       event_types=('Flood', 'Flash Flood'), block_size=CSV_BLOCK_BYTES):
+    """
+    Stream one NOAA Storm Events detail file (optionally gzipped) into filtered columns
+
+    Returns (columns, total_rows, seconds). Memory is bounded by block_size
+    plus the matching events, whatever the size of the file.
+    """
+    start = time.perf_counter()
+    total_rows = 0
+    parts = []
+    for batch in iter_detail_batches(path, block_size):
+        total_rows += batch.num_rows
+        parts.append(filter_detail_batch(batch, state, county, event_types))
+    return concat_columns(parts), total_rows, time.perf_counter() - start
+
+
+def _ingest_job(job):
+    path, state, county, event_types, block_size = job
+    return ingest_detail_file(path, state, county, event_types, block_size)
+
+
+def iter_storm_events(paths, state='ARIZONA', county='MARICOPA',
+                      event_types=('Flood', 'Flash Flood'), workers=None,
+                      block_size=CSV_BLOCK_BYTES):
+    """
+    Ingest several yearly detail files in parallel, one process per file
+
+    Yields each file's matching events as columns (dict of arrays in
+    EVENT_FIELDS order) sorted by event ID, in the order of paths, so they
+    can be written out as they arrive.
+    """
+    print(f"Streaming {len(paths)} Storm Events detail files...")
+    start = time.perf_counter()
+    jobs = [(path, state, county, tuple(event_types), block_size) for path in paths]
+
+    total_rows = 0
+    total_events = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for path, (columns, rows, seconds) in zip(paths, executor.map(_ingest_job, jobs)):
+            matched = len(columns['event_id'])
+            print(f"  {os.path.basename(path)}: {rows} rows, {matched} events "
+                  f"({rows / max(seconds, 1e-9):,.0f} rows/s)")
+            total_rows += rows
+            total_events += matched
+
+            order = np.argsort(columns['event_id'].astype(np.int64), kind='stable')
+            yield {field: values[order] for field, values in columns.items()}
+
+    elapsed = time.perf_counter() - start
+    print(f"  Total rows: {total_rows}")
+    print(f"  Valid events: {total_events}")
+    print(f"  Throughput: {total_rows / max(elapsed, 1e-9):,.0f} rows/s over {elapsed:.1f}s")
+
+
+def ingest_storm_events(paths, **kwargs):
+    """
+    Ingest detail files into one set of columns, sorted by event ID
+    """
+    events = concat_columns(iter_storm_events(paths, **kwargs))
+    order = np.argsort(events['event_id'].astype(np.int64), kind='stable')
+    return {field: values[order] for field, values in events.items()}
+
+
+def records_to_columns(events):
+    """
+    Convert event dicts (as returned by parse_maricopa_floods) to columns
+    """
+    return {field: np.array([event[field] for event in events],
+                            dtype=np.float64 if field in COORD_FIELDS else object)
+            for field in EVENT_FIELDS}
+
+
+def columns_to_records(columns):
+    """
+    Convert columnar events to the list of dicts written to JSON
+    """
+    fields = list(columns)
+    values = [columns[field].tolist() for field in fields]
+    return [dict(zip(fields, row)) for row in zip(*values)]
+
+
+def main(detail_files=None, workers=None, formats=('parquet',)):
     print("=" * 60)
     print("NOAA Storm Events Data Preprocessor")
     print("Processing Maricopa County flood data...")
     print("=" * 60)
 
-    # Path to the CSV file (in project data directory)
-    csv_path = 'floods_maricopa_2000yr.csv'
+    if detail_files:
+        # Full StormEvents_details-*.csv.gz dumps from NCEI
+        chunks = iter_storm_events(detail_files, workers=workers)
+    else:
+        # Path to the CSV file (in project data directory)
+        csv_path = 'floods_maricopa_2000yr.csv'
 
-    all_events = parse_maricopa_floods(csv_path)
+        chunks = [records_to_columns(parse_maricopa_floods(csv_path))]
 
-    # Save to JSON
-    output_file = 'noaa_maricopa_floods.json'
-    with open(output_file, 'w') as f:
-        json.dump(all_events, f, indent=2)
+    # Stream each chunk into the typed columnar file as it arrives
+    output_file = 'noaa_maricopa_floods.parquet'
+    with EventWriter(output_file) as writer:
+        for columns in chunks:
+            writer.write(columns)
+
+    # Summary columns are read before any format that was not asked for is dropped
+    summary = read_events(output_file, columns=['event_type', 'begin_date'])
+
+    outputs = [output_file]
+    if 'json' in formats:
+        json_file = 'noaa_maricopa_floods.json'
+        with open(json_file, 'w') as f:
+            json.dump(records(read_events(output_file)), f, indent=2)
+        outputs.append(json_file)
+    if 'parquet' not in formats:
+        os.remove(output_file)
+        outputs.remove(output_file)
 
     print("\n" + "=" * 60)
-    print(f"✓ Processed {len(all_events)} total flood events")
-    print(f"✓ Saved to {output_file}")
+    print(f"✓ Processed {writer.rows} total flood events")
+    print(f"✓ Saved to {', '.join(outputs)}")
     print("=" * 60)
 
     # Print summary stats
-    if all_events:
-        event_types = {}
-        for event in all_events:
-            etype = event['event_type']
-            event_types[etype] = event_types.get(etype, 0) + 1
-
+    if summary.num_rows:
         print("\nEvent type breakdown:")
-        for etype, count in sorted(event_types.items()):
-            print(f"  {etype}: {count} events")
+        counts = pc.value_counts(summary['event_type'].combine_chunks().dictionary_decode())
+        for item in sorted(counts.to_pylist(), key=lambda c: c['values']):
+            print(f"  {item['values']}: {item['counts']} events")
 
         # Show date range
-        dates = [e['begin_date'] for e in all_events if e['begin_date']]
-        if dates:
-            print(f"\nDate range: {min(dates)} to {max(dates)}")
+        dates = summary['begin_date'].drop_null()
+        if len(dates):
+            print(f"\nDate range: {pc.min(dates).as_py()} to {pc.max(dates).as_py()}")
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Preprocess NOAA Storm Events flood data")
+    parser.add_argument("detail_files", nargs="*",
+                        help="StormEvents_details-*.csv.gz files (default: the pre-filtered Maricopa CSV)")
+    parser.add_argument("--workers", type=int, default=None, help="Files processed in parallel")
+    parser.add_argument("--format", nargs="+", choices=["parquet", "json"], default=["parquet"],
+                        help="Output formats (JSON is the legacy, string-valued export)")
+    args = parser.parse_args()
+
+    main(args.detail_files, args.workers, args.format)
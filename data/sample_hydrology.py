@@ -0,0 +1,104 @@
+"""
+Sample the hydrology rasters from dem/tiles.py at flood event locations
+
+Points are looked up in the memory-mapped index of point_query.py, one
+vectorised gather per layer, so only the pages under the points are read and
+stream distances come precomputed. The index is built on first use and
+rebuilt only when a source raster changes. Attaches to each POI:
+- accum_class: water accumulation class (1-4, 0 outside the analysis)
+- upstream_cells: flow accumulation (number of upstream cells)
+- stream_distance_m: distance to the nearest stream cell in metres
+"""
+
+import os
+
+import numpy as np
+from osgeo import osr
+
+# Hydrology outputs of dem/tiles.py
+TILES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dem", "tiles")
+
+METRES_PER_DEGREE = 111320.0
+
+def cell_size_m(geotransform, srs, lat):
+    """
+    (row, column) cell size in metres at a latitude
+    """
+    dy, dx = abs(geotransform[5]), abs(geotransform[1])
+    if srs.IsGeographic():
+        return dy * METRES_PER_DEGREE, dx * METRES_PER_DEGREE * np.cos(np.radians(lat))
+    return dy, dx
+
+def to_raster_coords(ds, lats, lons):
+    """
+    Convert lat/lon arrays to the raster's (x, y) coordinates
+    """
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for ref in (srs, wgs84):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if srs.IsSame(wgs84):
+        return np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64)
+
+    transform = osr.CoordinateTransformation(wgs84, srs)
+    points = np.array(transform.TransformPoints(np.column_stack([lons, lats])))
+    return points[:, 0], points[:, 1]
+
+def sample_hydrology(lats, lons, tiles_dir=TILES_DIR, search_radius_m=5000.0, index_dir=None):
+    """
+    Sample accumulation class, upstream cells and stream distance at many points
+
+    Parameters:
+    lats, lons (array-like): Point coordinates (WGS84)
+    tiles_dir (str): Directory with flow_accum.tif, flow_dir.tif, streams.tif
+        and stream_influence_reclass.tif
+    search_radius_m (float): Streams further than this are reported as NaN
+    index_dir (str): point_query.py index to use (default: its INDEX_DIR for
+        the default tiles_dir, otherwise tiles_dir/point_index)
+
+    Returns a dict of arrays: accum_class (int), upstream_cells and
+    stream_distance_m (float, NaN where unknown).
+    """
+    # Imported here: point_query builds on the helpers above
+    from point_query import INDEX_DIR, PointIndex, build_index
+
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if not lats.size:
+        return {
+            "accum_class": np.zeros(lats.shape, dtype=np.int64),
+            "upstream_cells": np.full(lats.shape, np.nan),
+            "stream_distance_m": np.full(lats.shape, np.nan),
+        }
+
+    if index_dir is None:
+        same = os.path.abspath(tiles_dir) == os.path.abspath(TILES_DIR)
+        index_dir = INDEX_DIR if same else os.path.join(tiles_dir, "point_index")
+    # No-op unless a source raster changed since the index was built
+    build_index(tiles_dir, index_dir, search_radius_m)
+
+    samples = PointIndex(index_dir).query_many(lats, lons)
+    return {
+        "accum_class": samples["accum_class"].astype(np.int64),
+        "upstream_cells": samples["upstream_cells"].astype(np.float64),
+        "stream_distance_m": samples["stream_distance_m"].astype(np.float64),
+    }
+
+def enrich_pois(pois, tiles_dir=TILES_DIR, search_radius_m=5000.0):
+    """
+    Add the sampled hydrology to a list of dicts with 'lat' and 'lon' keys, in place
+    """
+    if not pois:
+        return pois
+
+    samples = sample_hydrology([poi["lat"] for poi in pois], [poi["lon"] for poi in pois],
+                               tiles_dir, search_radius_m)
+    classes = samples["accum_class"].tolist()
+    upstream = samples["upstream_cells"]
+    distance = samples["stream_distance_m"]
+    for i, poi in enumerate(pois):
+        poi["accum_class"] = classes[i]
+        poi["upstream_cells"] = None if np.isnan(upstream[i]) else int(upstream[i])
+        poi["stream_distance_m"] = None if np.isnan(distance[i]) else round(float(distance[i]), 1)
+    return pois
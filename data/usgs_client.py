@@ -0,0 +1,137 @@
+"""
+Pooled, cached client for the USGS NWIS water services
+
+All requests go through one requests.Session whose connection pool is sized
+to the worker count, with automatic retry and exponential backoff on
+throttling and server errors. Site lists are split into batches of up to
+batch_size site numbers per NWIS request (the services accept comma-separated
+lists) and the batches run concurrently. Responses are cached on disk as JSON
+for ttl seconds, keyed by service and query parameters.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+NWIS_URL = "https://waterservices.usgs.gov/nwis"
+
+class NWISClient:
+    """
+    Client for the NWIS site and instantaneous-values services
+
+    Parameters:
+    base_url (str): Service root (point at a local stub server for testing)
+    cache_dir (str): Directory for cached responses (None disables caching)
+    ttl (float): Seconds a cached response stays fresh
+    max_workers (int): Concurrent requests (and pooled connections)
+    batch_size (int): Site numbers per request
+    retries (int): Retries per request on connection errors, 429 and 5xx
+    backoff (float): Backoff factor; retry n waits backoff * 2 ** (n - 1) seconds
+    timeout (float): Per-request timeout in seconds
+    """
+
+    def __init__(self, base_url=NWIS_URL, cache_dir=".nwis_cache", ttl=3600,
+                 max_workers=8, batch_size=100, retries=3, backoff=0.5, timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.timeout = timeout
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      allowed_methods=["GET"], respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _cache_path(self, service, params):
+        encoded = json.dumps([service, params], sort_keys=True).encode()
+        return os.path.join(self.cache_dir, hashlib.sha256(encoded).hexdigest() + ".json")
+
+    def get(self, service, params):
+        """
+        JSON response of one NWIS service query, served from the cache while fresh
+        """
+        path = self._cache_path(service, params) if self.cache_dir else None
+        if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < self.ttl:
+            with open(path) as f:
+                return json.load(f)
+
+        response = self.session.get(f"{self.base_url}/{service}/", params=params,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+
+        if path:
+            # Write then rename so concurrent readers never see a partial file
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(data, f)
+            os.replace(tmp, path)
+        return data
+
+    def get_many(self, service, params_list):
+        """
+        Run several queries concurrently, returning responses in order
+        """
+        if len(params_list) == 1:
+            return [self.get(service, params_list[0])]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(executor.map(lambda params: self.get(service, params), params_list))
+
+    def batches(self, site_nos):
+        """
+        Split site numbers into sorted, de-duplicated request batches
+        """
+        site_nos = sorted(set(site_nos))
+        return [site_nos[i:i + self.batch_size] for i in range(0, len(site_nos), self.batch_size)]
+
+    def sites(self, bbox, site_type="ST"):
+        """
+        Site service response for every site of a type in a bounding box
+        """
+        return self.get("site", {
+            "format": "json",
+            "bBox": f"{bbox['min_lon']},{bbox['min_lat']},{bbox['max_lon']},{bbox['max_lat']}",
+            "siteType": site_type,
+            "siteStatus": "all"
+        })
+
+    def instantaneous_values(self, site_nos, start_date, end_date, parameter="00065"):
+        """
+        Instantaneous-value time series for many sites, grouped by site number
+
+        Returns a dict of site_no -> list of NWIS timeSeries entries (empty
+        for sites without data).
+        """
+        params_list = [{
+            "format": "json",
+            "sites": ",".join(batch),
+            "startDT": start_date,
+            "endDT": end_date,
+            "parameterCd": parameter,
+            "siteStatus": "all"
+        } for batch in self.batches(site_nos)]
+
+        series = {site_no: [] for site_no in site_nos}
+        for data in self.get_many("iv", params_list):
+            for ts in data.get("value", {}).get("timeSeries", []):
+                site_no = ts["sourceInfo"]["siteCode"][0]["value"]
+                series.setdefault(site_no, []).append(ts)
+        return series
+
+    def close(self):
+        self.session.close()
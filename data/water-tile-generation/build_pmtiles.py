@@ -0,0 +1,513 @@
+"""
+Build the water accumulation PMTiles archive straight from the reclassified raster
+
+Replaces gdal_polygonize -> GeoJSON -> tippecanoe. Every web-mercator tile
+from MIN_ZOOM to MAX_ZOOM is handled independently: the raster is warped into
+the tile's pixel grid and then either
+- mvt: generalized for its zoom (generalize.py), polygonized in tile
+  coordinates (so no reprojection or clipping of polygons is needed) and
+  encoded as a gzipped MVT with one 'water' layer carrying the class in VALUE,
+  as map.ts expects, or
+- png / webp: drawn as a palette PNG or lossless WebP in the map's class
+  colours (palette.py), for map.ts's raster source.
+Tiles run across a process pool and are streamed into the archive in tile-id
+order, so nothing larger than a batch of encoded tiles is held in memory or
+written to disk besides the archive itself.
+
+With the zoom pyramid from tiles.py (pyramid/pyramid.json next to the input
+raster), each zoom is rendered from the coarsest level whose cells still fit
+within a tile pixel, so low zooms warp a small raster built from aggregated
+flow accumulation instead of resampling the full-resolution classes.
+
+Builds are incremental by tile: a state file records a hash of every
+BLOCK_SIZE block of each source raster, and the next build re-renders only the
+tiles over blocks that changed, copying the rest from the previous archive.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import mapbox_vector_tile
+import numpy as np
+import shapely
+from osgeo import gdal, ogr, osr
+from pmtiles.reader import MmapSource
+from pmtiles.tile import (Compression, TileType, deserialize_directory, deserialize_header,
+                          zxy_to_tileid)
+from pmtiles.writer import Writer
+
+from generalize import (MIN_AREA_PIXELS, SIMPLIFY_PIXELS, SMOOTH_SIZE, majority_filter,
+                        print_tile_size_stats, sieve, simplify_coverage, tile_size_stats)
+from palette import class_palette
+
+gdal.UseExceptions()
+
+# Zoom range of the map (MAP_CONSTANTS.CONFIG in src/lib/components/Map/map.ts)
+MIN_ZOOM = 9
+MAX_ZOOM = 15
+
+LAYER = "water"
+EXTENT = 4096
+# Raster pixels per tile side; polygon vertices land on multiples of EXTENT / TILE_PIXELS
+TILE_PIXELS = 512
+# Class 1 is background (convert_raster_to_vector used to set it to nodata)
+MIN_CLASS = 2
+NUM_CLASSES = 4
+# Tiles per batch handed to the pool
+BATCH_SIZE = 256
+
+# Tile format -> (PMTiles tile type, tile compression)
+FORMATS = {
+    "mvt": (TileType.MVT, Compression.GZIP),
+    "png": (TileType.PNG, Compression.NONE),
+    "webp": (TileType.WEBP, Compression.NONE),
+}
+
+# Bump when tile rendering changes, so incremental builds start over
+BUILD_VERSION = 2
+# Raster cells per side of the blocks hashed for incremental builds
+BLOCK_SIZE = 512
+
+WEB_MERCATOR_HALF = 20037508.342789244
+
+def window_bounds(ds, xoff, yoff, xsize, ysize):
+    """
+    (min_lon, min_lat, max_lon, max_lat) of a pixel window of a raster
+    """
+    gt = ds.GetGeoTransform()
+    xs = [gt[0] + gt[1] * xoff, gt[0] + gt[1] * (xoff + xsize)]
+    ys = [gt[3] + gt[5] * yoff, gt[3] + gt[5] * (yoff + ysize)]
+    corners = [(x, y) for x in xs for y in ys]
+
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    wgs84 = osr.SpatialReference()
+    wgs84.ImportFromEPSG(4326)
+    for ref in (srs, wgs84):
+        ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    if not srs.IsSame(wgs84):
+        transform = osr.CoordinateTransformation(srs, wgs84)
+        corners = [point[:2] for point in transform.TransformPoints(corners)]
+
+    lons, lats = zip(*corners)
+    return min(lons), min(lats), max(lons), max(lats)
+
+def raster_bounds(ds):
+    """
+    (min_lon, min_lat, max_lon, max_lat) of a raster
+    """
+    return window_bounds(ds, 0, 0, ds.RasterXSize, ds.RasterYSize)
+
+def lonlat_to_tile(lon, lat, zoom):
+    """
+    (x, y) of the tile containing a point at a zoom
+    """
+    n = 2 ** zoom
+    sin = math.sin(math.radians(lat))
+    x = (lon + 180.0) / 360.0 * n
+    y = (0.5 - 0.25 * math.log((1 + sin) / (1 - sin)) / math.pi) * n
+    return min(max(int(x), 0), n - 1), min(max(int(y), 0), n - 1)
+
+def tile_bounds(zoom, x, y):
+    """
+    EPSG:3857 (min_x, min_y, max_x, max_y) of a tile
+    """
+    size = 2 * WEB_MERCATOR_HALF / 2 ** zoom
+    min_x = -WEB_MERCATOR_HALF + x * size
+    max_y = WEB_MERCATOR_HALF - y * size
+    return min_x, max_y - size, min_x + size, max_y
+
+def tiles_covering(bounds, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM):
+    """
+    (z, x, y) of every tile over the bounds, sorted by PMTiles tile id
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    tiles = []
+    for zoom in range(min_zoom, max_zoom + 1):
+        x0, y0 = lonlat_to_tile(min_lon, max_lat, zoom)
+        x1, y1 = lonlat_to_tile(max_lon, min_lat, zoom)
+        tiles.extend((zoom, x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1))
+    return sorted(tiles, key=lambda tile: zxy_to_tileid(*tile))
+
+def zoom_sources(input_raster, pyramid, min_zoom, max_zoom):
+    """
+    Source raster for every zoom: the coarsest pyramid level with cells no larger than a tile pixel
+
+    pyramid is the path of a pyramid.json written by tiles.py, or None to
+    render every zoom from input_raster.
+    """
+    if pyramid is None:
+        return {zoom: input_raster for zoom in range(min_zoom, max_zoom + 1)}
+
+    with open(pyramid) as f:
+        manifest = json.load(f)
+    here = os.path.dirname(os.path.abspath(pyramid))
+    scale = math.cos(math.radians(manifest["latitude"])) if manifest["latitude"] is not None else 1.0
+    levels = sorted(manifest["levels"], key=lambda level: level["cell_size_m"])
+
+    sources = {}
+    for zoom in range(min_zoom, max_zoom + 1):
+        pixel_m = 2 * WEB_MERCATOR_HALF / (TILE_PIXELS * 2 ** zoom) * scale
+        fitting = [level for level in levels if level["cell_size_m"] <= pixel_m]
+        level = fitting[-1] if fitting and fitting[-1]["factor"] > 1 else None
+        sources[zoom] = (os.path.normpath(os.path.join(here, level["path"])) if level
+                         else input_raster)
+    return sources
+
+# Per-worker source rasters by path, opened once by the pool initializer
+_sources = {}
+
+def _open_sources(paths):
+    # Keep GDAL from writing .aux.xml sidecars for the in-memory PNG/WebP tiles
+    gdal.SetConfigOption("GDAL_PAM_ENABLED", "NO")
+    for path in paths:
+        _sources[path] = gdal.Open(path)
+
+def warp_tile(source, zoom, x, y, max_zoom=MAX_ZOOM, min_class=MIN_CLASS):
+    """
+    The tile's TILE_PIXELS grid of classes as a MEM dataset, classes below min_class zeroed
+
+    Returns (dataset, classes), or (None, None) when the tile holds no water classes.
+    """
+    # Nearest neighbour at full detail; the most common class when downsampling
+    ds = gdal.Warp("", source, format="MEM", dstSRS="EPSG:3857",
+                   outputBounds=tile_bounds(zoom, x, y), width=TILE_PIXELS, height=TILE_PIXELS,
+                   resampleAlg="near" if zoom >= max_zoom else "mode",
+                   dstNodata=0, outputType=gdal.GDT_Byte)
+    classes = ds.GetRasterBand(1).ReadAsArray()
+    classes[classes < min_class] = 0
+    if not classes.any():
+        return None, None
+    return ds, classes
+
+def render_tile(source, zoom, x, y, max_zoom=MAX_ZOOM, min_class=MIN_CLASS,
+                smooth=SMOOTH_SIZE, min_area=MIN_AREA_PIXELS, simplify=SIMPLIFY_PIXELS):
+    """
+    Gzipped MVT bytes of one tile (None when it holds no water classes)
+
+    smooth, min_area and simplify are the majority window, sieve threshold and
+    simplification tolerance of generalize.py, in tile pixels (0 disables each).
+    """
+    ds, classes = warp_tile(source, zoom, x, y, max_zoom, min_class)
+    if ds is None:
+        return None
+    band = ds.GetRasterBand(1)
+    band.WriteArray(majority_filter(classes, smooth))
+    sieve(band, min_area)
+
+    # Pixel -> tile coordinates (y down), so polygons come out ready to encode.
+    # The background is polygonized too, so the polygons cover the whole tile
+    # and simplifying them keeps every class boundary shared.
+    scale = EXTENT / TILE_PIXELS
+    ds.SetGeoTransform((0, scale, 0, 0, 0, scale))
+    vectors = ogr.GetDriverByName("Memory").CreateDataSource("")
+    layer = vectors.CreateLayer(LAYER, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn("VALUE", ogr.OFTInteger))
+    gdal.Polygonize(band, None, layer, 0)
+
+    values = []
+    geometries = []
+    for feature in layer:
+        values.append(feature.GetField(0))
+        geometries.append(shapely.from_wkb(bytes(feature.GetGeometryRef().ExportToWkb())))
+    geometries = simplify_coverage(geometries, simplify * scale)
+
+    features = [{"geometry": geometry, "properties": {"VALUE": value}}
+                for value, geometry in zip(values, geometries)
+                if value >= min_class and not geometry.is_empty]
+    if not features:
+        return None
+    data = mapbox_vector_tile.encode(
+        [{"name": LAYER, "features": features}],
+        default_options={"extents": EXTENT, "y_coord_down": True}
+    )
+    # mtime=0 keeps the archive byte-identical across builds
+    return gzip.compress(data, mtime=0)
+
+def render_raster_tile(source, zoom, x, y, max_zoom=MAX_ZOOM, min_class=MIN_CLASS,
+                       tile_format="png", num_classes=NUM_CLASSES):
+    """
+    Palette PNG or lossless WebP bytes of one tile (None when it holds no water classes)
+    """
+    ds, classes = warp_tile(source, zoom, x, y, max_zoom, min_class)
+    if ds is None:
+        return None
+    palette = class_palette(num_classes, min_class)
+    classes = np.minimum(classes, len(palette) - 1)
+
+    if tile_format == "png":
+        band = ds.GetRasterBand(1)
+        band.WriteArray(classes)
+        table = gdal.ColorTable()
+        for value, rgba in enumerate(palette):
+            table.SetColorEntry(value, rgba)
+        band.SetRasterColorTable(table)
+        image = ds
+        driver, options = "PNG", ["ZLEVEL=9"]
+    else:
+        # WebP has no palettes, so expand to RGBA
+        rgba = np.array(palette, dtype=np.uint8)[classes]
+        image = gdal.GetDriverByName("MEM").Create("", TILE_PIXELS, TILE_PIXELS, 4, gdal.GDT_Byte)
+        for i in range(4):
+            image.GetRasterBand(i + 1).WriteArray(rgba[:, :, i])
+        driver, options = "WEBP", ["LOSSLESS=YES"]
+
+    path = f"/vsimem/tile_{os.getpid()}_{zoom}_{x}_{y}.{tile_format}"
+    gdal.Translate(path, image, format=driver, creationOptions=options)
+    f = gdal.VSIFOpenL(path, "rb")
+    data = gdal.VSIFReadL(1, gdal.VSIStatL(path).size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(path)
+    return bytes(data)
+
+def _render_job(job):
+    zoom, x, y, source, render, options = job
+    return render(_sources[source], zoom, x, y, **options)
+
+def block_hashes(ds, block=BLOCK_SIZE):
+    """
+    Hash of every block x block window of the raster's first band, keyed "xoff,yoff"
+    """
+    band = ds.GetRasterBand(1)
+    hashes = {}
+    for yoff in range(0, ds.RasterYSize, block):
+        for xoff in range(0, ds.RasterXSize, block):
+            data = band.ReadAsArray(xoff, yoff, min(block, ds.RasterXSize - xoff),
+                                    min(block, ds.RasterYSize - yoff))
+            hashes[f"{xoff},{yoff}"] = hashlib.sha256(data.tobytes()).hexdigest()
+    return hashes
+
+def stale_tiles(ds, old_blocks, new_blocks, min_zoom, max_zoom, block=BLOCK_SIZE):
+    """
+    Tiles over the blocks whose hashes changed
+
+    Blocks are padded by a couple of cells, since resampling at lower zooms
+    reads slightly past a tile's edge.
+    """
+    stale = set()
+    for key, digest in new_blocks.items():
+        if old_blocks.get(key) == digest:
+            continue
+        xoff, yoff = (int(v) for v in key.split(","))
+        x0, y0 = max(xoff - 2, 0), max(yoff - 2, 0)
+        x1 = min(xoff + block + 2, ds.RasterXSize)
+        y1 = min(yoff + block + 2, ds.RasterYSize)
+        stale.update(tiles_covering(window_bounds(ds, x0, y0, x1 - x0, y1 - y0),
+                                    min_zoom, max_zoom))
+    return stale
+
+def archive_tiles(path):
+    """
+    Tile id -> bytes lookup into an existing archive, and the file to close after use
+    """
+    f = open(path, "rb")
+    get_bytes = MmapSource(f)
+    header = deserialize_header(get_bytes(0, 127))
+    entries = {}
+
+    def walk(offset, length):
+        for entry in deserialize_directory(get_bytes(offset, length)):
+            if entry.run_length == 0:
+                walk(header["leaf_directory_offset"] + entry.offset, entry.length)
+                continue
+            for i in range(entry.run_length):
+                entries[entry.tile_id + i] = (header["tile_data_offset"] + entry.offset, entry.length)
+
+    walk(header["root_offset"], header["root_length"])
+
+    def lookup(tileid):
+        if tileid not in entries:
+            return None
+        return get_bytes(*entries[tileid])
+
+    return lookup, f
+
+def build_pmtiles(input_raster, output_file, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM,
+                  min_class=MIN_CLASS, workers=None, smooth=SMOOTH_SIZE,
+                  min_area=MIN_AREA_PIXELS, simplify=SIMPLIFY_PIXELS, tile_format="mvt",
+                  state_path=None, incremental=False, pyramid=None):
+    """
+    Render every tile of the raster into a PMTiles archive
+
+    Parameters:
+    input_raster (str): Reclassified influence raster (stream_influence_reclass.tif)
+    output_file (str): PMTiles archive to write
+    min_zoom, max_zoom (int): Zoom range to build
+    min_class (int): Lowest class drawn; smaller values are left out
+    workers (int): Worker processes (defaults to one per CPU)
+    smooth, min_area, simplify: Generalization settings for mvt (see render_tile)
+    tile_format (str): 'mvt' for vector tiles, 'png' or 'webp' for raster tiles
+    state_path (str): Block hashes for incremental builds (defaults to output_file + '.state.json')
+    incremental (bool): Re-render only the tiles over changed blocks when the state matches
+    pyramid (str): pyramid.json of coarser levels for the low zooms (see zoom_sources)
+
+    Returns a dict of tile counts, archive size and per-zoom tile size statistics.
+    """
+    state_path = state_path or output_file + ".state.json"
+    if tile_format == "mvt":
+        render = render_tile
+        options = {"max_zoom": max_zoom, "min_class": min_class, "smooth": smooth,
+                   "min_area": min_area, "simplify": simplify}
+    else:
+        render = render_raster_tile
+        options = {"max_zoom": max_zoom, "min_class": min_class, "tile_format": tile_format}
+
+    sources = zoom_sources(input_raster, pyramid, min_zoom, max_zoom)
+    # Zoom range each source raster is rendered at
+    source_zooms = {}
+    for zoom, source in sources.items():
+        low, high = source_zooms.get(source, (zoom, zoom))
+        source_zooms[source] = (min(low, zoom), max(high, zoom))
+    names = {source: os.path.relpath(source, os.path.dirname(os.path.abspath(input_raster)))
+             for source in source_zooms}
+
+    ds = gdal.Open(input_raster)
+    bounds = raster_bounds(ds)
+    state = {
+        "version": BUILD_VERSION,
+        "format": tile_format,
+        "zooms": [min_zoom, max_zoom],
+        "options": options,
+        "source": {"size": [ds.RasterXSize, ds.RasterYSize],
+                   "geotransform": list(ds.GetGeoTransform()),
+                   "projection": ds.GetProjection()},
+        "sources": {str(zoom): names[source] for zoom, source in sources.items()},
+        "blocks": {names[source]: block_hashes(gdal.Open(source)) for source in source_zooms},
+    }
+    ds = None
+
+    tiles = tiles_covering(bounds, min_zoom, max_zoom)
+    stale = None
+    previous = None
+    if incremental and os.path.exists(state_path) and os.path.exists(output_file):
+        with open(state_path) as f:
+            old_state = json.load(f)
+        if all(old_state.get(key) == state[key]
+               for key in ("version", "format", "zooms", "options", "source", "sources")):
+            stale = set()
+            for source, (low, high) in source_zooms.items():
+                stale |= stale_tiles(gdal.Open(source), old_state["blocks"][names[source]],
+                                     state["blocks"][names[source]], low, high)
+            previous, previous_file = archive_tiles(output_file)
+        else:
+            print("Build settings or raster grids changed; rebuilding every tile")
+
+    todo = len(tiles) if stale is None else sum(1 for tile in tiles if tile in stale)
+    workers = workers or os.cpu_count()
+    print(f"Rendering {todo} of {len(tiles)} {tile_format} tiles at zooms {min_zoom}-{max_zoom} "
+          f"with {workers} workers...")
+
+    start = time.time()
+    sizes = {zoom: [] for zoom in range(min_zoom, max_zoom + 1)}
+    tmp = output_file + ".tmp"
+    with open(tmp, "wb") as f:
+        writer = Writer(f)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_sources,
+                                 initargs=(list(source_zooms),)) as executor:
+            # Batches keep the results waiting to be written in order bounded
+            for i in range(0, len(tiles), BATCH_SIZE):
+                batch = tiles[i:i + BATCH_SIZE]
+                pending = [tile for tile in batch if stale is None or tile in stale]
+                chunksize = max(1, len(pending) // (workers * 4))
+                jobs = [(zoom, x, y, sources[zoom], render, options) for zoom, x, y in pending]
+                rendered = dict(zip(pending, executor.map(_render_job, jobs, chunksize=chunksize)))
+
+                for tile in batch:
+                    tileid = zxy_to_tileid(*tile)
+                    data = rendered[tile] if tile in rendered else previous(tileid)
+                    if data is not None:
+                        writer.write_tile(tileid, data)
+                        sizes[tile[0]].append(len(data))
+                print(f"  {min(i + BATCH_SIZE, len(tiles))}/{len(tiles)} tiles "
+                      f"({time.time() - start:.1f}s)")
+
+        if previous is not None:
+            previous_file.close()
+        written = sum(len(zoom_sizes) for zoom_sizes in sizes.values())
+        if not written:
+            raise RuntimeError(f"No tiles with class >= {min_class} in {input_raster}")
+
+        tile_type, tile_compression = FORMATS[tile_format]
+        min_lon, min_lat, max_lon, max_lat = bounds
+        metadata = {"name": "stream_influence_water_difference", "format": tile_format}
+        if tile_format == "mvt":
+            metadata["vector_layers"] = [{
+                "id": LAYER,
+                "fields": {"VALUE": "Number"},
+                "minzoom": min_zoom,
+                "maxzoom": max_zoom
+            }]
+        writer.finalize({
+            "tile_type": tile_type,
+            "tile_compression": tile_compression,
+            "min_lon_e7": int(min_lon * 1e7),
+            "min_lat_e7": int(min_lat * 1e7),
+            "max_lon_e7": int(max_lon * 1e7),
+            "max_lat_e7": int(max_lat * 1e7),
+            "center_zoom": min_zoom,
+            "center_lon_e7": int((min_lon + max_lon) / 2 * 1e7),
+            "center_lat_e7": int((min_lat + max_lat) / 2 * 1e7),
+        }, metadata)
+    os.replace(tmp, output_file)
+    with open(state_path, "w") as f:
+        json.dump(state, f)
+
+    return {"tiles": len(tiles), "rendered": todo, "written": written,
+            "bytes": os.path.getsize(output_file), "seconds": time.time() - start,
+            "zooms": tile_size_stats(sizes)}
+
+if __name__ == "__main__":
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Build PMTiles from the water accumulation raster")
+    parser.add_argument("--input", default=os.path.join(here, "..", "dem", "tiles",
+                                                        "stream_influence_reclass.tif"),
+                        help="Reclassified influence raster from tiles.py")
+    parser.add_argument("--output", default=None,
+                        help="PMTiles archive to write (defaults to static/tiles.pmtiles for mvt "
+                             "and static/tiles_raster.pmtiles for png/webp)")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="mvt",
+                        help="Vector tiles, or palette PNG / lossless WebP raster tiles")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only re-render tiles over parts of the raster that changed")
+    parser.add_argument("--no-pyramid", action="store_true",
+                        help="Render every zoom from --input, ignoring the tiles.py zoom pyramid")
+    parser.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    parser.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    parser.add_argument("--min-class", type=int, default=MIN_CLASS,
+                        help="Lowest class drawn (class 1 is background)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes (defaults to one per CPU)")
+    parser.add_argument("--smooth", type=int, default=SMOOTH_SIZE,
+                        help="Majority filter window in pixels (0 disables)")
+    parser.add_argument("--min-area", type=int, default=MIN_AREA_PIXELS,
+                        help="Merge regions smaller than this many pixels into a neighbour")
+    parser.add_argument("--simplify", type=float, default=SIMPLIFY_PIXELS,
+                        help="Simplification tolerance in pixels (0 disables)")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.input):
+        raise SystemExit(f"Error: Input file {args.input} not found!\n"
+                         "Please run tiles.py first to generate the raster.")
+
+    pyramid = os.path.join(os.path.dirname(os.path.abspath(args.input)), "pyramid", "pyramid.json")
+    if args.no_pyramid or not os.path.exists(pyramid):
+        pyramid = None
+    else:
+        print(f"Using the zoom pyramid in {os.path.dirname(pyramid)}")
+
+    name = "tiles.pmtiles" if args.format == "mvt" else "tiles_raster.pmtiles"
+    output = args.output or os.path.join(here, "..", "..", "static", name)
+    # State stays out of static/ so it isn't deployed
+    state_path = os.path.join(here, os.path.basename(output) + ".state.json")
+
+    stats = build_pmtiles(args.input, output, args.min_zoom, args.max_zoom,
+                          args.min_class, args.workers, args.smooth, args.min_area,
+                          args.simplify, args.format, state_path, args.incremental, pyramid)
+    print_tile_size_stats(stats["zooms"])
+    print(f"Done! {stats['written']} of {stats['tiles']} tiles ({stats['rendered']} rendered), "
+          f"{stats['bytes'] / 1024 ** 2:.1f} MB in {stats['seconds']:.1f}s at {output}")
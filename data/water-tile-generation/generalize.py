@@ -0,0 +1,86 @@
+"""
+Zoom-appropriate generalization of the water accumulation classes for the tile build
+
+Runs on each tile's class grid before and after polygonizing, so the classes
+always partition the tile and neighbouring classes keep one shared boundary:
+- majority filter: every cell takes the most common class around it, which
+  smooths one-cell stair-steps and removes one-cell slivers and spurs
+- sieve: regions smaller than a minimum area are merged into their largest
+  neighbour (rather than dropped, which would leave holes)
+- coverage simplification: the polygonized partition is simplified edge by
+  edge, so a boundary shared by two classes is simplified once and both sides
+  stay in contact; the tile edges are kept exact so neighbouring tiles meet
+
+Sizes are in tile pixels. Every zoom is rendered at TILE_PIXELS per tile, so
+the amount of generalization is constant on screen and scales with the
+ground size of a pixel at each zoom.
+"""
+
+import numpy as np
+import shapely
+from osgeo import gdal
+from scipy.ndimage import uniform_filter
+
+# Majority window side (cells)
+SMOOTH_SIZE = 3
+# Regions smaller than this many pixels are merged into a neighbour
+MIN_AREA_PIXELS = 16
+# Simplification tolerance in pixels
+SIMPLIFY_PIXELS = 1.0
+
+def majority_filter(classes, size=SMOOTH_SIZE):
+    """
+    Replace every cell by the most common class in its size x size window
+
+    Ties keep the cell's own class, so straight boundaries do not move.
+    """
+    values = np.unique(classes)
+    if size <= 1 or len(values) < 2:
+        return classes
+
+    own = classes[None] == values[:, None, None]
+    counts = np.stack([uniform_filter(mask.astype(np.float32), size, mode="nearest")
+                       for mask in own])
+    # Less than one cell's share of the window, so it only breaks ties
+    counts += own * (0.5 / size ** 2)
+    return values[np.argmax(counts, axis=0)].astype(classes.dtype)
+
+def sieve(band, min_area=MIN_AREA_PIXELS):
+    """
+    Merge 4-connected regions smaller than min_area pixels into their largest neighbour, in place
+    """
+    if min_area > 1:
+        gdal.SieveFilter(band, None, band, min_area, 4)
+
+def simplify_coverage(geometries, tolerance):
+    """
+    Simplify polygons that partition a tile without opening gaps or overlaps between them
+    """
+    if tolerance <= 0 or not len(geometries):
+        return geometries
+    return shapely.coverage_simplify(np.asarray(geometries), tolerance, simplify_boundary=False)
+
+def tile_size_stats(sizes):
+    """
+    Per-zoom tile size summary from a dict of zoom -> list of tile sizes in bytes
+    """
+    stats = {}
+    for zoom in sorted(sizes):
+        data = np.asarray(sizes[zoom], dtype=np.float64)
+        if not data.size:
+            continue
+        stats[zoom] = {
+            "tiles": int(data.size),
+            "total_bytes": int(data.sum()),
+            "mean_bytes": round(float(data.mean()), 1),
+            "p95_bytes": round(float(np.percentile(data, 95)), 1),
+            "max_bytes": int(data.max()),
+        }
+    return stats
+
+def print_tile_size_stats(stats):
+    print(f"{'zoom':>4} {'tiles':>8} {'total KB':>10} {'mean KB':>8} {'p95 KB':>8} {'max KB':>8}")
+    for zoom, row in stats.items():
+        print(f"{zoom:>4} {row['tiles']:>8} {row['total_bytes'] / 1024:>10.1f} "
+              f"{row['mean_bytes'] / 1024:>8.1f} {row['p95_bytes'] / 1024:>8.1f} "
+              f"{row['max_bytes'] / 1024:>8.1f}")
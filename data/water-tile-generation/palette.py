@@ -0,0 +1,65 @@
+"""
+Water accumulation class colours, matching the map
+
+flood_colors reproduces generateFloodColors in src/lib/components/Map/map.ts:
+chroma.scale(['#abced0', DARKEST_FLOOD_COLOR]).mode('lab').colors(4), with
+chroma-js's sRGB/CIE Lab conversion (D65 white point).
+"""
+
+import numpy as np
+
+LIGHTEST_FLOOD_COLOR = "#abced0"
+DARKEST_FLOOD_COLOR = "#519EA2"
+
+# sRGB <-> XYZ (D65) matrices and white point used by chroma-js
+RGB_TO_XYZ = np.array([
+    [0.4124564390896922, 0.357576077643909, 0.18043748326639894],
+    [0.21267285140562253, 0.715152155287818, 0.07217499080655754],
+    [0.019333895582329317, 0.119192025881303, 0.9503040785363677],
+])
+XYZ_TO_RGB = np.linalg.inv(RGB_TO_XYZ)
+WHITE = np.array([0.95047, 1.0, 1.08883])
+KE = 216 / 24389
+KK = 24389 / 27
+
+def hex_to_rgb(color):
+    color = color.lstrip("#")
+    return np.array([int(color[i:i + 2], 16) for i in (0, 2, 4)], dtype=np.float64)
+
+def rgb_to_lab(rgb):
+    c = rgb / 255
+    linear = np.where(c <= 0.04045, c / 12.92, ((c + 0.055) / 1.055) ** 2.4)
+    xyz = RGB_TO_XYZ @ linear / WHITE
+    f = np.where(xyz > KE, np.cbrt(xyz), (KK * xyz + 16) / 116)
+    return np.array([116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2])])
+
+def lab_to_rgb(lab):
+    l, a, b = lab
+    fy = (l + 16) / 116
+    fx = fy + a / 500
+    fz = fy - b / 200
+    x = fx ** 3 if fx ** 3 > KE else (116 * fx - 16) / KK
+    y = fy ** 3 if l > KK * KE else l / KK
+    z = fz ** 3 if fz ** 3 > KE else (116 * fz - 16) / KK
+    linear = XYZ_TO_RGB @ (np.array([x, y, z]) * WHITE)
+    c = np.where(linear <= 0.0031308, 12.92 * linear,
+                 1.055 * np.abs(linear) ** (1 / 2.4) - 0.055)
+    return np.clip(np.round(c * 255), 0, 255).astype(np.uint8)
+
+def flood_colors(num_classes=4):
+    """
+    RGB colours of classes 1..num_classes, lightest first
+    """
+    start = rgb_to_lab(hex_to_rgb(LIGHTEST_FLOOD_COLOR))
+    end = rgb_to_lab(hex_to_rgb(DARKEST_FLOOD_COLOR))
+    steps = np.linspace(0, 1, num_classes) if num_classes > 1 else [0.0]
+    return [tuple(int(v) for v in lab_to_rgb(start + t * (end - start))) for t in steps]
+
+def class_palette(num_classes=4, min_class=1):
+    """
+    RGBA palette indexed by class value; 0 and classes below min_class are transparent
+    """
+    palette = [(0, 0, 0, 0)]
+    for value, rgb in enumerate(flood_colors(num_classes), start=1):
+        palette.append(rgb + (255,) if value >= min_class else (0, 0, 0, 0))
+    return palette
@@ -2,14 +2,20 @@ import maplibregl from 'maplibre-gl';
 import type { StyleSpecification } from 'maplibre-gl';
 import { Protocol, PMTiles } from 'pmtiles';
 import pois from '../../data/pois.json';
+import poiIndex from '../../data/poi_index.json';
 import { MarkerPill } from './marker';
 import { writable } from 'svelte/store';
 import chroma from 'chroma-js';
 
+type WaterSource = 'vector' | 'raster';
+
 // Maricopa County map constants
 const MAP_CONSTANTS = {
   DARKEST_FLOOD_COLOR: '#519EA2',
   PMTILES_URL: 'tiles.pmtiles',
+  // Raster tiles of the same classes (build_pmtiles.py --format png|webp)
+  RASTER_PMTILES_URL: 'tiles_raster.pmtiles',
+  WATER_SOURCE: 'vector' as WaterSource,
   CONFIG: {
     center: [-112.074, 33.448] as [number, number], // Phoenix center
     maxZoom: 15,
@@ -55,43 +61,110 @@ type Marker = {
   feature?: POIFeature;
 };
 
+// Precomputed by data/poi_index.py: the feature shown for each name and the
+// marker clusters for every zoom level
+type Cluster = {
+  id: string;
+  coordinates: [number, number];
+  count: number;
+  events: number;
+  damage_property: number;
+  damage_crops: number;
+  deaths: number;
+  injuries: number;
+  children: string[];
+  name?: string;
+};
+
+const markerFeatures = poiIndex.markers as Record<string, number>;
+const clusterLevels = poiIndex.clusters as unknown as Record<string, Cluster[]>;
+
+const markerFeature = (name: string): POIFeature | undefined =>
+  pois.features[markerFeatures[name]];
+
 export const selectedPOI = writable<POIFeature | null>(null);
 
 export default class Map {
   private map?: maplibregl.Map;
   private markers: Marker[] = [];
   private markersVisible: boolean = true;
+  private markerZoom: number | null = null;
+  private waterSource: WaterSource = MAP_CONSTANTS.WATER_SOURCE;
+  private layerOpacity: number = 0.8;
 
   private initializeLayers(): void {
     if (!this.map) return;
 
+    // Keep the water layer under the highlighted-POI circles
+    const beforeId = this.map.getLayer('pulse-point-outer') ? 'pulse-point-outer' : undefined;
+
+    if (this.waterSource === 'raster') {
+      this.map.addSource('pmtiles-source', {
+        type: 'raster',
+        url: `pmtiles://${MAP_CONSTANTS.RASTER_PMTILES_URL}`,
+        tileSize: 512,
+        attribution: '© <a href="https://openstreetmap.org">OpenStreetMap</a>'
+      });
+
+      // Class colours are baked into the tiles (data/water-tile-generation/palette.py)
+      this.map.addLayer(
+        {
+          id: 'pmtiles-layer',
+          type: 'raster',
+          source: 'pmtiles-source',
+          paint: {
+            'raster-opacity': this.layerOpacity,
+            'raster-resampling': 'nearest'
+          }
+        },
+        beforeId
+      );
+      return;
+    }
+
     this.map.addSource('pmtiles-source', {
       type: 'vector',
       url: `pmtiles://${MAP_CONSTANTS.PMTILES_URL}`,
       attribution: '© <a href="https://openstreetmap.org">OpenStreetMap</a>'
     });
 
-    this.map.addLayer({
-      id: 'pmtiles-layer',
-      type: 'fill',
-      source: 'pmtiles-source',
-      'source-layer': 'water',
+    this.map.addLayer(
+      {
+        id: 'pmtiles-layer',
+        type: 'fill',
+        source: 'pmtiles-source',
+        'source-layer': 'water',
+
+        paint: {
+          'fill-color': [
+            'interpolate',
+            ['linear'],
+            ['get', 'VALUE'],
+            2,
+            '#C4CDD020',
+            3,
+            '#abced0',
+            4,
+            '#519ea2'
+          ],
+          'fill-opacity': this.layerOpacity
+        }
+      },
+      beforeId
+    );
+  }
 
-      paint: {
-        'fill-color': [
-          'interpolate',
-          ['linear'],
-          ['get', 'VALUE'],
-          2,
-          '#C4CDD020',
-          3,
-          '#abced0',
-          4,
-          '#519ea2'
-        ],
-        'fill-opacity': 0.8
-      }
-    });
+  setWaterSource(source: WaterSource): void {
+    if (!this.map || source === this.waterSource) return;
+
+    this.waterSource = source;
+    if (this.map.getLayer('pmtiles-layer')) {
+      this.map.removeLayer('pmtiles-layer');
+    }
+    if (this.map.getSource('pmtiles-source')) {
+      this.map.removeSource('pmtiles-source');
+    }
+    this.initializeLayers();
   }
 
   private setupEventListeners(): void {
@@ -102,10 +175,10 @@ export default class Map {
 
     selectedPOI.subscribe(poi => {
       if (poi && this.map) {
-        const marker = this.markers.find(m => m.name === poi.properties.name);
-        if (marker) {
+        const feature = markerFeature(poi.properties.name);
+        if (feature) {
           this.map.flyTo({
-            center: marker.coordinates,
+            center: feature.geometry.coordinates as [number, number],
             zoom: 14,
             duration: 2000
           });
@@ -114,6 +187,24 @@ export default class Map {
     });
   }
 
+  private addMarker(
+    element: HTMLElement,
+    coordinates: [number, number]
+  ): maplibregl.Marker | undefined {
+    if (!this.map) return;
+
+    return new maplibregl.Marker({
+      element,
+      anchor: 'left',
+      offset: [0, -10],
+      clickTolerance: 10,
+      pitchAlignment: 'viewport',
+      rotationAlignment: 'viewport'
+    })
+      .setLngLat(coordinates)
+      .addTo(this.map);
+  }
+
   private createMarker(feature: POIFeature): void {
     if (!this.map) return;
 
@@ -128,37 +219,65 @@ export default class Map {
       selectedPOI.set(feature);
     });
 
-    const markerObj = new maplibregl.Marker({
-      element: markerEl,
-      anchor: 'left',
-      offset: [0, -10],
-      clickTolerance: 10,
-      pitchAlignment: 'viewport',
-      rotationAlignment: 'viewport'
-    })
-      .setLngLat(coordinates)
-      .addTo(this.map);
+    const markerObj = this.addMarker(markerEl, coordinates);
 
     this.markers.push({ name, coordinates, markerObj, feature });
     markerPill.render(name);
   }
 
-  private initializeMarkers(): void {
-    const uniquePOIs = pois.features.reduce((acc: POIFeature[], current) => {
-      const index = acc.findIndex(
-        item => item.properties.name === current.properties.name
-      );
-      if (index === -1) {
-        acc.push(current);
-      } else if (
-        parseInt(current.properties.date) > parseInt(acc[index].properties.date)
-      ) {
-        acc[index] = current;
+  private createClusterMarker(cluster: Cluster, zoom: number): void {
+    if (!this.map) return;
+
+    const markerPill = new MarkerPill(this.map);
+    const markerEl = markerPill.onAdd();
+
+    markerEl.addEventListener('click', e => {
+      e.stopPropagation();
+      this.map?.flyTo({
+        center: cluster.coordinates,
+        zoom: Math.min(zoom + 2, poiIndex.maxZoom),
+        duration: 1000
+      });
+    });
+
+    const markerObj = this.addMarker(markerEl, cluster.coordinates);
+
+    this.markers.push({
+      name: cluster.id,
+      coordinates: cluster.coordinates,
+      markerObj
+    });
+    markerPill.render(`${cluster.count} places`);
+  }
+
+  private renderMarkers(): void {
+    if (!this.map) return;
+
+    const zoom = Math.min(
+      Math.max(Math.floor(this.map.getZoom()), poiIndex.minZoom),
+      poiIndex.maxZoom
+    );
+    if (zoom === this.markerZoom) return;
+    this.markerZoom = zoom;
+
+    this.markers.forEach(marker => marker.markerObj?.remove());
+    this.markers = [];
+
+    clusterLevels[zoom].forEach(cluster => {
+      const feature = cluster.name && markerFeature(cluster.name);
+      if (feature) {
+        this.createMarker(feature);
+      } else {
+        this.createClusterMarker(cluster, zoom);
       }
-      return acc;
-    }, []);
+    });
 
-    uniquePOIs.forEach(feature => this.createMarker(feature));
+    this.togglePOIVisibility(this.markersVisible);
+  }
+
+  private initializeMarkers(): void {
+    this.renderMarkers();
+    this.map?.on('zoomend', () => this.renderMarkers());
   }
 
   private addBlinkingCircle(coordinates: [number, number]): void {
@@ -282,7 +401,12 @@ export default class Map {
 
   setLayerOpacity(opacity: number): void {
     if (this.map) {
-      this.map.setPaintProperty('pmtiles-layer', 'fill-opacity', opacity);
+      this.layerOpacity = opacity;
+      this.map.setPaintProperty(
+        'pmtiles-layer',
+        this.waterSource === 'raster' ? 'raster-opacity' : 'fill-opacity',
+        opacity
+      );
     }
   }
 
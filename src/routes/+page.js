@@ -1,28 +1,10 @@
-import POIS from '$lib/data/pois.json';
+import POI_INDEX from '$lib/data/poi_index.json';
 
 export const prerender = true;
 
+// Grouped by name (links by date) when the data is built; see data/poi_index.py
 export const load = async () => {
-  const transformedPois = POIS.features.reduce((acc, feature) => {
-    const { name, date, url } = feature.properties;
-
-    if (!acc[name]) {
-      acc[name] = {
-        links: {},
-        coordinates: feature.geometry.coordinates,
-        neighborhood: feature.properties.neighbourhood
-      };
-    }
-
-    if (!acc[name].links[date]) {
-      acc[name].links[date] = [];
-    }
-
-    acc[name].links[date].push(url);
-    return acc;
-  }, {});
-
   return {
-    pois: transformedPois
+    pois: POI_INDEX.groups
   };
 };